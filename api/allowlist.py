@@ -0,0 +1,239 @@
+"""
+Allowlist
+
+Ranges that must never be blocked (our own networks, CDNs, partners, cloud
+providers) are held in one path-compressed binary trie per address family, so
+checking an address costs at most one step per prefix bit however many ranges
+are listed. Every range remembers the source it was loaded from, so matches
+can be reported per source.
+"""
+import ipaddress
+import json
+import logging
+import os
+from bisect import bisect_left
+
+
+class _Node:
+    __slots__ = ("value", "length", "source", "children")
+
+    def __init__(self, value, length, source=None):
+        self.value = value
+        self.length = length
+        self.source = source
+        self.children = [None, None]
+
+
+class PrefixTrie:
+    """Patricia trie of prefixes of one address family mapping each to a source"""
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = _Node(0, 0)
+        self.size = 0
+
+    def _bit(self, value, position):
+        return (value >> (self.bits - 1 - position)) & 1
+
+    def _common_length(self, first, second, limit):
+        differing = first ^ second
+        if not differing:
+            return limit
+        return min(limit, self.bits - differing.bit_length())
+
+    def insert(self, value, length, source):
+        """Add the prefix value/length; a prefix that is already listed keeps its first source"""
+        value &= ~((1 << (self.bits - length)) - 1)
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.source is None:
+                    node.source = source
+                    self.size += 1
+                return
+            bit = self._bit(value, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _Node(value, length, source)
+                self.size += 1
+                return
+            common = self._common_length(value, child.value, min(length, child.length))
+            if common == child.length:
+                node = child
+                continue
+            if common == length:
+                inserted = _Node(value, length, source)
+                inserted.children[self._bit(child.value, length)] = child
+            else:
+                inserted = _Node(value & ~((1 << (self.bits - common)) - 1), common)
+                inserted.children[self._bit(child.value, common)] = child
+                inserted.children[self._bit(value, common)] = _Node(value, length, source)
+            node.children[bit] = inserted
+            self.size += 1
+            return
+
+    def _covers(self, node, value):
+        return (node.value ^ value) >> (self.bits - node.length) == 0
+
+    def lookup(self, value):
+        """Source of the most specific prefix containing the address value, None if none does"""
+        node = self.root
+        found = node.source
+        while node.length < self.bits:
+            node = node.children[self._bit(value, node.length)]
+            if node is None or not self._covers(node, value):
+                break
+            if node.source is not None:
+                found = node.source
+        return found
+
+    def overlaps(self, value, length):
+        """Return True if any listed prefix contains or lies inside value/length"""
+        if not self.size:
+            return False
+        node = self.root
+        if node.source is not None:
+            return True
+        while node.length < length:
+            node = node.children[self._bit(value, node.length)]
+            if node is None:
+                return False
+            if node.length >= length:
+                # Every node below a listed prefix leads to at least one listed prefix
+                return (node.value ^ value) >> (self.bits - length) == 0
+            if not self._covers(node, value):
+                return False
+            if node.source is not None:
+                return True
+        return True
+
+
+class Allowlist:
+    def __init__(self):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.sources = {}
+        self.mtimes = {}
+
+    def __len__(self):
+        return self.tries[4].size + self.tries[6].size
+
+    def add(self, cidr, source):
+        network = ipaddress.ip_network(cidr.strip(), strict=False)
+        self.tries[network.version].insert(int(network.network_address), network.prefixlen, source)
+
+    def load_file(self, path, source):
+        """Add the ranges in path, one CIDR per line or a cloud provider JSON range file
+
+        Lines may carry # comments. In JSON files every string under a key
+        containing "prefix" is read, which covers the AWS, Google Cloud and
+        similar range files. Returns the number of ranges read.
+        """
+        with open(path, "r") as file:
+            if path.endswith(".json"):
+                ranges = list(_json_prefixes(json.load(file)))
+            else:
+                ranges = [line.split("#", 1)[0].strip() for line in file]
+
+        count = 0
+        for cidr in ranges:
+            if not cidr:
+                continue
+            try:
+                self.add(cidr, source)
+            except ValueError:
+                logging.warning(f"Ignoring invalid allowlist range {cidr!r} in {path}")
+                continue
+            count += 1
+        self.sources[source] = self.sources.get(source, 0) + count
+        self.mtimes[path] = os.path.getmtime(path)
+        return count
+
+    def match(self, ip_address):
+        """Source of the allowlist range containing ip_address, None if it may be blocked"""
+        address = ipaddress.ip_address(ip_address)
+        return self.tries[address.version].lookup(int(address))
+
+    def filter(self, ip_set, hits=None):
+        """Return ip_set without the allowlisted addresses
+
+        With a hits dict, the (version, integer) of every dropped address is
+        added to the set of the source that matched it.
+        """
+        if not len(self):
+            return ip_set
+
+        def keep(version, value):
+            source = self.tries[version].lookup(value)
+            if source is None:
+                return True
+            if hits is not None:
+                hits.setdefault(source, set()).add((version, value))
+            return False
+
+        return ip_set.filter(keep)
+
+    def split_overlapping(self, prefixes, ip_set):
+        """Replace prefixes that cover an allowlisted range by host routes for their members in ip_set
+
+        Aggregation below full density can produce a prefix that reaches into an
+        allowlisted range; its blocked addresses are then pushed one by one.
+        """
+        if not len(self):
+            return prefixes
+        result = set()
+        split = 0
+        for prefix in prefixes:
+            network = ipaddress.ip_network(prefix)
+            start = int(network.network_address)
+            if not self.tries[network.version].overlaps(start, network.prefixlen):
+                result.add(prefix)
+                continue
+            split += 1
+            values = ip_set.ipv4_integers() if network.version == 4 else ip_set.ipv6_integers()
+            end = start + network.num_addresses
+            for value in values[bisect_left(values, start):bisect_left(values, end)]:
+                result.add(f"{type(network.network_address)(value)}/{network.max_prefixlen}")
+        if split:
+            logging.info(f"Split {split} aggregated prefixes that overlap the allowlist into host routes")
+        return result
+
+    def is_stale(self, files):
+        """Return True if one of files was changed, added or removed since it was loaded"""
+        for paths in files.values():
+            for path in _paths(paths):
+                try:
+                    if os.path.getmtime(path) != self.mtimes.get(path):
+                        return True
+                except OSError:
+                    if path in self.mtimes:
+                        return True
+        return False
+
+
+def _json_prefixes(data, key=""):
+    if isinstance(data, dict):
+        for name, value in data.items():
+            yield from _json_prefixes(value, name)
+    elif isinstance(data, list):
+        for value in data:
+            yield from _json_prefixes(value, key)
+    elif isinstance(data, str) and "prefix" in key.lower():
+        yield data
+
+
+def _paths(paths):
+    return [paths] if isinstance(paths, str) else paths
+
+
+def load_allowlist(files):
+    """Build an Allowlist from a mapping of source name to one path or a list of paths"""
+    allowlist = Allowlist()
+    for source, paths in files.items():
+        for path in _paths(paths):
+            try:
+                count = allowlist.load_file(path, source)
+            except (OSError, ValueError) as e:
+                logging.error(f"Could not load allowlist {source} from {path}: {str(e)}")
+                continue
+            logging.info(f"Loaded {count} allowlist ranges for {source} from {path}")
+    return allowlist
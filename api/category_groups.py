@@ -0,0 +1,78 @@
+"""
+Category Groups
+
+Every category (query name) has a bit in the categories mask of each IP in the
+state store. A category group gathers categories into one address set and one
+security policy on the device, so C2 frameworks can be denied while scanners
+are only logged. The groups of an IP are found with one AND per group against
+its mask, and every prefix carries the bitmask of the groups whose sets list
+it, so the membership changes between two runs are the XOR of the masks.
+"""
+import re
+from collections import namedtuple
+
+DEFAULT_GROUP = "default"
+ACTIONS = ("deny", "log")
+
+CategoryGroup = namedtuple("CategoryGroup", ["name", "bit", "categories", "address_set", "policy", "action"])
+
+
+def group_categories(group_config):
+    """Every category named by a group"""
+    return sorted({category for settings in group_config.values() for category in settings["categories"]})
+
+
+def build_groups(group_config, category_bits, group_bits, default_set, default_policy):
+    """Return the CategoryGroups with the default group (bit 0) first
+
+    categories is the mask of the category bits of a group. The default group
+    keeps the original deny set and policy and takes every category no other
+    group names, as well as IPs stored before categories were recorded.
+    """
+    groups = []
+    named = 0
+    for name, settings in group_config.items():
+        action = settings.get("action", "deny")
+        if action not in ACTIONS:
+            raise ValueError(f"Category group {name}: action must be one of {', '.join(ACTIONS)}, not {action!r}")
+        mask = 0
+        for category in settings["categories"]:
+            mask |= 1 << category_bits[category]
+        named |= mask
+        slug = re.sub(r"[^a-z0-9]+", "-", name.lower()).strip("-")
+        groups.append(CategoryGroup(
+            name, group_bits[name], mask,
+            settings.get("address_set", f"cip-{slug}-set"), settings.get("policy", f"cip-{slug}-{action}"), action,
+        ))
+    return [CategoryGroup(DEFAULT_GROUP, 0, ~named, default_set, default_policy, "deny")] + groups
+
+
+def group_mask(categories, groups):
+    """Bitmask of the groups an IP with the given categories mask belongs to
+
+    Deny wins over log: an IP in a deny group is left out of the log groups,
+    since the permit policy of a log group may come first in the policy order.
+    """
+    if not categories:
+        return 1
+    mask = 0
+    for group in groups:
+        if categories & group.categories:
+            mask |= 1 << group.bit
+    if mask & action_mask(groups, "deny"):
+        mask &= ~action_mask(groups, "log")
+    return mask
+
+
+def action_mask(groups, action):
+    """Bitmask of the groups with the given action"""
+    mask = 0
+    for group in groups:
+        if group.action == action:
+            mask |= 1 << group.bit
+    return mask
+
+
+def address_sets(groups):
+    """Group address set names by group bit"""
+    return {group.bit: group.address_set for group in groups}
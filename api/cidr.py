@@ -0,0 +1,62 @@
+"""
+CIDR Aggregation
+
+Collapse a set of blocked addresses into the smallest list of covering
+prefixes. With min_density below 1.0 a prefix may also cover a few addresses
+that are not on the blocklist, trading precision for fewer address objects.
+"""
+import ipaddress
+
+
+def _aggregate(values, bits, min_density, min_prefix_len):
+    """Greedily emit the shortest prefixes whose listed-address density is high enough
+
+    values must be sorted integers. Prefix lengths are tried from min_prefix_len
+    down to host routes; addresses covered by an emitted prefix are not
+    considered again, so the result never overlaps.
+    """
+    remaining = list(values)
+    prefixes = []
+    for length in range(min_prefix_len, bits + 1):
+        shift = bits - length
+        size = 1 << shift
+        keep = []
+        start = 0
+        while start < len(remaining):
+            key = remaining[start] >> shift
+            end = start + 1
+            while end < len(remaining) and remaining[end] >> shift == key:
+                end += 1
+            count = end - start
+            if count >= size * min_density and (count > 1 or length == bits):
+                prefixes.append((key << shift, length))
+            else:
+                keep.extend(remaining[start:end])
+            start = end
+        remaining = keep
+        if not remaining:
+            break
+    return prefixes
+
+
+def aggregate_prefixes(ip_set, min_density=1.0, min_prefix_len=24):
+    """Return the aggregated prefixes of an IPSet as "address/length" strings
+
+    min_prefix_len is the broadest IPv4 prefix that may be produced; IPv6 uses the
+    same number of host bits (e.g. /24 for IPv4 allows /120 for IPv6).
+    """
+    min_density = min(1.0, max(min_density, 0.0)) or 1.0
+    prefixes = [
+        f"{ipaddress.IPv4Address(network)}/{length}"
+        for network, length in _aggregate(ip_set.ipv4_integers(), 32, min_density, min_prefix_len)
+    ]
+    prefixes.extend(
+        f"{ipaddress.IPv6Address(network)}/{length}"
+        for network, length in _aggregate(ip_set.ipv6_integers(), 128, min_density, 128 - (32 - min_prefix_len))
+    )
+    return prefixes
+
+
+def host_prefixes(ip_set):
+    """Return one host route per address, as pushed before aggregation existed"""
+    return [f"{ip}/{128 if ':' in ip else 32}" for ip in ip_set]
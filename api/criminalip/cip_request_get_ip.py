@@ -1,157 +1,453 @@
-import requests
-import json
 import logging
-import time
-import csv
-from config import CSV_FILE_PATH, TODAY_CSV_FILE_PATH, LOG_FILE_NAME, BASE_URL, ENDPOINT, HEADERS, date, ip_data
+import re
+import threading
+from collections import namedtuple
+from datetime import date as Date, datetime, time, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from api.http_client import request
+from api.metrics import API_LATENCY, API_REQUESTS, QUERY_MISSED_RESULTS
+from api.criminalip.csv_writer import BufferedCSVWriter
+from api.criminalip.page_cache import CrawlCheckpoint, PageCache, page_key
+from api.criminalip.rate_limiter import TokenBucket
+from api.criminalip.state_store import IPStateStore
+from api.ip_set import IPSet
+from api.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from config import TODAY_CSV_FILE_PATH, BASE_URL, ENDPOINT, HEADERS, current_date, csv_file_path, ip_data, category_ip_data
+from config import CIP_RATE_LIMIT_PER_SECOND, CIP_RATE_LIMIT_BURST, CIP_RATE_LIMIT_BACKOFF_SECONDS, CIP_CRAWL_WORKERS
+from config import CIP_PARTITION_WORKERS, CIP_MIN_PARTITION_SECONDS, CRAWL_CACHE_DIR, CRAWL_CACHE_MAX_BYTES, CRAWL_CACHE_MAX_AGE_SECONDS
+from config import CSV_FLUSH_ROWS, CSV_FLUSH_SECONDS, STATE_DB_PATH, QUERY_CURSORS, CIP_RESULT_TIME_FIELD
+from config import CIP_RETRY_MAX_ATTEMPTS, CIP_RETRY_BUDGET, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS
+from config import CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_SECONDS
 
 
-# Initialize logger
-logging.basicConfig(
-    filename=LOG_FILE_NAME,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)
-
 # Global constants
-MAX_RETRY_COUNT = 70
-RETRY_DELAY_SECONDS = 2
 errcode_list = []
+AFTER_FILTER = re.compile(r"after:\s*(\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2})?)")
+BEFORE_FILTER = re.compile(r"before:\s*(\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2})?)")
+PAGE_SIZE = 10
+MAX_OFFSET = 9900
+# Results of one query that can be reached by paging
+MAX_REACHABLE_RESULTS = MAX_OFFSET + PAGE_SIZE
 
-def handle_exception(err, err_type, retry_func):
-    logging.error(f"{err_type}: {err}")
-    time.sleep(RETRY_DELAY_SECONDS)
-    retry_func()
+PageResults = namedtuple("PageResults", ["newest", "oldest", "stale", "added", "newest_first"])
+
+# Shared between all crawler threads
+rate_limiter = TokenBucket(CIP_RATE_LIMIT_PER_SECOND, CIP_RATE_LIMIT_BURST)
+ip_data_lock = threading.Lock()
+page_cache = PageCache(CRAWL_CACHE_DIR, CRAWL_CACHE_MAX_BYTES, CRAWL_CACHE_MAX_AGE_SECONDS)
+checkpoint = CrawlCheckpoint(f"{CRAWL_CACHE_DIR}/checkpoint.jsonl")
+replayed_pages = []
+cip_retry = RetryPolicy(
+    "Criminal IP search",
+    max_attempts=CIP_RETRY_MAX_ATTEMPTS,
+    base_delay=RETRY_BASE_DELAY_SECONDS,
+    max_delay=RETRY_MAX_DELAY_SECONDS,
+    budget=CIP_RETRY_BUDGET,
+    breaker=CircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_SECONDS),
+)
 
 
 def check_payload(now_query, offset):
     return {"query": now_query, "offset": offset}
 
-def process_query(url, c2_name, payload, COUNT=0):
-    global MAX_RETRY_COUNT
-    if COUNT >= MAX_RETRY_COUNT:
-        logging.error(
-            "Maximum retry count reached. Please check the server for verification."
-        )
-        process_query(url, c2_name, payload, COUNT + 1)
+
+def send_request(url, payload):
+    """Send a rate limited search request, pausing the limiter when the API answers 429"""
+    rate_limiter.acquire()
+    with API_LATENCY.time():
+        response = request("cip", "GET", url, headers=HEADERS, params=payload)
+    API_REQUESTS.inc(status=response.status_code)
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        delay = float(retry_after) if retry_after.isdigit() else CIP_RATE_LIMIT_BACKOFF_SECONDS
+        rate_limiter.pause(delay)
+    return response
+
+
+def fetch_page(url, payload):
+    """Fetch one page of search results, raising on any HTTP or API level error"""
+    response = send_request(url, payload)
+    logging.debug(f"check payload:{payload}, response: {response}")
+    response.raise_for_status()
+
+    data = response.json()
+    assert data["status"] == 200, f"API status {data['status']}"
+    return data
+
+
+def fetch_page_with_retry(url, payload):
+    """Fetch a page through the retry engine; the circuit breaker is keyed by query"""
+    return cip_retry.call(lambda: fetch_page(url, payload), key=payload["query"])
+
+
+def fetch_query_page(url, payload):
+    """Fetch one page of results through the retry engine
+
+    Pages checkpointed by an unfinished earlier crawl are replayed from the
+    page cache; fetched pages are cached and checkpointed. Returns None when
+    the page could not be fetched, either because the retries ran out or
+    because the circuit breaker for the query is open.
+    """
+    query, offset = payload["query"], payload["offset"]
+    key = page_key(url, query, offset)
+    if checkpoint.is_done(query, offset):
+        data = page_cache.get(key)
+        if data is not None:
+            replayed_pages.append(key)
+            return data
+
     try:
-        response2_json = requests.request("GET", url, headers=HEADERS, params=payload)
-        logging.info(f"check payload:{payload}, response2_json: {response2_json}")
-        response2_json.raise_for_status()
-
-        data = response2_json.json()
-        logging.info(f"now status:{data['status']}")
-        assert data["status"] == 200
-        result = data["data"]["result"]
-
-        for item in result:
-            ip_address = item["ip_address"]
-            logging.info([str(date), ip_address])
-
-            if ip_address not in ip_data:
-                with open(CSV_FILE_PATH, "a", newline="") as file:
-                    writer = csv.writer(file)
-                    if not ip_data:
-                        writer.writerow(["Date", "IP Address"])
-
-                    writer.writerow([str(date), ip_address])
-
-                ip_data.add(ip_address)
-
-        logging.info(f"Number of deduplicated IPs: {len(ip_data)}")
-
-    except json.JSONDecodeError as json_err:
-        handle_exception(
-            json_err,
-            "JSONDecodeError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
-        )
-    except requests.exceptions.HTTPError as err:
-        handle_exception(
-            err, "HTTPError", lambda: process_query(url, c2_name, payload, COUNT + 1)
-        )
-    except requests.exceptions.ChunkedEncodingError as chunked_err:
-        handle_exception(
-            chunked_err,
-            "ChunkedEncodingError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
-        )
-    except requests.exceptions.ConnectionError as connect_err:
-        handle_exception(
-            connect_err,
-            "ConnectionError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
-        )
-    except requests.exceptions.RequestException as e:
-        handle_exception(
-            e,
-            "RequestException",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
-        )
-    except AssertionError as err:
-        handle_exception(
-            err,
-            "AssertionError",
-            lambda: process_query(url, c2_name, payload, COUNT + 1),
-        )
+        data = fetch_page_with_retry(url, payload)
+    except CircuitOpenError as err:
+        logging.error(f"Skipping {payload}: {err}")
+        return None
     except Exception as err:
-        handle_exception(
-            err, "Exception", lambda: process_query(url, c2_name, payload, COUNT + 1)
-        )
+        logging.error(f"Giving up on {payload}: {type(err).__name__}: {err}")
+        return None
 
+    page_cache.put(key, data)
+    checkpoint.mark(query, offset)
+    return data
 
-def process_ioc(c2_name, query_list):
-    global errcode_list, RETRY_DELAY_SECONDS
-    for now_query in query_list:
-        offset = 0
-        while True:
-            logging.info(f"Processing target C2: {c2_name}, Using query: {now_query}")
 
-            payload = check_payload(now_query, offset)
-            time.sleep(RETRY_DELAY_SECONDS)
+def record_results(c2_name, data, writer, watermark=None):
+    """Record the new IPs of one page of results
+
+    Results whose time is at or below watermark were ingested by an earlier run
+    and are skipped. Returns PageResults with the newest and oldest result time
+    on the page, whether every result on it was already ingested, how many new
+    IPs it added and whether its results are ordered newest first.
+    """
+    newest = oldest = None
+    newest_first = True
+    stale = bool(watermark)
+    date = current_date()
+    results = data["data"]["result"]
+    added = 0
+    skipped = 0
+    for item in results:
+        ip_address = item["ip_address"]
+        result_time = item.get(CIP_RESULT_TIME_FIELD)
+        if result_time:
+            if oldest is not None and result_time > oldest:
+                newest_first = False
+            if newest is None or result_time > newest:
+                newest = result_time
+            if oldest is None or result_time < oldest:
+                oldest = result_time
+        if watermark and result_time and result_time <= watermark:
+            skipped += 1
+            continue
+        stale = False
 
+        with ip_data_lock:
             try:
-                response = requests.get(BASE_URL+ENDPOINT, headers=HEADERS, params=payload)
-                logging.info(
-                    "check query %s/ check offset %d / Current server status response: %s",
-                    now_query,
-                    offset,
-                    response,
+                is_new = category_ip_data.setdefault(c2_name, IPSet()).add(ip_address)
+            except ValueError:
+                logging.warning(f"Ignoring invalid IP address {ip_address!r} from {c2_name}")
+                continue
+            if is_new:
+                writer.writerow([str(date), ip_address, c2_name])
+                added += ip_data.add(ip_address)
+
+    logging.debug(
+        f"Page of {c2_name}: {len(results)} results, {added} new IPs, {skipped} already ingested",
+        extra={"c2_name": c2_name, "results": len(results), "new_ips": added, "skipped": skipped},
+    )
+    return PageResults(newest, oldest, stale, added, newest_first)
+
+
+def newer(first, second):
+    """Return the later of two result times, either of which may be None"""
+    if first is None or (second is not None and second > first):
+        return second
+    return first
+
+
+def cursor_key(query):
+    """Key a query by its text without the date of its after: filter"""
+    return AFTER_FILTER.sub("after: *", query).strip()
+
+
+def cursor_query(query, watermark):
+    """Move the after: filter of query to the day of watermark"""
+    if not watermark:
+        return query
+    return AFTER_FILTER.sub(f"after: {watermark[:10]}", query)
+
+
+def process_query(url, c2_name, payload, writer):
+    """Fetch one page of results and record the new IPs, returns False if the page was lost"""
+    data = fetch_query_page(url, payload)
+    if data is None:
+        return False
+    record_results(c2_name, data, writer)
+    return True
+
+
+def page_offsets(result_count):
+    """Offsets of the pages after the first one, capped at the API's maximum offset"""
+    offsets = []
+    for count in range(1, int(result_count / PAGE_SIZE) + 1):
+        offset = count * PAGE_SIZE
+        if offset > MAX_OFFSET:
+            logging.error(
+                "Reached maximum offset value and attempting to output the next query."
+            )
+            break
+        offsets.append(offset)
+    return offsets
+
+
+def filter_time(moment):
+    """Format moment for an after:/before: filter, as a plain date at midnight"""
+    if moment.time() == time():
+        return moment.date().isoformat()
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def split_query(query, min_window=CIP_MIN_PARTITION_SECONDS):
+    """Split the after:/before: window of query into two halves
+
+    A query without before: runs up to tomorrow. The halves are cut at a
+    multiple of min_window seconds from the start. Returns None if the query
+    has no after: filter or its window is shorter than two min_windows.
+    """
+    after = AFTER_FILTER.search(query)
+    if after is None:
+        return None
+    before = BEFORE_FILTER.search(query)
+    start = datetime.fromisoformat(after.group(1))
+    end = datetime.fromisoformat(before.group(1)) if before else datetime.combine(Date.today() + timedelta(days=1), time())
+    windows = int((end - start).total_seconds() // min_window)
+    if windows < 2:
+        return None
+
+    middle = start + timedelta(seconds=windows // 2 * min_window)
+    base = BEFORE_FILTER.sub("", query).strip()
+    return [
+        f"{AFTER_FILTER.sub(f'after: {filter_time(first)}', base)} before: {filter_time(second)}"
+        for first, second in ((start, middle), (middle, end))
+    ]
+
+
+def plan_partitions(now_query, data):
+    """Split a query over the offset cap into date windows that each stay below it
+
+    Every window costs one request for its first page, which also tells its
+    result count. A window whose halves together report more results than it
+    holds, as when the API ignores the time of a filter, is kept whole.
+    Returns the (query, first page) pairs to crawl and whether every window
+    could be read.
+    """
+    partitions = []
+    complete = True
+    pending = [(now_query, data)]
+    while pending:
+        query, page = pending.pop()
+        count = page["data"]["count"]
+        if count <= MAX_REACHABLE_RESULTS:
+            partitions.append((query, page))
+            continue
+        halves = split_query(query)
+        if not halves:
+            if query != now_query:
+                logging.warning(f"Date window {query} has {count} results and cannot be split further, {count - MAX_REACHABLE_RESULTS} results are out of reach")
+            partitions.append((query, page))
+            continue
+
+        half_pages = []
+        for half in halves:
+            half_page = fetch_query_page(BASE_URL+ENDPOINT, check_payload(half, 0))
+            if half_page is None:
+                logging.error(f"Could not read result count for partition {half}")
+                complete = False
+                continue
+            half_pages.append((half, half_page))
+        if sum(half_page["data"]["count"] for _, half_page in half_pages) > count:
+            logging.warning(f"Splitting {query} did not narrow its results, {count - MAX_REACHABLE_RESULTS} results are out of reach")
+            partitions.append((query, page))
+            continue
+        pending.extend(half_pages)
+    return partitions, complete
+
+
+def crawl_pages(c2_name, now_query, data, writer, watermark=None):
+    """Crawl the remaining pages of a query whose first page is data
+
+    Returns the newest result time seen and whether no page was lost.
+    """
+    offsets = page_offsets(data["data"]["count"])
+    newest, complete, pages, added = crawl_offsets(c2_name, now_query, data, writer, watermark, offsets)
+    logging.info(
+        f"Crawled {pages} of {len(offsets) + 1} pages of {now_query}: {added} new IPs, {len(ip_data)} unique IPs so far",
+        extra={"c2_name": c2_name, "query": now_query, "pages": pages, "new_ips": added, "complete": complete},
+    )
+    return newest, complete
+
+
+def crawl_offsets(c2_name, now_query, data, writer, watermark, offsets):
+    """Record the first page and fetch the pages at offsets, returns (newest, complete, pages, new IPs)
+
+    With a watermark the crawl stops at the first page that holds only results
+    up to it. That relies on the API serving results newest first, so once a
+    page is out of that order the stale results are skipped and every page is
+    crawled.
+    """
+    # The first page already holds results, the remaining pages are prefetched
+    # one ahead so the next request is in flight while the current one is parsed.
+    page = record_results(c2_name, data, writer, watermark)
+    newest, added, oldest = page.newest, page.added, page.oldest
+    newest_first = page.newest_first
+    if watermark and not newest_first:
+        logging.warning(f"Results of {now_query} are not ordered newest first, crawling every page past the watermark")
+    complete = True
+    pages = 1
+    if not offsets or (page.stale and newest_first):
+        return newest, complete, pages, added
+
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(fetch_query_page, BASE_URL+ENDPOINT, check_payload(now_query, offsets[0]))
+        for index in range(len(offsets)):
+            data = pending.result()
+            if data is None and cip_retry.breaker.is_open(now_query):
+                logging.error(f"Circuit open for {now_query}, skipping its remaining pages")
+                complete = False
+                break
+
+            # A page fetched past the point where the watermark stops the crawl is discarded
+            if index + 1 < len(offsets):
+                pending = prefetcher.submit(fetch_query_page, BASE_URL+ENDPOINT, check_payload(now_query, offsets[index + 1]))
+
+            if data is None:
+                complete = False
+                continue
+            page = record_results(c2_name, data, writer, watermark)
+            newest = newer(newest, page.newest)
+            pages += 1
+            added += page.added
+            if watermark and newest_first and not (page.newest_first and (oldest is None or page.newest is None or page.newest <= oldest)):
+                logging.warning(f"Results of {now_query} are not ordered newest first, crawling every page past the watermark")
+                newest_first = False
+            oldest = page.oldest or oldest
+            if page.stale and newest_first:
+                logging.info(f"Reached results ingested by an earlier run for {now_query}, skipping {len(offsets) - index - 1} pages")
+                pending.cancel()
+                break
+    return newest, complete, pages, added
+
+
+def process_ioc(c2_name, query_list, writer, watermark=None):
+    """Crawl every page of the queries, stopping at the first page that holds only results up to watermark
+
+    Pages are expected newest first; see crawl_offsets.
+
+    Queries with more results than paging can reach are split into date
+    windows that are crawled in parallel. Returns the newest result time seen
+    (watermark if nothing newer was found), or None if a page was lost and the
+    results may be incomplete.
+    """
+    newest = watermark
+    complete = True
+    for now_query in query_list:
+        logging.info(f"Processing target C2: {c2_name}, Using query: {now_query}")
+
+        data = fetch_query_page(BASE_URL+ENDPOINT, check_payload(now_query, 0))
+        if data is None:
+            logging.error(f"Could not read result count for {now_query}, moving on")
+            complete = False
+            continue
+
+        total = data["data"]["count"]
+        logging.info("result total_count: %d", total)
+        partitions = [(now_query, data)]
+        if total > MAX_REACHABLE_RESULTS:
+            partitions, planned = plan_partitions(now_query, data)
+            complete = complete and planned
+            counts = [page["data"]["count"] for _, page in partitions]
+            reachable = sum(min(count, MAX_REACHABLE_RESULTS) for count in counts)
+            missed = max(0, total - reachable)
+            if len(partitions) == 1:
+                logging.error(f"{now_query} has {total} results and no date window to split, {missed} results are out of reach")
+            else:
+                logging.log(
+                    logging.WARNING if missed else logging.INFO,
+                    f"Split {now_query} ({total} results) into {len(partitions)} date windows covering "
+                    f"{reachable} results ({reachable / total:.1%}), {missed} results still out of reach"
                 )
-                response.raise_for_status()
-                data = response.json()
-
-                assert data["status"] == 200
-                logging.info("result total_count: %d", data["data"]["count"])
-
-                total_count = int(data["data"]["count"] / 10) + 1
-                logging.info("count: %d", total_count)
-
-                for count in range(total_count):
-                    offset = count * 10
-
-                    if offset > 9900:
-                        logging.error(
-                            "Reached maximum offset value and attempting to output the next query."
-                        )
-                        break
-                    payload = check_payload(now_query, offset)
-                    time.sleep(RETRY_DELAY_SECONDS)
-                    process_query(BASE_URL+ENDPOINT, c2_name, payload)
-
-            except json.JSONDecodeError as json_err:
-                handle_exception(json_err, "JSONDecodeError", lambda: None)
-            except requests.exceptions.HTTPError as err:
-                handle_exception(err, "HTTPError", lambda: None)
-            except requests.exceptions.ChunkedEncodingError as chunked_err:
-                handle_exception(chunked_err, "ChunkedEncodingError", lambda: None)
-            except requests.exceptions.ConnectionError as connect_err:
-                handle_exception(connect_err, "ConnectionError", lambda: None)
-            except requests.exceptions.RequestException as e:
-                handle_exception(e, "RequestException", lambda: None)
-            except AssertionError as err:
-                handle_exception(err, "AssertionError", lambda: None)
+            QUERY_MISSED_RESULTS.set(missed, query=c2_name)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(CIP_PARTITION_WORKERS, len(partitions)))) as executor:
+            futures = [
+                executor.submit(crawl_pages, c2_name, query, page, writer, watermark)
+                for query, page in partitions
+            ]
+            for future in futures:
+                page_newest, page_complete = future.result()
+                newest = newer(newest, page_newest)
+                complete = complete and page_complete
+
+    return newest if complete else None
+
+
+def crawl_queries(queries):
+    """Crawl every query concurrently, sharing one rate limiter between the workers
+
+    With QUERY_CURSORS each query starts from the newest result time recorded
+    for it by earlier runs, and the cursors are advanced once the crawl output
+    is safely on disk. Queries that lost pages keep their old cursor. A crawl
+    that died partway through is resumed by replaying its checkpointed pages.
+    """
+    cursors = load_query_cursors() if QUERY_CURSORS else {}
+    resumed = checkpoint.load()
+    if resumed:
+        logging.info(f"Resuming an unfinished crawl, {resumed} pages are checkpointed")
+    tasks = []
+    for c2_name, query_list in queries.items():
+        for now_query in query_list:
+            key = (c2_name, cursor_key(now_query))
+            tasks.append((c2_name, cursor_query(now_query, cursors.get(key)), key))
+
+    logging.info(f"Crawling {len(tasks)} queries with {CIP_CRAWL_WORKERS} workers, {len(cursors)} have a cursor")
+    advanced = {}
+    writer = BufferedCSVWriter(csv_file_path(), ["Date", "IP Address", "Category"], CSV_FLUSH_ROWS, CSV_FLUSH_SECONDS)
+    with writer, ThreadPoolExecutor(max_workers=CIP_CRAWL_WORKERS) as executor:
+        futures = {
+            executor.submit(process_ioc, c2_name, [now_query], writer, cursors.get(key)): (now_query, key)
+            for c2_name, now_query, key in tasks
+        }
+        for future in as_completed(futures):
+            now_query, key = futures[future]
+            try:
+                newest = future.result()
             except Exception as err:
-                handle_exception(err, "Exception", lambda: None)
-            else:
-                break
\ No newline at end of file
+                logging.error(f"Crawling query {now_query} failed: {err}")
+                continue
+            if newest and newest != cursors.get(key):
+                advanced[key] = newest
+
+    if QUERY_CURSORS and advanced:
+        save_query_cursors(advanced)
+    if replayed_pages:
+        logging.info(f"Replayed {len(replayed_pages)} pages from the crawl cache")
+    replayed_pages.clear()
+    checkpoint.clear()
+
+
+def load_query_cursors():
+    """Read the per-query cursors from the state store"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        return store.query_cursors()
+    finally:
+        store.close()
+
+
+def save_query_cursors(cursors):
+    """Advance the per-query cursors in the state store"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        store.save_query_cursors(cursors, datetime.now().isoformat(timespec="seconds"))
+    finally:
+        store.close()
+    logging.info(f"Advanced the cursors of {len(cursors)} queries")
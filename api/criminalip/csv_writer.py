@@ -0,0 +1,87 @@
+"""
+Buffered CSV Writer
+
+Keeps the crawl output file open for the whole run. Rows are buffered in memory
+and flushed when either the row or the time threshold is reached. Everything is
+written to a temporary file that is fsynced and atomically renamed over the
+target on close, so a crash never leaves a half-written daily file behind.
+"""
+import csv
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+class BufferedCSVWriter:
+    def __init__(self, path, header, flush_rows=1000, flush_seconds=5.0):
+        self.path = path
+        self.temp_path = f"{path}.part"
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.rows = []
+        self.rows_written = 0
+        self.file = None
+        self.writer = None
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            # Continue the existing daily file (e.g. a second run on the same day)
+            shutil.copyfile(self.path, self.temp_path)
+            self.file = open(self.temp_path, "a", newline="")
+            self.writer = csv.writer(self.file)
+        else:
+            self.file = open(self.temp_path, "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.header)
+        self.last_flush = time.monotonic()
+        return self
+
+    def writerow(self, row):
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        if self.rows:
+            self.writer.writerows(self.rows)
+            self.rows_written += len(self.rows)
+            self.rows = []
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """Flush the remaining rows, fsync and move the file into place"""
+        with self.lock:
+            if self.file is None:
+                return
+            self._flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            os.replace(self.temp_path, self.path)
+            directory = os.open(os.path.dirname(self.path) or ".", os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+        logging.info(f"Wrote {self.rows_written} rows to {self.path}")
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            # Leave the previous daily file untouched and drop the partial one
+            self.file.close()
+            self.file = None
+            os.remove(self.temp_path)
+        return False
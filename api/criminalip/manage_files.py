@@ -3,7 +3,22 @@ import json
 import logging
 import os
 from datetime import datetime
-from config import OUTPUT_FILE_PATH, SEVEN_DAYS_AGO, yesterday_date, PREVIOUS_CSV_FILE_PATH, TODAY_CSV_FILE_PATH, CSV_FILE_PATH
+from api.criminalip.state_store import MAX_TAG_BITS, IPStateStore
+from api.allowlist import load_allowlist
+from api.category_groups import build_groups, group_categories, group_mask
+from api.cidr import aggregate_prefixes, host_prefixes
+from api.ip_set import IPSet
+from api.metrics import ALLOWLISTED_IPS, BLOCKLIST_IPS
+from config import yesterday_date, PREVIOUS_CSV_FILE_PATH, TODAY_CSV_FILE_PATH, STATE_DB_PATH, output_file_path
+from config import csv_file_path as crawl_csv_file_path
+from config import DEFAULT_CATEGORY, DEFAULT_TTL_DAYS, CATEGORY_TTL_DAYS
+from config import AGGREGATE_PREFIXES, AGGREGATE_MIN_DENSITY, AGGREGATE_MIN_PREFIX_LEN
+from config import DEVICES, ALLOWLIST_FILES, CATEGORY_GROUPS, QUERY_FILE_NAME
+
+# Push history recorded before devices were listed belongs to the first device
+DEFAULT_DEVICE = DEVICES[0]["name"] if DEVICES else None
+
+_allowlist = None
 
 class QueryData:
     def __init__(self, data):
@@ -13,182 +28,275 @@ class QueryData:
     def from_file(cls, query_file_name):
         with open(query_file_name, "r") as query_file:
             data = json.load(query_file)
+            if len(data["data"]) > MAX_TAG_BITS:
+                raise ValueError(
+                    f"{query_file_name} has {len(data['data'])} queries, the category bitmask holds at most {MAX_TAG_BITS}"
+                )
             for key, value in data["data"].items():
                 data["data"][key] = [
-                    item.replace("{% now_date %}", yesterday_date) for item in value
+                    item.replace("{% now_date %}", yesterday_date()) for item in value
                 ]
         return cls(data["data"])
 
 
-def merge_and_update_ip_addresses():
-    """Read CSVs of Malicious IPs and Updates Them"""
-    if not os.path.exists(PREVIOUS_CSV_FILE_PATH) and not os.path.exists(TODAY_CSV_FILE_PATH):
-        os.makedirs(os.path.dirname(TODAY_CSV_FILE_PATH), exist_ok=True)
-        rows_to_write = [['Date', 'IP Address']]
-        new_ip_addresses = set()
-        
-        if os.path.exists(CSV_FILE_PATH):
-            try:
-                with open(CSV_FILE_PATH, 'r', newline='') as file:
-                    reader = csv.reader(file)
-                    headers = next(reader, None)
-                    
-                    for row in reader:
-                        if len(row) >= 2:
-                            rows_to_write.append([row[0], row[1]])
-                            new_ip_addresses.add(row[1])
-                
-                logging.info(f"Read {len(rows_to_write)-1} entries from {CSV_FILE_PATH}")
-            except Exception as e:
-                logging.error(f"Error reading {CSV_FILE_PATH}: {str(e)}")
-        else:
-            logging.warning(f"Both {PREVIOUS_CSV_FILE_PATH} and {CSV_FILE_PATH} don't exist.")
-        
-        with open(TODAY_CSV_FILE_PATH, 'w', newline='') as today_file:
-            writer = csv.writer(today_file)
-            writer.writerows(rows_to_write)
-        
-        logging.info(f"Created {TODAY_CSV_FILE_PATH} with {len(rows_to_write)-1} entries")
-        
-        return new_ip_addresses, None
-    elif not os.path.exists(PREVIOUS_CSV_FILE_PATH) and os.path.exists(TODAY_CSV_FILE_PATH):
-        rows_to_copy = []
-        with open(TODAY_CSV_FILE_PATH, 'r', newline='') as today_file:
-            reader = csv.reader(today_file)
-            headers = next(reader, None)
-            rows_to_copy.append(['Date', 'IP Address'])
-            
-            for row in reader:
-                if len(row) >= 2:
-                    rows_to_copy.append([row[0], row[1]])
-        
-        # Write to previous file
-        with open(PREVIOUS_CSV_FILE_PATH, 'w', newline='') as prev_file:
-            writer = csv.writer(prev_file)
-            writer.writerows(rows_to_copy)
-        
-        # Now filter out data older than 7 days from today's file
-        filtered_rows = [['Date', 'IP Address']]
-        filtered_ips = set()
-        delete_ips = set()
-        
-        with open(TODAY_CSV_FILE_PATH, 'r', newline='') as today_file:
-            reader = csv.reader(today_file)
-            headers = next(reader, None)
-            
-            for row in reader:
-                if len(row) >= 2:
-                    date_str = row[0]
-                    ip = row[1]
-                    
-                    try:
-                        entry_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        if entry_date >= SEVEN_DAYS_AGO:
-                            filtered_rows.append([date_str, ip])
-                            filtered_ips.add(ip)
-                        else:
-                            delete_ips.add(ip)
-                    except ValueError:
-                        logging.warning(f"Invalid date format in row: {row}")
-        
-        logging.info(f"Filtered data to {len(filtered_rows)-1} entries (removing entries older than 7 days)")
-        new_ip_addresses = set()
-        if os.path.exists(CSV_FILE_PATH):
-            with open(CSV_FILE_PATH, 'r', newline='') as csv_file:
-                reader = csv.reader(csv_file)
-                headers = next(reader, None)
-                today_date = datetime.now().strftime("%Y-%m-%d")
-                
-                for row in reader:
-                    if len(row) >= 2:
-                        ip = row[1]
-                        if ip not in filtered_ips:  # Check against filtered IPs
-                            new_ip_addresses.add(ip)
-                            filtered_rows.append([today_date, ip])
-        
-            logging.info(f"Found {len(new_ip_addresses)} new unique IP addresses from {CSV_FILE_PATH}")
-        
-        # Write the combined filtered data and new data back to today's file
-        with open(TODAY_CSV_FILE_PATH, 'w', newline='') as today_file:
-            writer = csv.writer(today_file)
-            writer.writerows(filtered_rows)
-        
-        logging.info(f"Updated {TODAY_CSV_FILE_PATH} with {len(filtered_rows)-1} entries")
-
-        return new_ip_addresses, delete_ips
-    elif os.path.exists(PREVIOUS_CSV_FILE_PATH) and os.path.exists(TODAY_CSV_FILE_PATH):
-        rows_to_copy = []
-        with open(TODAY_CSV_FILE_PATH, 'r', newline='') as today_file:
-            reader = csv.reader(today_file)
-            headers = next(reader, None)
-            rows_to_copy.append(['Date', 'IP Address'])
-            
-            for row in reader:
-                if len(row) >= 2:
-                    rows_to_copy.append([row[0], row[1]])
-        
-        # Write to previous file
-        with open(PREVIOUS_CSV_FILE_PATH, 'w', newline='') as prev_file:
-            writer = csv.writer(prev_file)
-            writer.writerows(rows_to_copy)
-        
-        # Now filter out data older than 7 days from today's file
-        filtered_rows = [['Date', 'IP Address']]
-        filtered_ips = set()
-        delete_ips = set()
-        
-        with open(TODAY_CSV_FILE_PATH, 'r', newline='') as today_file:
-            reader = csv.reader(today_file)
+def read_crawled_ip_addresses(csv_file_path=None):
+    """Read the IPs collected by today's crawl, grouped by the category they were found under"""
+    csv_file_path = csv_file_path or crawl_csv_file_path()
+    ip_addresses = {}
+    if not os.path.exists(csv_file_path):
+        logging.warning(f"{csv_file_path} doesn't exist.")
+        return ip_addresses
+
+    try:
+        with open(csv_file_path, 'r', newline='') as file:
+            reader = csv.reader(file)
             headers = next(reader, None)
-            
+
             for row in reader:
                 if len(row) >= 2:
-                    date_str = row[0]
-                    ip = row[1]
-                    
+                    category = row[2] if len(row) >= 3 and row[2] else DEFAULT_CATEGORY
                     try:
-                        entry_date = datetime.strptime(date_str, "%Y-%m-%d")
-                        if entry_date >= SEVEN_DAYS_AGO:
-                            filtered_rows.append([date_str, ip])
-                            filtered_ips.add(ip)
-                        else:
-                            delete_ips.add(ip)
+                        ip_addresses.setdefault(category, IPSet()).add(row[1])
                     except ValueError:
-                        logging.warning(f"Invalid date format in row: {row}")
-        
-        logging.info(f"Filtered data to {len(filtered_rows)-1} entries (removing entries older than 7 days)")
-        
-        # Process new data from CSV_FILE_PATH if it exists
-        new_ip_addresses = set()
-        if os.path.exists(CSV_FILE_PATH):
-            with open(CSV_FILE_PATH, 'r', newline='') as csv_file:
-                reader = csv.reader(csv_file)
-                headers = next(reader, None)
-                
-                today_date = datetime.now().strftime("%Y-%m-%d")
-                
-                for row in reader:
-                    if len(row) >= 2:
-                        ip = row[1]
-                        if ip not in filtered_ips:  # Check against filtered IPs
-                            new_ip_addresses.add(ip)
-                            filtered_rows.append([today_date, ip])
-        
-            logging.info(f"Found {len(new_ip_addresses)} new unique IP addresses from {CSV_FILE_PATH}")
-        
-        # Write the combined filtered data and new data back to today's file
-        with open(TODAY_CSV_FILE_PATH, 'w', newline='') as today_file:
-            writer = csv.writer(today_file)
-            writer.writerows(filtered_rows)
-        
-        logging.info(f"Updated {TODAY_CSV_FILE_PATH} with {len(filtered_rows)-1} entries")
-
-        return new_ip_addresses, delete_ips
- 
-    
+                        logging.warning(f"Invalid IP address in row: {row}")
+        logging.info(f"Read {sum(len(ips) for ips in ip_addresses.values())} entries from {csv_file_path}")
+    except Exception as e:
+        logging.error(f"Error reading {csv_file_path}: {str(e)}")
+    return ip_addresses
+
+
+def ttl_days(category):
+    """Number of days an IP of the given category stays blocked after it was last seen"""
+    return CATEGORY_TTL_DAYS.get(category, DEFAULT_TTL_DAYS)
+
+
+def configured_categories():
+    """Query names and grouped categories in use, None if the query file cannot be read"""
+    try:
+        queries = QueryData.from_file(QUERY_FILE_NAME).data
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Could not read the categories from {QUERY_FILE_NAME}: {str(e)}")
+        return None
+    return set(queries) | set(group_categories(CATEGORY_GROUPS)) | {DEFAULT_CATEGORY}
+
+
+def current_allowlist():
+    """The allowlist, reloaded when one of its files changed since the last run"""
+    global _allowlist
+    if _allowlist is None or _allowlist.is_stale(ALLOWLIST_FILES):
+        _allowlist = load_allowlist(ALLOWLIST_FILES)
+    return _allowlist
+
+
+def merge_and_update_ip_addresses():
+    """Merge today's crawl into the IP state store
+
+    Returns the new and expired IPs and the stored IPs that gained a category.
+    """
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        imported = store.import_csv_history(TODAY_CSV_FILE_PATH, PREVIOUS_CSV_FILE_PATH)
+        if imported:
+            logging.info(f"Imported {imported} IPs from the CSV history into {STATE_DB_PATH}")
+
+        allowlist = current_allowlist()
+        hits = {}
+        crawled = {
+            category: allowlist.filter(ip_addresses, hits) for category, ip_addresses in read_crawled_ip_addresses().items()
+        }
+        # The whole day's crawl is merged again on every run, so hits are a gauge, not a running count
+        for source in sorted(allowlist.sources):
+            ALLOWLISTED_IPS.set(len(hits.get(source, ())), source=source)
+            if hits.get(source):
+                logging.info(f"Allowlist {source} kept {len(hits[source])} crawled IPs from being blocked")
+        result = store.merge(crawled, datetime.now().date(), ttl_days, configured_categories())
+        tracked = store.count()
+        logging.info(
+            f"Found {len(result.new)} new and {len(result.expired)} expired IP addresses, "
+            f"{tracked} IPs are now tracked"
+        )
+        logging.info(
+            f"Refreshed the TTL of {result.refreshed} IPs seen again, avoiding "
+            f"{result.expiries_avoided} deletes and {result.expiries_avoided} re-adds on the device"
+        )
+        BLOCKLIST_IPS.set(len(result.new), state="new")
+        BLOCKLIST_IPS.set(len(result.expired), state="expired")
+        BLOCKLIST_IPS.set(tracked - len(result.new), state="unchanged")
+        BLOCKLIST_IPS.set(result.refreshed, state="refreshed")
+        return result.new, result.expired, result.recategorized
+    finally:
+        store.close()
+
+
+def active_ip_addresses():
+    """Every IP currently on the blocklist"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        return store.active_ip_addresses()
+    finally:
+        store.close()
+
+
+def category_groups(default_set, default_policy):
+    """The configured category groups, with their category and group bits assigned in the state store
+
+    Groups removed from CATEGORY_GROUPS are kept without categories, so the
+    next push empties and deletes their address sets and policies.
+    """
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        category_bits = store.tag_bits("category", group_categories(CATEGORY_GROUPS), keep=configured_categories())
+        group_bits = store.tag_bits("group", list(CATEGORY_GROUPS), first_bit=1)
+        group_config = dict(CATEGORY_GROUPS)
+        for name in group_bits:
+            saved = store.get_meta(f"group:{name}")
+            if name not in group_config and saved:
+                group_config[name] = dict(json.loads(saved), categories=[])
+        groups = build_groups(group_config, category_bits, group_bits, default_set, default_policy)
+        with store.connection:
+            for group in groups[1:]:
+                if group.name in CATEGORY_GROUPS:
+                    settings = {"address_set": group.address_set, "policy": group.policy, "action": group.action}
+                    store.set_meta(f"group:{group.name}", json.dumps(settings))
+    finally:
+        store.close()
+    return groups
+
+
+def _split_by_group(rows, groups, active=None):
+    members = {group.bit: [] for group in groups}
+    masks = {}
+    for ip, categories in rows:
+        if active is not None and ip not in active:
+            continue
+        mask = masks.get(categories)
+        if mask is None:
+            mask = masks[categories] = group_mask(categories, groups)
+        for bit, ips in members.items():
+            if mask >> bit & 1:
+                ips.append(ip)
+    return {bit: IPSet(ips) for bit, ips in members.items()}
+
+
+def group_members(active, groups):
+    """Split the active IPs into one IPSet per group bit by their category masks"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        return _split_by_group(store.category_masks(), groups, active)
+    finally:
+        store.close()
+
+
+def update_group_members(members, groups, changed, removed):
+    """Apply a merge to members from group_members, reading the masks of the changed IPs only
+
+    changed holds the new IPs and the IPs that gained a category, removed the
+    expired ones.
+    """
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        moved = _split_by_group(store.category_masks(changed), groups)
+    finally:
+        store.close()
+    stale = changed.union(removed)
+    return {bit: ip_set.difference(stale).union(moved[bit]) for bit, ip_set in members.items()}
+
+
+def desired_prefixes(active=None, groups=None, members=None):
+    """Prefixes the device should hold for the active blocklist
+
+    Returns a dict mapping each prefix to the bitmask of the category groups
+    whose address sets should list it; without groups every prefix is in the
+    default group (bit 0). Each group is aggregated on its own. members may
+    hold the IPs of each group kept in memory from an earlier run.
+    """
+    if active is None:
+        active = active_ip_addresses()
+    # Also drops IPs stored before their range was allowlisted
+    allowlist = current_allowlist()
+    active = allowlist.filter(active)
+    if not groups or len(groups) < 2:
+        members = {0: active}
+    elif members is None:
+        members = group_members(active, groups)
+    else:
+        members = {bit: ip_set.intersection(active) for bit, ip_set in members.items()}
+
+    desired = {}
+    for bit, ip_set in members.items():
+        if AGGREGATE_PREFIXES:
+            prefixes = set(aggregate_prefixes(ip_set, AGGREGATE_MIN_DENSITY, AGGREGATE_MIN_PREFIX_LEN))
+            prefixes = allowlist.split_overlapping(prefixes, ip_set)
+        else:
+            prefixes = host_prefixes(ip_set)
+        for prefix in prefixes:
+            desired[prefix] = desired.get(prefix, 0) | 1 << bit
+    if len(members) > 1:
+        names = {group.bit: group.name for group in groups}
+        logging.info("IPs per category group: " + ", ".join(f"{names[bit]} {len(ip_set)}" for bit, ip_set in members.items()))
+    logging.info(
+        f"Aggregated {len(active)} blocked IPs into {len(desired)} address objects "
+        f"({len(active) - len(desired)} fewer objects)"
+    )
+    return desired
+
+
+def has_push_history(device=DEFAULT_DEVICE):
+    """Return True if the prefixes on device are known from an earlier push"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        if device == DEFAULT_DEVICE:
+            store.claim_legacy_prefixes(device)
+        return store.pushed_prefixes(device) is not None
+    finally:
+        store.close()
+
+
+def plan_prefix_changes(new_ip_addresses, delete_ip_addresses, device=DEFAULT_DEVICE, desired=None, default_set=None):
+    """Aggregate the blocklist and diff it against the prefixes already on device
+
+    Returns the prefixes to add, the prefixes to delete, the prefixes currently
+    on device mapped to their group bitmasks and the shard count of each group
+    set they were pushed with. Pass desired to reuse a blocklist aggregated
+    once for several devices; default_set names the deny set that push
+    history recorded before category groups refers to.
+    """
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        active = store.active_ip_addresses() if desired is None else None
+        if desired is None:
+            desired = desired_prefixes(active)
+
+        if device == DEFAULT_DEVICE:
+            store.claim_legacy_prefixes(device)
+        pushed = store.pushed_prefixes(device)
+        if pushed is None and device == DEFAULT_DEVICE:
+            # Before prefixes were recorded every active IP was pushed as a host route
+            if active is None:
+                active = store.active_ip_addresses()
+            previous = active.difference(IPSet(new_ip_addresses or ())).union(IPSet(delete_ip_addresses or ()))
+            pushed = dict.fromkeys(host_prefixes(previous), 1)
+        elif pushed is None:
+            pushed = {}
+        shard_counts = store.pushed_shard_counts(device, default_set)
+        return desired.keys() - pushed.keys(), pushed.keys() - desired.keys(), pushed, shard_counts
+    finally:
+        store.close()
+
+
+def save_pushed_prefixes(prefixes, shard_counts=None, device=DEFAULT_DEVICE):
+    """Remember which prefixes are present on device, their group bitmasks and the shard counts of the group sets"""
+    store = IPStateStore(STATE_DB_PATH)
+    try:
+        store.save_pushed_prefixes(device, prefixes, shard_counts)
+    finally:
+        store.close()
+
+
 def output_result(new_ip_addresses):
     """Output the final record of today's malicious IPs"""
-    if new_ip_addresses and not os.path.exists(OUTPUT_FILE_PATH):
+    output_path = output_file_path()
+    if new_ip_addresses and not os.path.exists(output_path):
         rows_to_write = [['Date', 'IP Address']]
 
         today_date = datetime.now().strftime("%Y-%m-%d")
@@ -197,15 +305,11 @@ def output_result(new_ip_addresses):
             rows_to_write.append([today_date, ip])
 
         try:
-            with open(OUTPUT_FILE_PATH, 'w', newline='') as file:
+            with open(output_path, 'w', newline='') as file:
                 writer = csv.writer(file)
                 writer.writerows(rows_to_write)
-            logging.info(f"Created {OUTPUT_FILE_PATH} with {len(new_ip_addresses)} new entries.")
+            logging.info(f"Created {output_path} with {len(new_ip_addresses)} new entries.")
         except Exception as e:
-            logging.error(f"Error writing to {OUTPUT_FILE_PATH}: {str(e)}")
+            logging.error(f"Error writing to {output_path}: {str(e)}")
     else:
         logging.info(f"Today's Output File has been already made")
-
-
-
-
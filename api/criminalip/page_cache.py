@@ -0,0 +1,164 @@
+"""
+Crawl Page Cache And Checkpoint
+
+Search result pages are kept on disk under the blake2b hash of the request, so
+a crawl that dies partway through can replay the pages it already paid for
+instead of fetching them again. The cache is bounded in size and evicts
+entries by age. The checkpoint is an append-only log of the (query, offset)
+pages fetched by the unfinished crawl; it is cleared once a crawl completes,
+so pages are only ever replayed to resume, never served to a fresh crawl.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+def page_key(url, query, offset):
+    """Hash identifying one page of one query"""
+    return hashlib.blake2b(f"{url}\0{query}\0{offset}".encode(), digest_size=20).hexdigest()
+
+
+class PageCache:
+    """Size bounded, age evicted store of JSON pages addressed by page_key"""
+
+    EVICT_EVERY = 1000
+
+    def __init__(self, directory, max_bytes, max_age_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.Lock()
+        self.puts = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """Return the cached page for key, None if it is missing or too old"""
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                os.unlink(path)
+                return None
+            with open(path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, data):
+        """Store a page atomically, evicting old entries every EVICT_EVERY writes"""
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "w") as file:
+                    json.dump(data, file, separators=(",", ":"))
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            logging.warning(f"Could not cache page {key}: {str(e)}")
+            return
+
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % self.EVICT_EVERY == 1
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Delete entries older than max_age_seconds, then the oldest ones until the cache fits max_bytes"""
+        now = time.time()
+        entries = []
+        removed = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if now - stat.st_mtime > self.max_age_seconds:
+                        os.unlink(path)
+                        removed += 1
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Evicted {removed} pages from the crawl cache, {total} bytes remain")
+
+
+class CrawlCheckpoint:
+    """Append-only record of the pages fetched by the crawl in progress"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        self.file = None
+
+    def load(self):
+        """Read the pages checkpointed by an unfinished crawl and return how many there are"""
+        with self.lock:
+            self.done = set()
+            try:
+                with open(self.path, "r") as file:
+                    for line in file:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # The last line of a crashed run can be cut short
+                            continue
+                        self.done.add((entry["query"], entry["offset"]))
+            except FileNotFoundError:
+                pass
+            return len(self.done)
+
+    def is_done(self, query, offset):
+        with self.lock:
+            return (query, offset) in self.done
+
+    def mark(self, query, offset):
+        """Record that a page of query was fetched and cached"""
+        with self.lock:
+            if (query, offset) in self.done:
+                return
+            self.done.add((query, offset))
+            try:
+                if self.file is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self.file = open(self.path, "a")
+                self.file.write(json.dumps({"query": query, "offset": offset}) + "\n")
+                self.file.flush()
+            except OSError as e:
+                logging.warning(f"Could not write crawl checkpoint: {str(e)}")
+
+    def clear(self):
+        """Forget the checkpoint once the crawl completed"""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.done = set()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,328 @@
+"""
+IP State Store
+
+SQLite backed record of every blocked IP, keyed by IP with first_seen,
+last_seen and source columns. New and expired IPs are computed with indexed
+queries instead of re-reading and rewriting the whole CSV history every run.
+The categories column is a bitmask of every query name the IP was seen under,
+with the bit of each name kept in the tag_bits table.
+"""
+import csv
+import json
+import logging
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import timedelta
+from api.ip_set import IPSet
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ip_addresses (
+    ip TEXT PRIMARY KEY,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    source TEXT NOT NULL,
+    expires_at TEXT,
+    categories INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_ip_addresses_first_seen ON ip_addresses (first_seen);
+CREATE TABLE IF NOT EXISTS pushed_prefixes (
+    prefix TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS device_prefixes (
+    device TEXT NOT NULL,
+    prefix TEXT NOT NULL,
+    groups INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (device, prefix)
+);
+CREATE TABLE IF NOT EXISTS tag_bits (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    bit INTEGER NOT NULL,
+    PRIMARY KEY (kind, name),
+    UNIQUE (kind, bit)
+);
+CREATE TABLE IF NOT EXISTS query_cursors (
+    name TEXT NOT NULL,
+    query TEXT NOT NULL,
+    watermark TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (name, query)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Bits of a SQLite INTEGER that can be set without overflowing into the sign
+MAX_TAG_BITS = 63
+
+# Ordered index on the expiry date: each run only visits the rows that expire
+EXPIRY_INDEX = "CREATE INDEX IF NOT EXISTS idx_ip_addresses_expires_at ON ip_addresses (expires_at)"
+
+
+MergeResult = namedtuple("MergeResult", ["new", "expired", "refreshed", "expiries_avoided", "recategorized"])
+
+
+class IPStateStore:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """Add the columns missing from stores created by earlier versions"""
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(ip_addresses)")}
+        if "expires_at" not in columns:
+            self.connection.execute("ALTER TABLE ip_addresses ADD COLUMN expires_at TEXT")
+        if "categories" not in columns:
+            self.connection.execute("ALTER TABLE ip_addresses ADD COLUMN categories INTEGER NOT NULL DEFAULT 0")
+        # Prefixes pushed before category groups existed are in the default group (bit 0)
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(device_prefixes)")}
+        if "groups" not in columns:
+            self.connection.execute("ALTER TABLE device_prefixes ADD COLUMN groups INTEGER NOT NULL DEFAULT 1")
+        self.connection.execute(EXPIRY_INDEX)
+
+    def close(self):
+        self.connection.close()
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def tag_bits(self, kind, names, first_bit=0, keep=None):
+        """Bit of each name of kind, assigning the lowest free bits to new names
+
+        Bits are kept while their name is in keep, so masks stored by earlier
+        runs keep their meaning. Once all MAX_TAG_BITS are taken, the bits of
+        names outside keep are reclaimed and cleared from the stored category
+        masks; with keep=None no bit is ever reclaimed. Raises ValueError when
+        no bit is left for a new name.
+        """
+        with self.connection:
+            bits = dict(self.connection.execute("SELECT name, bit FROM tag_bits WHERE kind = ?", (kind,)))
+            used = set(bits.values())
+            reclaimable = [] if keep is None else sorted(
+                (bit, name) for name, bit in bits.items() if name not in keep and name not in names
+            )
+            bit = first_bit
+            for name in names:
+                if name in bits:
+                    continue
+                while bit in used:
+                    bit += 1
+                if bit >= MAX_TAG_BITS:
+                    if not reclaimable:
+                        raise ValueError(
+                            f"No {kind} bit left for {name!r}: at most {MAX_TAG_BITS} {kind} names fit in the bitmask"
+                        )
+                    bit, retired = reclaimable.pop(0)
+                    self.connection.execute("DELETE FROM tag_bits WHERE kind = ? AND name = ?", (kind, retired))
+                    if kind == "category":
+                        self.connection.execute(
+                            "UPDATE ip_addresses SET categories = categories & ? WHERE categories & ?",
+                            (~(1 << bit), 1 << bit),
+                        )
+                    del bits[retired]
+                    logging.info(f"Reused {kind} bit {bit} of {retired!r} for {name!r}")
+                self.connection.execute("INSERT INTO tag_bits (kind, name, bit) VALUES (?, ?, ?)", (kind, name, bit))
+                bits[name] = bit
+                used.add(bit)
+        return bits
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM ip_addresses").fetchone()[0]
+
+    def import_csv_history(self, *csv_paths):
+        """One-time import of the Date/IP Address CSVs used before the store existed
+
+        Files are imported in order; the first date seen for an IP wins. Imported
+        rows get their expiry date on the next merge.
+        """
+        if self.get_meta("csv_imported"):
+            return 0
+
+        imported = 0
+        with self.connection:
+            for csv_path in csv_paths:
+                if not os.path.exists(csv_path):
+                    continue
+                with open(csv_path, "r", newline="") as csv_file:
+                    reader = csv.reader(csv_file)
+                    next(reader, None)
+                    rows = [(row[1], row[0], row[0], "csv-import") for row in reader if len(row) >= 2]
+                cursor = self.connection.executemany(
+                    "INSERT OR IGNORE INTO ip_addresses (ip, first_seen, last_seen, source) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                imported += cursor.rowcount
+                logging.info(f"Imported {cursor.rowcount} entries from {csv_path}")
+            self.set_meta("csv_imported", 1)
+        return imported
+
+    def merge(self, seen_ips, today, ttl_days, categories=None):
+        """Refresh, expire and add IPs for one run
+
+        seen_ips maps each category to the IPSet of IPs seen under it today and
+        ttl_days(category) returns that category's TTL. categories lists the
+        configured categories, whose bits are never reclaimed. An IP seen again has its last_seen refreshed
+        and its expiry pushed to today + TTL, so it is never deleted and re-added
+        while it keeps showing up. Only rows whose expires_at is due are read
+        through the expiry index. recategorized holds the IPs already stored
+        that were seen under a category they did not have yet.
+        """
+        today_iso = today.isoformat()
+        category_bits = self.tag_bits("category", sorted(seen_ips), keep=categories)
+        with self.connection:
+            self.connection.execute(
+                "UPDATE ip_addresses SET expires_at = date(last_seen, ?) WHERE expires_at IS NULL",
+                (f"+{ttl_days(None)} days",),
+            )
+
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS seen (ip TEXT PRIMARY KEY, source TEXT, expires_at TEXT, categories INTEGER)"
+            )
+            self.connection.execute("DELETE FROM seen")
+            # An IP seen under several categories gets all their bits and the longest TTL
+            self.connection.executemany(
+                "INSERT INTO seen (ip, source, expires_at, categories) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ip) DO UPDATE SET categories = categories | excluded.categories, "
+                "expires_at = MAX(expires_at, excluded.expires_at)",
+                (
+                    (ip, category, (today + timedelta(days=ttl_days(category))).isoformat(), 1 << category_bits[category])
+                    for category, ip_addresses in seen_ips.items()
+                    for ip in ip_addresses
+                ),
+            )
+
+            # IPs that would have expired today without the refresh
+            expiries_avoided = self.connection.execute(
+                "SELECT COUNT(*) FROM seen JOIN ip_addresses ON ip_addresses.ip = seen.ip "
+                "WHERE ip_addresses.expires_at <= ?",
+                (today_iso,),
+            ).fetchone()[0]
+            recategorized = IPSet(
+                row[0] for row in self.connection.execute(
+                    "SELECT seen.ip FROM seen JOIN ip_addresses ON ip_addresses.ip = seen.ip "
+                    "WHERE ip_addresses.categories | seen.categories != ip_addresses.categories"
+                )
+            )
+            refreshed = self.connection.execute(
+                "UPDATE ip_addresses SET last_seen = ?, "
+                "expires_at = MAX(expires_at, (SELECT seen.expires_at FROM seen WHERE seen.ip = ip_addresses.ip)), "
+                "categories = categories | (SELECT seen.categories FROM seen WHERE seen.ip = ip_addresses.ip) "
+                "WHERE ip IN (SELECT ip FROM seen)",
+                (today_iso,),
+            ).rowcount
+
+            expired = IPSet(
+                row[0] for row in self.connection.execute(
+                    "SELECT ip FROM ip_addresses WHERE expires_at <= ?", (today_iso,)
+                )
+            )
+            self.connection.execute("DELETE FROM ip_addresses WHERE expires_at <= ?", (today_iso,))
+
+            new_ips = IPSet(
+                row[0] for row in self.connection.execute(
+                    "SELECT seen.ip FROM seen LEFT JOIN ip_addresses ON ip_addresses.ip = seen.ip "
+                    "WHERE ip_addresses.ip IS NULL"
+                )
+            )
+            self.connection.execute(
+                "INSERT INTO ip_addresses (ip, first_seen, last_seen, source, expires_at, categories) "
+                "SELECT ip, ?, ?, source, expires_at, categories FROM seen "
+                "WHERE ip NOT IN (SELECT ip FROM ip_addresses)",
+                (today_iso, today_iso),
+            )
+            self.connection.execute("DELETE FROM seen")
+        return MergeResult(new_ips, expired, refreshed, expiries_avoided, recategorized)
+
+    def active_ip_addresses(self):
+        """Every IP currently on the blocklist"""
+        return IPSet(row[0] for row in self.connection.execute("SELECT ip FROM ip_addresses"))
+
+    def category_masks(self, ip_addresses=None):
+        """Yield (ip, categories bitmask) for every IP on the blocklist, or only for ip_addresses"""
+        if ip_addresses is None:
+            yield from self.connection.execute("SELECT ip, categories FROM ip_addresses")
+            return
+        batch = []
+        for ip in ip_addresses:
+            batch.append(ip)
+            if len(batch) == 500:
+                yield from self._category_masks_of(batch)
+                batch = []
+        if batch:
+            yield from self._category_masks_of(batch)
+
+    def _category_masks_of(self, ips):
+        placeholders = ", ".join("?" * len(ips))
+        return self.connection.execute(f"SELECT ip, categories FROM ip_addresses WHERE ip IN ({placeholders})", ips)
+
+    def claim_legacy_prefixes(self, device):
+        """Move the push history recorded before devices were listed to device
+
+        Does nothing if there is no such history or device already has its own.
+        """
+        if not self.get_meta("prefixes_recorded") or self.get_meta(f"prefixes_recorded:{device}"):
+            return
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR IGNORE INTO device_prefixes (device, prefix) SELECT ?, prefix FROM pushed_prefixes", (device,)
+            )
+            self.connection.execute("DELETE FROM pushed_prefixes")
+            self.set_meta(f"prefixes_recorded:{device}", 1)
+            shards = self.get_meta("deny_set_shards")
+            if shards is not None:
+                self.set_meta(f"deny_set_shards:{device}", shards)
+            self.connection.execute("DELETE FROM meta WHERE key IN ('prefixes_recorded', 'deny_set_shards')")
+        logging.info(f"Moved the recorded push history to device {device}")
+
+    def pushed_prefixes(self, device):
+        """Prefixes pushed to device as address objects, mapped to the bitmask of
+        the category groups whose address sets hold them, None if never recorded"""
+        if not self.get_meta(f"prefixes_recorded:{device}"):
+            return None
+        rows = self.connection.execute("SELECT prefix, groups FROM device_prefixes WHERE device = ?", (device,))
+        return dict(rows.fetchall())
+
+    def pushed_shard_counts(self, device, default_set_name):
+        """Shard count of each address set on device by set name; sets missing were never sharded"""
+        value = self.get_meta(f"set_shards:{device}")
+        if value is not None:
+            return json.loads(value)
+        # Recorded before category groups existed, for the default deny set only
+        value = self.get_meta(f"deny_set_shards:{device}")
+        return {default_set_name: int(value)} if value is not None else {}
+
+    def save_pushed_prefixes(self, device, prefixes, shard_counts=None):
+        """Replace the recorded prefixes present on device, their group bitmasks and the set shard counts"""
+        with self.connection:
+            self.connection.execute("DELETE FROM device_prefixes WHERE device = ?", (device,))
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO device_prefixes (device, prefix, groups) VALUES (?, ?, ?)",
+                ((device, prefix, groups) for prefix, groups in prefixes.items()),
+            )
+            self.set_meta(f"prefixes_recorded:{device}", 1)
+            if shard_counts is not None:
+                self.set_meta(f"set_shards:{device}", json.dumps(shard_counts, sort_keys=True))
+
+    def query_cursors(self):
+        """Newest result time ingested per (query name, query), as a dict"""
+        rows = self.connection.execute("SELECT name, query, watermark FROM query_cursors")
+        return {(name, query): watermark for name, query, watermark in rows}
+
+    def save_query_cursors(self, cursors, updated_at):
+        """Record the newest result time ingested for each (query name, query) in cursors"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO query_cursors (name, query, watermark, updated_at) VALUES (?, ?, ?, ?)",
+                ((name, query, watermark, updated_at) for (name, query), watermark in cursors.items()),
+            )
@@ -0,0 +1,214 @@
+"""
+Dynamic Address Feed Server
+
+Publishes the blocklist as a versioned feed that SRX dynamic-address objects
+pull over HTTP, so blocklist updates need no configuration commit. Every
+publish writes the full list, a delta against the previous version and a
+manifest; the server answers polls with ETag/Last-Modified validators so an
+unchanged feed costs a 304 without a body.
+"""
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FEED_FILE_NAME = "blocklist.txt"
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _read_manifest(feed_dir):
+    path = os.path.join(feed_dir, MANIFEST_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def _read_feed(feed_dir, relative_path):
+    with open(os.path.join(feed_dir, relative_path), "r") as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def publish_feed(prefixes, feed_dir, keep_versions=24):
+    """Publish a new feed version if the blocklist changed
+
+    Writes full/<version>.txt, delta/<version>.json (prefixes added and removed
+    since the previous version), the current blocklist.txt and manifest.json.
+    Only the last keep_versions versions are kept. Returns the manifest.
+    """
+    prefixes = set(prefixes)
+    body = "".join(f"{prefix}\n" for prefix in sorted(prefixes)).encode()
+    digest = hashlib.sha256(body).hexdigest()
+
+    manifest = _read_manifest(feed_dir)
+    if manifest and manifest.get("sha256") == digest:
+        logging.info(f"Feed unchanged at version {manifest['version']} ({manifest['count']} entries)")
+        return manifest
+
+    previous_version = manifest["version"] if manifest else 0
+    version = previous_version + 1
+    full_path = f"full/{version}.txt"
+    _write_atomic(os.path.join(feed_dir, full_path), body)
+
+    deltas = manifest.get("deltas", []) if manifest else []
+    if manifest:
+        previous = _read_feed(feed_dir, manifest["full"])
+        delta_path = f"delta/{version}.json"
+        delta = {
+            "from": previous_version,
+            "to": version,
+            "add": sorted(prefixes - previous),
+            "remove": sorted(previous - prefixes),
+        }
+        _write_atomic(os.path.join(feed_dir, delta_path), json.dumps(delta).encode())
+        deltas.append({"from": previous_version, "to": version, "path": delta_path,
+                       "add": len(delta["add"]), "remove": len(delta["remove"])})
+        logging.info(f"Feed delta {previous_version} -> {version}: +{len(delta['add'])} -{len(delta['remove'])}")
+
+    versions = [entry for entry in manifest.get("versions", [])] if manifest else []
+    versions.append({"version": version, "path": full_path, "count": len(prefixes), "sha256": digest})
+    stale_versions, versions = versions[:-keep_versions], versions[-keep_versions:]
+    oldest = versions[0]["version"]
+    stale_deltas = [entry for entry in deltas if entry["to"] <= oldest]
+    deltas = [entry for entry in deltas if entry["to"] > oldest]
+    for entry in stale_versions + stale_deltas:
+        path = os.path.join(feed_dir, entry["path"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    manifest = {
+        "version": version,
+        "generated_at": int(time.time()),
+        "count": len(prefixes),
+        "sha256": digest,
+        "full": full_path,
+        "versions": versions,
+        "deltas": deltas,
+    }
+    _write_atomic(os.path.join(feed_dir, FEED_FILE_NAME), body)
+    _write_atomic(os.path.join(feed_dir, MANIFEST_FILE_NAME), json.dumps(manifest, indent=2).encode())
+    logging.info(f"Published feed version {version} with {len(prefixes)} entries")
+    return manifest
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """Serve the files of the feed directory with conditional GET support"""
+
+    feed_dir = None
+    _etags = {}
+    _etags_lock = threading.Lock()
+
+    def _resolve(self):
+        path = posixpath.normpath(self.path.split("?", 1)[0]).lstrip("/")
+        if not path or path.startswith("..") or path.startswith(".tmp-"):
+            return None
+        full_path = os.path.join(self.feed_dir, path)
+        return full_path if os.path.isfile(full_path) else None
+
+    def _etag(self, full_path, stat):
+        """ETag of a file, cached per path until the file changes
+
+        On every miss the entries of files that publish_feed has pruned since
+        are evicted, so the cache never holds more than the feed directory.
+        """
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._etags_lock:
+            cached = self._etags.get(full_path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with open(full_path, "rb") as file:
+            etag = '"' + hashlib.sha256(file.read()).hexdigest()[:32] + '"'
+        with self._etags_lock:
+            for path in [path for path in self._etags if path != full_path and not os.path.exists(path)]:
+                del self._etags[path]
+            self._etags[full_path] = (version, etag)
+        return etag
+
+    def _send(self, include_body):
+        full_path = self._resolve()
+        if full_path is None:
+            self.send_error(404)
+            return
+
+        stat = os.stat(full_path)
+        etag = self._etag(full_path, stat)
+        last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+        not_modified = False
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            not_modified = etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        elif self.headers.get("If-Modified-Since"):
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"]).timestamp()
+                not_modified = int(stat.st_mtime) <= int(since)
+            except (TypeError, ValueError):
+                not_modified = False
+
+        if not_modified:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+
+        content_type = "application/json" if full_path.endswith(".json") else "text/plain"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(stat.st_size))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if include_body:
+            with open(full_path, "rb") as file:
+                self.wfile.write(file.read())
+
+    def do_GET(self):
+        self._send(include_body=True)
+
+    def do_HEAD(self):
+        self._send(include_body=False)
+
+    def log_message(self, format, *args):
+        logging.info(f"Feed request from {self.client_address[0]}: {format % args}")
+
+
+def create_feed_server(feed_dir, host, port):
+    """Create (but do not start) the HTTP server for a feed directory"""
+    handler = type("BoundFeedRequestHandler", (FeedRequestHandler,), {"feed_dir": feed_dir, "_etags": {}})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve_feed(feed_dir, host, port):
+    """Serve the feed directory until interrupted"""
+    server = create_feed_server(feed_dir, host, port)
+    logging.info(f"Serving feed {feed_dir} on http://{host}:{port}/{FEED_FILE_NAME}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
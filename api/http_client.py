@@ -0,0 +1,76 @@
+"""
+Shared HTTP Client
+
+Keeps one pooled keep-alive requests.Session per remote service so that the
+Criminal IP crawler and the SRX RPC client reuse TCP/TLS connections instead of
+opening a new one for every call.
+"""
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name):
+    """Return the pooled session registered under name, creating it on first use"""
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[name] = session
+            logging.info(f"Created HTTP session '{name}' (pool size {HTTP_POOL_MAXSIZE})")
+        return session
+
+
+def request(name, method, url, **kwargs):
+    """Send a request through the named session using the configured timeouts"""
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    return get_session(name).request(method, url, **kwargs)
+
+
+def connection_stats():
+    """Return request, connection and reuse counters for every session"""
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for name, session in sessions:
+        requests_sent = 0
+        connections_opened = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+        stats[name] = {
+            "requests": requests_sent,
+            "connections": connections_opened,
+            "reused": max(0, requests_sent - connections_opened),
+        }
+    return stats
+
+
+def log_connection_stats():
+    """Write the connection reuse counters of every session to the log"""
+    for name, counters in connection_stats().items():
+        logging.info(
+            f"HTTP session '{name}': {counters['requests']} requests over "
+            f"{counters['connections']} connections ({counters['reused']} reused)"
+        )
+
+
+def close_sessions():
+    """Close every pooled session"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
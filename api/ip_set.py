@@ -0,0 +1,210 @@
+"""
+Compact IP Set
+
+Set of IP addresses stored as sorted integers: IPv4 in an array('I') (4 bytes
+per address) and IPv6 in a separate sorted list. Batch union, difference and
+intersection are sorted merges; single adds go to a small pending buffer that
+is merged in once it grows, which keeps crawl deduplication cheap, and batch
+updates are sorted in bounded runs so building a large set stays compact.
+"""
+import heapq
+import ipaddress
+import socket
+from array import array
+from bisect import bisect_left
+
+PENDING_LIMIT = 4096
+# Addresses update() holds as Python ints before sorting them into a compact run
+UPDATE_BATCH = 65536
+
+
+def _ipv4_to_int(ip_address):
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+
+
+def _parse(ip_address):
+    """Return (version, integer) for an IP address string"""
+    try:
+        return 4, _ipv4_to_int(ip_address)
+    except OSError:
+        return 6, int(ipaddress.IPv6Address(ip_address))
+
+
+def _contains_sorted(values, value):
+    index = bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+
+def _insert_sorted(values, new_values):
+    """Sorted union of sorted values and sorted, unique new_values
+
+    The runs of values between two insertion points are copied as slices, so
+    only the new values are handled one at a time and values keeps its type.
+    """
+    merged = values[:0]
+    start, length = 0, len(values)
+    for value in new_values:
+        index = bisect_left(values, value, start)
+        if index < length and values[index] == value:
+            continue
+        merged += values[start:index]
+        merged.append(value)
+        start = index
+    merged += values[start:]
+    return merged
+
+
+def _merge_unique(*sequences):
+    """Sorted union of sorted sequences without duplicates"""
+    previous = None
+    for value in heapq.merge(*sequences):
+        if value != previous:
+            yield value
+            previous = value
+
+
+def _difference(first, second):
+    """Values of sorted first that are not in sorted second"""
+    index, length = 0, len(second)
+    for value in first:
+        while index < length and second[index] < value:
+            index += 1
+        if index >= length or second[index] != value:
+            yield value
+
+
+def _intersection(first, second):
+    index, length = 0, len(second)
+    for value in first:
+        while index < length and second[index] < value:
+            index += 1
+        if index < length and second[index] == value:
+            yield value
+
+
+class IPSet:
+    def __init__(self, ip_addresses=()):
+        self.ipv4 = array("I")
+        self.ipv6 = []
+        self.pending4 = set()
+        self.pending6 = set()
+        self.update(ip_addresses)
+
+    @classmethod
+    def _from_sorted(cls, ipv4, ipv6):
+        ip_set = cls()
+        ip_set.ipv4 = array("I", ipv4)
+        ip_set.ipv6 = list(ipv6)
+        return ip_set
+
+    def _compact(self):
+        if self.pending4:
+            self.ipv4 = _insert_sorted(self.ipv4, sorted(self.pending4))
+            self.pending4 = set()
+        if self.pending6:
+            self.ipv6 = _insert_sorted(self.ipv6, sorted(self.pending6))
+            self.pending6 = set()
+
+    def add(self, ip_address):
+        """Add an address, returns True if it was not in the set yet
+
+        Raises ValueError for strings that are not IP addresses.
+        """
+        version, value = _parse(ip_address)
+        values, pending = (self.ipv4, self.pending4) if version == 4 else (self.ipv6, self.pending6)
+        if value in pending or _contains_sorted(values, value):
+            return False
+        pending.add(value)
+        # Grow the buffer with the set so merging stays amortised O(n log n)
+        if len(pending) >= max(PENDING_LIMIT, len(values) // 8):
+            self._compact()
+        return True
+
+    def update(self, ip_addresses):
+        """Add many addresses at once
+
+        Addresses are sorted in batches of UPDATE_BATCH into compact runs that
+        are merged with the set in one pass at the end, so building a large set
+        never holds more than one batch as Python ints.
+        """
+        runs = {4: [], 6: []}
+        batches = {4: set(), 6: set()}
+        for ip_address in ip_addresses:
+            version, value = _parse(ip_address)
+            batch = batches[version]
+            batch.add(value)
+            if len(batch) >= UPDATE_BATCH:
+                runs[version].append(array("I", sorted(batch)) if version == 4 else sorted(batch))
+                batch.clear()
+        if not runs[4] and not runs[6]:
+            self.pending4.update(batches[4])
+            self.pending6.update(batches[6])
+            self._compact()
+            return
+        self._compact()
+        self.ipv4 = array("I", _merge_unique(self.ipv4, *runs[4], sorted(batches[4])))
+        self.ipv6 = list(_merge_unique(self.ipv6, *runs[6], sorted(batches[6])))
+
+    def __contains__(self, ip_address):
+        try:
+            version, value = _parse(ip_address)
+        except ValueError:
+            return False
+        if version == 4:
+            return value in self.pending4 or _contains_sorted(self.ipv4, value)
+        return value in self.pending6 or _contains_sorted(self.ipv6, value)
+
+    def __len__(self):
+        return len(self.ipv4) + len(self.ipv6) + len(self.pending4) + len(self.pending6)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        self._compact()
+        for value in self.ipv4:
+            yield socket.inet_ntop(socket.AF_INET, value.to_bytes(4, "big"))
+        for value in self.ipv6:
+            yield str(ipaddress.IPv6Address(value))
+
+    def ipv4_integers(self):
+        """Sorted IPv4 addresses as integers"""
+        self._compact()
+        return self.ipv4
+
+    def ipv6_integers(self):
+        """Sorted IPv6 addresses as integers"""
+        self._compact()
+        return self.ipv6
+
+    def union(self, other):
+        self._compact()
+        other._compact()
+        return IPSet._from_sorted(_merge_unique(self.ipv4, other.ipv4), _merge_unique(self.ipv6, other.ipv6))
+
+    def difference(self, other):
+        self._compact()
+        other._compact()
+        return IPSet._from_sorted(_difference(self.ipv4, other.ipv4), _difference(self.ipv6, other.ipv6))
+
+    def intersection(self, other):
+        self._compact()
+        other._compact()
+        return IPSet._from_sorted(_intersection(self.ipv4, other.ipv4), _intersection(self.ipv6, other.ipv6))
+
+    def filter(self, keep):
+        """New IPSet of the addresses for which keep(version, integer) is true"""
+        self._compact()
+        return IPSet._from_sorted(
+            (value for value in self.ipv4 if keep(4, value)), (value for value in self.ipv6 if keep(6, value))
+        )
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def clear(self):
+        self.ipv4 = array("I")
+        self.ipv6 = []
+        self.pending4 = set()
+        self.pending6 = set()
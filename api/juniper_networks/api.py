@@ -7,36 +7,54 @@ objects, address sets, and security policies.
 
 Dependencies:
     - logging: For operation logging
-    - xml.etree.ElementTree: For XML parsing
+    - .commit: Coalesces commits and isolates changes rejected by a commit check
+    - .parser: Streams get-configuration replies into address, set and policy records
     - .utils: Contains the make_rpc_request function for NETCONF communication
 """
 import logging
-from .utils import make_rpc_request
-import xml.etree.ElementTree as ET
+from .parser import iter_response_records
+from .commit import commit_manager_for
+from .utils import make_rpc_request, rpc_succeeded
+from .sharding import is_deny_set, members_from_history, plan_shards, shard_count
+from config import EDIT_CONFIG_CHUNK_SIZE
+
+# Every address object managed by this tool starts with this prefix
+ADDRESS_NAME_PREFIX = "test-ip-"
+DENY_ADDRESS_SET_NAME = "test-deny-set"
+DENY_POLICY_NAME = "deny-to-test-set"
+
+
+def address_object_name(ip_address):
+    """Return the address book object name used for an IP address or prefix
+
+    Host routes keep the plain IP based name; wider prefixes get the prefix
+    length appended (e.g. test-ip-10-0-0-0-24). The dots and colons of the
+    address become dashes (test-ip-2001-db8--1 for 2001:db8::1).
+    """
+    address, _, length = ip_address.partition("/")
+    name = f"{ADDRESS_NAME_PREFIX}{address.replace('.', '-').replace(':', '-')}"
+    if length and length not in ("32", "128"):
+        name = f"{name}-{length}"
+    return name
+
+
+def as_prefix(ip_address):
+    """Return an IP address as a prefix, leaving prefixes untouched"""
+    if "/" in ip_address:
+        return ip_address
+    return f"{ip_address}/{128 if ':' in ip_address else 32}"
+
 
 def commit_configuration():
     """Commit the configuration changes"""
-    logging.info("Committing configuration changes")
-    
-    xml_data = """
-    <commit-configuration/>
-    """
-    
-    response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 204]:
-        logging.info("Successfully committed configuration")
-        return True
-    else:
-        if response:
-            logging.error(f"Failed to commit configuration: {response.text}")
-        return False
+    return commit_manager_for().commit()
 
 
 def create_address_object(ip_address):
-    """Create an address object for a malicious IP"""
+    """Create an address object for a malicious IP or prefix"""
     logging.info(f"Creating address object for IP: {ip_address}")
     
-    address_name = f"test-ip-{ip_address.replace('.', '-')}"
+    address_name = address_object_name(ip_address)
     xml_data = f"""
     <edit-config>
         <target>
@@ -49,7 +67,7 @@ def create_address_object(ip_address):
                         <name>global</name>
                         <address>
                             <name>{address_name}</name>
-                            <ip-prefix>{ip_address}/32</ip-prefix>
+                            <ip-prefix>{as_prefix(ip_address)}</ip-prefix>
                         </address>
                     </address-book>
                 </security>
@@ -59,9 +77,9 @@ def create_address_object(ip_address):
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully created address object for {ip_address}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -71,7 +89,7 @@ def create_address_object(ip_address):
 
 def create_address_set(ip_address, address_set_name="test-deny-set"):
     """Create an address set containing malicious IPs"""
-    address_name = f"test-ip-{ip_address.replace('.', '-')}"
+    address_name = address_object_name(ip_address)
     
     xml_data = f"""
     <edit-config>
@@ -97,9 +115,9 @@ def create_address_set(ip_address, address_set_name="test-deny-set"):
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully created address set {address_set_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -146,9 +164,9 @@ def create_security_policy(policy_name="deny-to-test-set", address_set_name="tes
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully created security policy {policy_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -156,6 +174,54 @@ def create_security_policy(policy_name="deny-to-test-set", address_set_name="tes
         return False
 
 
+def create_dynamic_address_feed(feed_url, feed_path, feed_name="cip-blocklist", address_name="cip-dynamic-blocklist",
+                                server_name="cip-feed-server", update_interval=300, hold_interval=86400):
+    """Create a dynamic address that the device fills by polling a blocklist feed"""
+    logging.info(f"Creating dynamic address {address_name} from feed {feed_url}{feed_path}")
+
+    xml_data = f"""
+    <edit-config>
+        <target>
+            <candidate/>
+        </target>
+        <config>
+            <configuration>
+                <security>
+                    <dynamic-address>
+                        <feed-server>
+                            <name>{server_name}</name>
+                            <url>{feed_url}</url>
+                            <update-interval>{update_interval}</update-interval>
+                            <hold-interval>{hold_interval}</hold-interval>
+                            <feed-name>
+                                <name>{feed_name}</name>
+                                <path>{feed_path}</path>
+                            </feed-name>
+                        </feed-server>
+                        <address-name>
+                            <name>{address_name}</name>
+                            <profile>
+                                <feed-name>{feed_name}</feed-name>
+                            </profile>
+                        </address-name>
+                    </dynamic-address>
+                </security>
+            </configuration>
+        </config>
+    </edit-config>
+    """
+    
+    response = make_rpc_request(xml_data)
+    if rpc_succeeded(response):
+        logging.info(f"Successfully created dynamic address {address_name}")
+        commit_manager_for().request_commit()
+        return True
+    else:
+        if response:
+            logging.error(f"Failed to create dynamic address: {response.text}")
+        return False
+
+
 def create_permit_security_policy(policy_name, address_set_name, from_zone, to_zone):
     """Create a security policy to allow traffic in a specific direction"""
     logging.info(f"Creating permit security policy: {policy_name}")
@@ -195,9 +261,9 @@ def create_permit_security_policy(policy_name, address_set_name, from_zone, to_z
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully created permit security policy {policy_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -205,9 +271,47 @@ def create_permit_security_policy(policy_name, address_set_name, from_zone, to_z
         return False
 
 
+def delete_security_policy(policy_name, from_zone="trust", to_zone="untrust"):
+    """Delete a security policy from a specific zone pair"""
+    logging.info(f"Deleting security policy: {policy_name}")
+
+    xml_data = f"""
+    <edit-config>
+        <target>
+            <candidate/>
+        </target>
+        <config>
+            <configuration>
+                <security>
+                    <policies>
+                        <policy>
+                            <from-zone-name>{from_zone}</from-zone-name>
+                            <to-zone-name>{to_zone}</to-zone-name>
+                            <policy operation="delete">
+                                <name>{policy_name}</name>
+                            </policy>
+                        </policy>
+                    </policies>
+                </security>
+            </configuration>
+        </config>
+    </edit-config>
+    """
+
+    response = make_rpc_request(xml_data)
+    if rpc_succeeded(response):
+        logging.info(f"Successfully deleted security policy {policy_name}")
+        commit_manager_for().request_commit()
+        return True
+    else:
+        if response:
+            logging.error(f"Failed to delete security policy: {response.text}")
+        return False
+
+
 def delete_address_object(ip_address):
     """Delete an address object for a specific IP"""
-    address_name = f"test-ip-{ip_address.replace('.', '-')}"
+    address_name = address_object_name(ip_address)
 
     logging.info(f"Deleting address object: {address_name}")
 
@@ -232,9 +336,9 @@ def delete_address_object(ip_address):
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully deleted address object {address_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -267,9 +371,9 @@ def delete_address_set(set_name):
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully deleted address set {set_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -280,47 +384,21 @@ def delete_address_set(set_name):
 def delete_all_address_objects(address_book_name="global"):
     """Delete all malicious IP address objects from the address book"""
     logging.info(f"Deleting all malicious IP address objects from address book: {address_book_name}")
-  
-    # Get all address sets to remove references
-    xml_data = f"""
-    <get-configuration>
-        <configuration>
-            <security>
-                <address-book>
-                    <name>{address_book_name}</name>
-                </address-book>
-            </security>
-        </configuration>
-    </get-configuration>
-    """
-    response = make_rpc_request(xml_data)
-    if response and response.status_code == 200:
-        text = response.text
-        
-        # Clean up the response text if needed
-        if text.startswith('--'):
-            xml_start = text.find("<configuration")
-            if xml_start != -1:
-                boundary_marker = text[:text.find('\n')]
-                xml_end = text.rfind(boundary_marker)
-                if xml_end != -1:
-                    text = text[xml_start:xml_end].strip()
-        try:
-            root = ET.fromstring(text)
-            for addr in root.findall(".//address/name"):
-                if addr.text and addr.text.startswith("malicious-"):
-                    ip_parts = addr.text.replace('malicious-', '').split('-')
-                    ip_address = '.'.join(ip_parts)
-                    delete_address_object(ip_address)
-            return True
-        except Exception as e:
-            logging.error(f"Error processing address sets: {str(e)}")
-            return False
+
+    # One snapshot gives both the objects and the address sets that reference them
+    snapshot = fetch_address_book(address_book_name)
+    if snapshot is None:
+        return False
+
+    change_set = AddressChangeSet(address_book_name)
+    plan_reconcile(snapshot, set(), change_set=change_set)
+    results = change_set.push()
+    return all(success for _, _, success in results)
 
 
 def delete_address_object_from_address_set(ip_address, address_set_name="test-deny-set"):
     """Remove a specific IP address reference from an address set"""
-    address_name = f"test-ip-{ip_address.replace('.', '-')}"
+    address_name = address_object_name(ip_address)
 
     logging.info(f"Removing address {address_name} from address set {address_set_name}")
     
@@ -348,9 +426,9 @@ def delete_address_object_from_address_set(ip_address, address_set_name="test-de
     """
     
     response = make_rpc_request(xml_data)
-    if response and response.status_code in [200, 201, 204]:
+    if rpc_succeeded(response):
         logging.info(f"Successfully removed address {address_name} from set {address_set_name}")
-        commit_configuration()
+        commit_manager_for().request_commit()
         return True
     else:
         if response:
@@ -377,24 +455,15 @@ def check_if_policy_exists(policy_name="deny-to-test-set", from_zone="trust", to
     </get-configuration>
     """
     
-    response = make_rpc_request(xml_data)
+    response = make_rpc_request(xml_data, stream=True)
     if response and response.status_code == 200:
-        text = response.text
-        
-        # Clean up the response text if needed
-        if text.startswith('--'):
-            xml_start = text.find("<configuration")
-            if xml_start != -1:
-                boundary_marker = text[:text.find('\n')]
-                xml_end = text.rfind(boundary_marker)
-                if xml_end != -1:
-                    text = text[xml_start:xml_end].strip()
         try:
-            root = ET.fromstring(text)
             # Find all the policy names and check if our policy exists.
-            for policy_elem in root.findall(".//policy/name"):
-                if policy_elem.text and policy_elem.text == policy_name:
+            records = iter_response_records(response)
+            for record in records:
+                if record.kind == "policy" and record.name == policy_name:
                     logging.info(f"Policy {policy_name} exists in zone pair {from_zone}-{to_zone}")
+                    records.close()
                     return True
             
             logging.info(f"Policy {policy_name} does not exist in zone pair {from_zone}-{to_zone}")
@@ -406,3 +475,403 @@ def check_if_policy_exists(policy_name="deny-to-test-set", from_zone="trust", to
         if response:
             logging.error(f"Failed to check if policy exists: {response.text}")
         return False
+
+
+class AddressChangeSet:
+    """Collect address object and address set changes and push them as a batch
+
+    Changes are queued with the add/remove methods and sent by push() as chunked
+    <edit-config> payloads, committed through the commit manager. Member removals are sent
+    before object deletes, and object creates before member additions, so every
+    chunk only references objects that exist in the candidate configuration.
+    """
+
+    ADD_ADDRESS = "add-address"
+    DELETE_ADDRESS = "delete-address"
+    ADD_MEMBER = "add-member"
+    REMOVE_MEMBER = "remove-member"
+    ADD_SET_REFERENCE = "add-set-reference"
+    REMOVE_SET_REFERENCE = "remove-set-reference"
+    DELETE_SET = "delete-set"
+
+    # Order in which the operations are sent to the device
+    _OPERATION_ORDER = (
+        REMOVE_MEMBER, REMOVE_SET_REFERENCE, DELETE_SET, DELETE_ADDRESS,
+        ADD_ADDRESS, ADD_MEMBER, ADD_SET_REFERENCE,
+    )
+
+    def __init__(self, address_book_name="global", chunk_size=EDIT_CONFIG_CHUNK_SIZE):
+        self.address_book_name = address_book_name
+        self.chunk_size = max(1, int(chunk_size))
+        self.items = {operation: [] for operation in self._OPERATION_ORDER}
+
+    def __len__(self):
+        return sum(len(items) for items in self.items.values())
+
+    def add_object(self, name, prefix):
+        self.items[self.ADD_ADDRESS].append((name, prefix))
+
+    def delete_object(self, name, prefix):
+        self.items[self.DELETE_ADDRESS].append((name, prefix))
+
+    def add_member(self, address_set_name, name):
+        self.items[self.ADD_MEMBER].append((address_set_name, name))
+
+    def remove_member(self, address_set_name, name):
+        self.items[self.REMOVE_MEMBER].append((address_set_name, name))
+
+    def add_set_reference(self, address_set_name, child_set_name):
+        self.items[self.ADD_SET_REFERENCE].append((address_set_name, child_set_name))
+
+    def remove_set_reference(self, address_set_name, child_set_name):
+        self.items[self.REMOVE_SET_REFERENCE].append((address_set_name, child_set_name))
+
+    def delete_set(self, address_set_name):
+        self.items[self.DELETE_SET].append((address_set_name,))
+
+    def add_address(self, ip_address, address_set_name="test-deny-set"):
+        """Queue the creation of an address object (IP or prefix) and its set membership"""
+        prefix = as_prefix(ip_address)
+        name = address_object_name(prefix)
+        self.add_object(name, prefix)
+        if address_set_name:
+            self.add_member(address_set_name, name)
+
+    def delete_address(self, ip_address, address_set_name="test-deny-set"):
+        """Queue the removal of an address object (IP or prefix) and its set membership"""
+        prefix = as_prefix(ip_address)
+        name = address_object_name(prefix)
+        if address_set_name:
+            self.remove_member(address_set_name, name)
+        self.delete_object(name, prefix)
+
+    def _operations(self):
+        """Return all queued (operation, item) pairs in send order"""
+        return [(operation, item) for operation in self._OPERATION_ORDER for item in self.items[operation]]
+
+    def _chunks(self, operations):
+        """Yield lists of at most chunk_size (operation, item) pairs in send order"""
+        rank = {operation: index for index, operation in enumerate(self._OPERATION_ORDER)}
+        operations = sorted(operations, key=lambda pair: rank[pair[0]])
+        for start in range(0, len(operations), self.chunk_size):
+            yield operations[start:start + self.chunk_size]
+
+    def _build_payloads(self, operations):
+        """Build the <edit-config> requests for a list of operations"""
+        return [self._build_payload(chunk) for chunk in self._chunks(operations)]
+
+    def _units(self):
+        """Split the queued operations into per-object units and the shared set operations
+
+        A unit holds every change to one address object, including its set
+        memberships, so it can be committed or rejected on its own. Nested set
+        references and set deletes are shared by all units.
+        """
+        units = {}
+        base = []
+        for operation, item in self._operations():
+            if operation in (self.ADD_ADDRESS, self.DELETE_ADDRESS):
+                units.setdefault(item[0], []).append((operation, item))
+            elif operation in (self.ADD_MEMBER, self.REMOVE_MEMBER):
+                units.setdefault(item[1], []).append((operation, item))
+            else:
+                base.append((operation, item))
+        return list(units.items()), base
+
+    def _needs_reference(self, base_operation, units):
+        """Return True if units add members to the set a queued nested set reference points to
+
+        The reference is committed together with the first members of a new
+        shard, so moved addresses never sit in a set the parent does not list.
+        Reference removals and set deletes wait for the last window.
+        """
+        operation, item = base_operation
+        if operation != self.ADD_SET_REFERENCE:
+            return False
+        return any(
+            member_operation == self.ADD_MEMBER and member_item[0] == item[1]
+            for _, operations in units for member_operation, member_item in operations
+        )
+
+    def _build_payload(self, chunk):
+        """Build one <edit-config> request for a chunk of operations"""
+        addresses = []
+        set_members = {}
+        # Deleting a set drops its members too; editing it afterwards would recreate it
+        deleted_sets = {item[0] for operation, item in chunk if operation == self.DELETE_SET}
+        for operation, item in chunk:
+            if operation == self.ADD_ADDRESS:
+                name, prefix = item
+                addresses.append(f"<address><name>{name}</name><ip-prefix>{prefix}</ip-prefix></address>")
+            elif operation == self.DELETE_ADDRESS:
+                addresses.append(f'<address operation="delete"><name>{item[0]}</name></address>')
+            elif operation == self.DELETE_SET:
+                addresses.append(f'<address-set operation="delete"><name>{item[0]}</name></address-set>')
+            elif item[0] not in deleted_sets:
+                set_name, name = item
+                attribute = ' operation="delete"' if operation in (self.REMOVE_MEMBER, self.REMOVE_SET_REFERENCE) else ""
+                element = "address" if operation in (self.ADD_MEMBER, self.REMOVE_MEMBER) else "address-set"
+                set_members.setdefault(set_name, []).append(f"<{element}{attribute}><name>{name}</name></{element}>")
+
+        address_sets = [
+            f"<address-set><name>{set_name}</name>{''.join(members)}</address-set>"
+            for set_name, members in set_members.items()
+        ]
+        return f"""
+    <edit-config>
+        <target>
+            <candidate/>
+        </target>
+        <config>
+            <configuration>
+                <security>
+                    <address-book>
+                        <name>{self.address_book_name}</name>
+                        {''.join(addresses)}
+                        {''.join(address_sets)}
+                    </address-book>
+                </security>
+            </configuration>
+        </config>
+    </edit-config>
+    """
+
+    @classmethod
+    def applied_groups(cls, results, current, desired):
+        """Return the prefixes on the device after a push, mapped to their group bitmasks
+
+        current and desired map prefixes to the bitmask of the group sets that
+        list them. An object whose changes all succeeded has its desired state,
+        one with a failed change keeps its current state.
+        """
+        failed = set()
+        for operation, item, success in results:
+            if success:
+                continue
+            if operation in (cls.ADD_ADDRESS, cls.DELETE_ADDRESS):
+                failed.add(item[0])
+            elif operation in (cls.ADD_MEMBER, cls.REMOVE_MEMBER):
+                failed.add(item[1])
+
+        applied = {}
+        for prefix in current.keys() | desired.keys():
+            state = current if address_object_name(prefix) in failed else desired
+            if prefix in state:
+                applied[prefix] = state[prefix]
+        return applied
+
+    def push(self, commit=True):
+        """Send all queued changes and commit them through the commit manager
+
+        Returns a list of (operation, item, success) tuples, one per queued change.
+        Changes are committed in windows of COMMIT_WINDOW_ITEMS; when a commit
+        check fails, the window is bisected so only the objects the device rejects
+        are reported as failed. With commit=False the changes are only loaded into
+        the candidate configuration.
+        """
+        if not commit:
+            results = []
+            for index, chunk in enumerate(self._chunks(self._operations()), start=1):
+                logging.info(f"Sending address change chunk {index} with {len(chunk)} items")
+                response = make_rpc_request(self._build_payload(chunk))
+                success = rpc_succeeded(response)
+                if not success and response is not None:
+                    logging.error(f"Failed to apply address change chunk {index}: {response.text}")
+                results.extend((operation, item, success) for operation, item in chunk)
+        else:
+            units, base = self._units()
+            logging.info(f"Committing {len(units)} address objects and {len(base)} set changes")
+            # Deleting a shard set is only safe once every unit has moved off it
+            failed = commit_manager_for().apply(
+                units, self._build_payloads, base=base, single_window=bool(self.items[self.DELETE_SET]),
+                ready=self._needs_reference,
+            )
+            results = [
+                (operation, item, key not in failed)
+                for key, operations in units for operation, item in operations
+            ]
+            results.extend((operation, item, None not in failed) for operation, item in base)
+
+        failed = sum(1 for _, _, success in results if not success)
+        logging.info(f"Address change set finished: {len(results) - failed} succeeded, {failed} failed")
+        for operation in self._OPERATION_ORDER:
+            self.items[operation] = []
+        return results
+
+
+class AddressBookSnapshot:
+    """In-memory index of the address objects and address sets of one address book"""
+
+    def __init__(self, addresses=None, address_sets=None, set_references=None):
+        self.addresses = addresses or {}
+        self.address_sets = address_sets or {}
+        self.set_references = set_references or {}
+
+    @classmethod
+    def from_records(cls, records, address_book_name="global"):
+        """Index the ConfigRecords of a streamed get-configuration reply"""
+        snapshot = cls()
+        for record in records:
+            if record.scope != address_book_name:
+                continue
+            if record.kind == "address":
+                snapshot.addresses[record.name] = record.value
+            elif record.kind == "set-member":
+                snapshot.address_sets.setdefault(record.name, set()).add(record.value)
+                snapshot.set_references.setdefault(record.name, set())
+            elif record.kind == "set-reference":
+                snapshot.set_references.setdefault(record.name, set()).add(record.value)
+                snapshot.address_sets.setdefault(record.name, set())
+        return snapshot
+
+    def managed_addresses(self):
+        """Address objects created by this tool, by name"""
+        return {
+            name: prefix for name, prefix in self.addresses.items()
+            if name and name.startswith(ADDRESS_NAME_PREFIX)
+        }
+
+    def managed_groups(self, address_sets):
+        """Managed prefixes mapped to the bitmask of the group sets in address_sets (bit -> set name) that list them"""
+        managed = self.managed_addresses()
+        groups = dict.fromkeys(managed.values(), 0)
+        for bit, address_set_name in address_sets.items():
+            for set_name, members in self.address_sets.items():
+                if not is_deny_set(set_name, address_set_name):
+                    continue
+                for name in members:
+                    if name in managed:
+                        groups[managed[name]] |= 1 << bit
+        return groups
+
+
+def fetch_address_book(address_book_name="global"):
+    """Fetch an address book with a single get-configuration and index it, None on failure
+
+    The committed configuration is read, since the candidate may still hold
+    changes of a push whose commit failed.
+    """
+    logging.info(f"Fetching address book snapshot: {address_book_name}")
+
+    xml_data = f"""
+    <get-configuration database="committed">
+        <configuration>
+            <security>
+                <address-book>
+                    <name>{address_book_name}</name>
+                </address-book>
+            </security>
+        </configuration>
+    </get-configuration>
+    """
+    response = make_rpc_request(xml_data, stream=True)
+    if response and response.status_code == 200:
+        try:
+            snapshot = AddressBookSnapshot.from_records(iter_response_records(response), address_book_name)
+        except Exception as e:
+            logging.error(f"Error parsing address book {address_book_name}: {str(e)}")
+            return None
+        logging.info(
+            f"Address book {address_book_name} holds {len(snapshot.addresses)} addresses "
+            f"and {len(snapshot.address_sets)} address sets"
+        )
+        return snapshot
+    else:
+        if response:
+            logging.error(f"Failed to fetch address book: {response.text}")
+        return None
+
+
+def as_group_masks(desired_prefixes):
+    """Map prefixes to group bitmasks; a plain collection of prefixes is all in the default group"""
+    if isinstance(desired_prefixes, dict):
+        return {as_prefix(prefix): groups for prefix, groups in desired_prefixes.items()}
+    return {as_prefix(prefix): 1 for prefix in desired_prefixes}
+
+
+def plan_group_set(change_set, address_set_name, current_members, current_shards, desired_names):
+    """Plan one group address set with plan_shards and return its shard count
+
+    A set that loses its last member is deleted, since an address set cannot
+    be empty.
+    """
+    count = plan_shards(change_set, address_set_name, current_members, current_shards, desired_names)
+    if not desired_names and (current_shards or any(current_members.values())):
+        change_set.delete_set(address_set_name)
+        logging.info(f"Address set {address_set_name} has no members left and is deleted")
+    return count
+
+
+def plan_group_sets(change_set, address_sets, current, desired, shard_counts):
+    """Queue the membership changes of the group address sets from the push history
+
+    address_sets maps group bits to set names, current and desired map
+    prefixes to group bitmasks. Only sets whose bit is in the XOR of an old and
+    new mask, or whose shard count has to change, are planned. Returns the
+    shard count of every set.
+    """
+    changed = 0
+    for prefix in current.keys() | desired.keys():
+        changed |= current.get(prefix, 0) ^ desired.get(prefix, 0)
+
+    counts = {}
+    for bit, address_set_name in address_sets.items():
+        mask = 1 << bit
+        desired_names = [address_object_name(prefix) for prefix, groups in desired.items() if groups & mask]
+        count = shard_counts.get(address_set_name)
+        if not changed & mask and count == shard_count(len(desired_names), count):
+            counts[address_set_name] = count
+            continue
+        current_names = [address_object_name(prefix) for prefix, groups in current.items() if groups & mask]
+        current_members, current_shards = members_from_history(address_set_name, current_names, count)
+        counts[address_set_name] = plan_group_set(change_set, address_set_name, current_members, current_shards, desired_names)
+    return counts
+
+
+def plan_reconcile(snapshot, desired_prefixes, address_sets=None, change_set=None):
+    """Queue the exact changes that turn the device address book into the desired state
+
+    desired_prefixes maps prefixes to the bitmask of the group sets that should
+    list them (a plain collection puts every prefix in the default set) and
+    address_sets maps each group bit to its set name. Managed objects that are
+    not desired are removed from every other set that references them and
+    deleted; desired prefixes that are missing or point to a different prefix
+    are (re)created. Membership of each group set is spread over shard sets,
+    moving as few members as possible.
+    Returns the change set and the shard count of every group set.
+    """
+    change_set = change_set if change_set is not None else AddressChangeSet()
+    address_sets = address_sets or {0: DENY_ADDRESS_SET_NAME}
+    managed = snapshot.managed_addresses()
+    masks = as_group_masks(desired_prefixes)
+    desired = {address_object_name(prefix): prefix for prefix in masks}
+
+    def is_group_set(set_name):
+        return any(is_deny_set(set_name, address_set_name) for address_set_name in address_sets.values())
+
+    for name, prefix in managed.items():
+        if name not in desired:
+            for set_name, members in snapshot.address_sets.items():
+                if name in members and not is_group_set(set_name):
+                    change_set.remove_member(set_name, name)
+            change_set.delete_object(name, prefix)
+
+    for name, prefix in desired.items():
+        if managed.get(name) != prefix:
+            change_set.add_object(name, prefix)
+
+    shard_counts = {}
+    for bit, address_set_name in address_sets.items():
+        current_members = {
+            set_name: {name for name in members if name.startswith(ADDRESS_NAME_PREFIX)}
+            for set_name, members in snapshot.address_sets.items()
+            if is_deny_set(set_name, address_set_name)
+        }
+        current_shards = snapshot.set_references.get(address_set_name, set())
+        desired_names = [address_object_name(prefix) for prefix, groups in masks.items() if groups & (1 << bit)]
+        shard_counts[address_set_name] = plan_group_set(
+            change_set, address_set_name, current_members, current_shards, desired_names
+        )
+
+    logging.info(f"Reconcile plan for {', '.join(address_sets.values())}: {len(change_set)} changes")
+    return change_set, shard_counts
@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from api.metrics import COMMIT_DURATION
+from .devices import current_device
+from .utils import make_rpc_request, rpc_succeeded
+from config import COMMIT_WINDOW_ITEMS, COMMIT_WINDOW_SECONDS
+
+COMMIT_RPC = "<commit-configuration/>"
+COMMIT_CHECK_RPC = "<commit-configuration><check/></commit-configuration>"
+ROLLBACK_RPC = '<load-configuration rollback="0"/>'
+
+
+def commit_check():
+    """Validate the candidate configuration without activating it"""
+    response = make_rpc_request(COMMIT_CHECK_RPC)
+    if rpc_succeeded(response):
+        return True
+    if response is not None:
+        logging.warning(f"Commit check failed: {response.text}")
+    return False
+
+
+def rollback_candidate():
+    """Discard all uncommitted changes by reloading the active configuration"""
+    response = make_rpc_request(ROLLBACK_RPC)
+    if rpc_succeeded(response):
+        return True
+    if response is not None:
+        logging.error(f"Failed to roll back the candidate configuration: {response.text}")
+    return False
+
+
+class CommitManager:
+    """Coalesce configuration changes into few commits and isolate the ones the device rejects
+
+    Helpers that edit the candidate one object at a time call request_commit(),
+    which only commits once max_items edits are pending or the oldest pending
+    edit is max_seconds old; flush() commits whatever is left. Batches of units
+    passed to apply() are loaded in windows of the same size, validated with a
+    commit check and, if the check fails, bisected down to the failing units so
+    the rest can still be committed.
+    """
+
+    def __init__(self, name="SRX", max_items=COMMIT_WINDOW_ITEMS, max_seconds=COMMIT_WINDOW_SECONDS):
+        self.name = name
+        self.max_items = max(1, max_items)
+        self.max_seconds = max_seconds
+        self.pending = 0
+        self.pending_since = None
+        self.commits = 0
+        self.checks = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        """Commit the candidate configuration now"""
+        logging.info("Committing configuration changes")
+        self.commits += 1
+        with COMMIT_DURATION.time(device=current_device().name):
+            response = make_rpc_request(COMMIT_RPC)
+        self.pending = 0
+        self.pending_since = None
+        if rpc_succeeded(response):
+            logging.info("Successfully committed configuration")
+            return True
+        if response is not None:
+            logging.error(f"Failed to commit configuration: {response.text}")
+        return False
+
+    def request_commit(self):
+        """Record one edit in the candidate and commit if the window is full"""
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.max_items or time.monotonic() - self.pending_since >= self.max_seconds:
+            return self.commit()
+        return True
+
+    def flush(self):
+        """Commit any edits still waiting for their window to close"""
+        if not self.pending:
+            return True
+        return self.commit()
+
+    def _load(self, payloads):
+        """Send edit-config payloads to the candidate, stopping at the first rejected one"""
+        for payload in payloads:
+            response = make_rpc_request(payload)
+            if not rpc_succeeded(response):
+                if response is not None:
+                    logging.warning(f"Candidate rejected a configuration change: {response.text}")
+                return False
+        return True
+
+    def _trial(self, base, units, build_payloads, rollback_first=True):
+        """Load base plus units into a clean candidate and report whether it passes a commit check"""
+        if rollback_first:
+            self.rollbacks += 1
+            if not rollback_candidate():
+                return None
+        operations = list(base)
+        for _, unit_operations in units:
+            operations.extend(unit_operations)
+        if not self._load(build_payloads(operations)):
+            return False
+        self.checks += 1
+        return commit_check()
+
+    def _find_failing(self, base, units, build_payloads):
+        """Bisect units whose trial failed, returning the keys of the units that fail on their own"""
+        if len(units) == 1:
+            return [units[0][0]]
+        middle = len(units) // 2
+        failing = []
+        for half in (units[:middle], units[middle:]):
+            passed = self._trial(base, half, build_payloads)
+            if passed is None:
+                return [key for key, _ in units]
+            if not passed:
+                failing.extend(self._find_failing(base, half, build_payloads))
+        return failing
+
+    def _apply_window(self, base, units, build_payloads):
+        """Commit one window of units, returning the keys that were not committed
+
+        The key None stands for the base operations.
+        """
+        keys = [key for key, _ in units] + ([None] if base else [])
+        passed = self._trial(base, units, build_payloads, rollback_first=False)
+        if passed:
+            return [] if self.commit() else keys
+        if passed is None:
+            return keys
+
+        logging.warning(f"Commit check failed for {len(units)} changes, bisecting to find the rejected ones")
+        checks = self.checks
+        failing = self._find_failing(base, units, build_payloads) if units else []
+        good = [unit for unit in units if unit[0] not in set(failing)]
+        logging.warning(f"Isolated {len(failing)} rejected changes with {self.checks - checks} commit checks")
+
+        if (good or base) and self._trial(base, good, build_payloads) and self.commit():
+            return failing
+        self.rollbacks += 1
+        rollback_candidate()
+        return keys
+
+    def apply(self, units, build_payloads, base=(), single_window=False, ready=None):
+        """Load, check and commit units in windows
+
+        units is a list of (key, operations) pairs that can be applied independently
+        of each other and build_payloads turns a list of operations into
+        edit-config payloads. base holds the operations the units rely on, such
+        as nested set references. ready(operation, window) tells whether a base
+        operation is needed by a window of units; such operations are loaded with
+        the first window that needs them, and again with the next window if that
+        one is not committed. The rest of base is loaded with the last window, or
+        with every unit when single_window is set. Returns the set of keys whose
+        changes were not committed, including None if the base was not.
+        """
+        if not self.flush():
+            return {key for key, _ in units} | ({None} if base else set())
+
+        windows = []
+        window = []
+        items = 0
+        for unit in units:
+            window.append(unit)
+            items += len(unit[1])
+            if not single_window and items >= self.max_items:
+                windows.append(window)
+                window = []
+                items = 0
+        if window or not windows:
+            windows.append(window)
+
+        failed = set()
+        waiting = list(base)
+        carried = []
+        for index, window in enumerate(windows):
+            last = index == len(windows) - 1
+            if last:
+                window_base = carried + waiting
+            else:
+                needed = [operation for operation in waiting if ready and ready(operation, window)]
+                waiting = [operation for operation in waiting if operation not in needed]
+                window_base = carried + needed
+            if not window and not (last and window_base):
+                continue
+            window_failed = set(self._apply_window(window_base, window, build_payloads))
+            carried = window_base if None in window_failed and not last else []
+            if not last:
+                window_failed.discard(None)
+            failed.update(window_failed)
+        return failed
+
+    def log_stats(self):
+        """Log how many commits, commit checks and rollbacks were sent"""
+        logging.info(f"{self.name} commits: {self.commits} commits, {self.checks} commit checks, {self.rollbacks} rollbacks")
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def commit_manager_for(device=None):
+    """Return the commit manager of device, or of the device selected for the calling thread"""
+    device = device or current_device()
+    with _managers_lock:
+        manager = _managers.get(device.name)
+        if manager is None:
+            manager = _managers[device.name] = CommitManager(f"Device {device.name}")
+        return manager
+
+
+def log_commit_stats():
+    """Log the commit counters of every device"""
+    with _managers_lock:
+        managers = sorted(_managers.items())
+    for _, manager in managers:
+        manager.log_stats()
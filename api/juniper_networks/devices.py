@@ -0,0 +1,94 @@
+"""
+SRX Device Inventory
+
+Builds the list of SRX devices from the DEVICES setting and runs work against
+all of them with bounded parallelism. The device a thread is working on is kept
+in a thread-local, so make_rpc_request and the commit manager pick it up without
+every helper taking a device argument.
+"""
+import base64
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from config import DEVICES, DEVICE_PUSH_WORKERS
+
+Device = namedtuple("Device", ["name", "url", "headers"])
+
+_current = threading.local()
+
+
+def make_device(entry):
+    """Build a Device from one DEVICES entry"""
+    auth_string = f"{entry.get('user', '')}:{entry.get('password', '')}"
+    auth_base64 = base64.b64encode(auth_string.encode()).decode()
+    headers = {
+        "Authorization": f"Basic {auth_base64}",
+        "Content-Type": "application/xml",
+        "Accept": "application/xml"
+    }
+    scheme = entry.get("scheme", "http")
+    return Device(entry["name"], f"{scheme}://{entry['host']}:{entry['port']}/rpc", headers)
+
+
+def load_devices(entries=DEVICES):
+    """Build the device inventory, rejecting duplicate names"""
+    devices = [make_device(entry) for entry in entries]
+    names = [device.name for device in devices]
+    if len(set(names)) != len(names):
+        raise ValueError("Device names in DEVICES must be unique")
+    return devices
+
+
+devices = load_devices()
+default_device = devices[0] if devices else None
+
+
+def current_device():
+    """Return the device the calling thread works on, the first device by default"""
+    return getattr(_current, "device", None) or default_device
+
+
+@contextmanager
+def use_device(device):
+    """Direct the RPCs of the calling thread to device for the duration of the block"""
+    previous = getattr(_current, "device", None)
+    _current.device = device
+    try:
+        yield device
+    finally:
+        _current.device = previous
+
+
+def fan_out(func, targets=None, workers=DEVICE_PUSH_WORKERS):
+    """Run func(device) for every device on a bounded thread pool
+
+    Each call runs with its device selected by use_device(), so a slow or
+    unreachable device only holds up its own worker. Returns a dict mapping the
+    device name to func's return value, or to the exception it raised.
+    """
+    targets = devices if targets is None else targets
+    results = {}
+    if not targets:
+        return results
+
+    def run(device):
+        started = time.monotonic()
+        with use_device(device):
+            try:
+                return func(device)
+            finally:
+                logging.info(f"Device {device.name} finished in {time.monotonic() - started:.1f}s")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as executor:
+        futures = {executor.submit(run, device): device for device in targets}
+        for future in as_completed(futures):
+            device = futures[future]
+            try:
+                results[device.name] = future.result()
+            except Exception as e:
+                logging.error(f"Device {device.name} failed: {str(e)}")
+                results[device.name] = e
+    return results
@@ -0,0 +1,123 @@
+"""
+Streaming Configuration Parser
+
+Reads get-configuration replies from the SRX REST API incrementally. The
+multipart envelope is stripped as the bytes arrive and the XML is parsed with a
+pull parser; every address, address-set member and policy is yielded as a
+record and its element is dropped right away, so large address books are never
+held in memory as a whole.
+"""
+from collections import namedtuple
+import xml.etree.ElementTree as ET
+
+CHUNK_SIZE = 64 * 1024
+
+# kind is "address", "set-member", "set-reference" or "policy". For addresses
+# scope is the address book and value the ip-prefix; for set members and
+# references scope is the address book, name the set and value the member; for
+# policies scope is the (from_zone, to_zone) pair and value is None.
+ConfigRecord = namedtuple("ConfigRecord", ["kind", "scope", "name", "value"])
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child_text(element, tag):
+    """Text of the first tag child of element, in the namespace of element"""
+    if element.tag[0] == "{":
+        tag = element.tag[:element.tag.index("}") + 1] + tag
+    return element.findtext(tag)
+
+
+def iter_xml_chunks(chunks):
+    """Yield the XML payload of a (possibly multipart) reply from a stream of byte chunks
+
+    A multipart reply starts with its boundary line; everything up to the first
+    "<" is envelope and the payload ends at the next boundary.
+    """
+    buffer = b""
+    boundary = None
+    chunks = iter(chunks)
+
+    for chunk in chunks:
+        buffer += chunk
+        start = buffer.find(b"<")
+        if start == -1:
+            continue
+        if buffer.startswith(b"--"):
+            boundary = b"\n" + buffer[:buffer.find(b"\n")].strip()
+        buffer = buffer[start:]
+        break
+    else:
+        return
+
+    if boundary is None:
+        if buffer:
+            yield buffer
+        yield from chunks
+        return
+
+    # Hold back enough bytes to recognise a boundary split across two chunks
+    keep = len(boundary)
+    while True:
+        end = buffer.find(boundary)
+        if end != -1:
+            yield buffer[:end]
+            return
+        if len(buffer) > keep:
+            yield buffer[:-keep]
+            buffer = buffer[-keep:]
+        chunk = next(chunks, None)
+        if chunk is None:
+            yield buffer
+            return
+        buffer += chunk
+
+
+def iter_config_records(chunks):
+    """Parse a get-configuration reply lazily and yield ConfigRecords"""
+    parser = ET.XMLPullParser(events=("start", "end"))
+    stack = []
+    for data in iter_xml_chunks(chunks):
+        parser.feed(data)
+        for event, element in parser.read_events():
+            if event == "start":
+                stack.append(element)
+                continue
+
+            stack.pop()
+            tag = _local_name(element.tag)
+            parent = stack[-1] if stack else None
+            parent_tag = _local_name(parent.tag) if parent is not None else None
+            record = None
+
+            if tag == "address" and parent_tag == "address-book":
+                record = ConfigRecord("address", _child_text(parent, "name"), _child_text(element, "name"),
+                                      _child_text(element, "ip-prefix"))
+            elif tag == "address" and parent_tag == "address-set":
+                book = _child_text(stack[-2], "name") if len(stack) > 1 else None
+                record = ConfigRecord("set-member", book, _child_text(parent, "name"), _child_text(element, "name"))
+            elif tag == "address-set" and parent_tag == "address-set":
+                book = _child_text(stack[-2], "name") if len(stack) > 1 else None
+                record = ConfigRecord("set-reference", book, _child_text(parent, "name"), _child_text(element, "name"))
+            elif tag == "policy" and parent_tag == "policy":
+                zones = (_child_text(parent, "from-zone-name"), _child_text(parent, "to-zone-name"))
+                record = ConfigRecord("policy", zones, _child_text(element, "name"), None)
+
+            if record is not None:
+                yield record
+            if record is not None or tag in ("address-set", "address-book", "policy"):
+                # Drop the finished subtree; name children of open parents stay
+                element.clear()
+                if parent is not None:
+                    parent.remove(element)
+    parser.close()
+
+
+def iter_response_records(response, chunk_size=CHUNK_SIZE):
+    """Stream the records of a requests response and close it afterwards"""
+    try:
+        yield from iter_config_records(response.iter_content(chunk_size))
+    finally:
+        response.close()
@@ -0,0 +1,113 @@
+"""
+Deny Set Sharding
+
+Spreads the members of the deny address set over numbered shard sets
+(test-deny-set-0, test-deny-set-1, ...) that are nested in the parent set the
+policy refers to. Members are assigned with a jump consistent hash, so growing
+or shrinking the shard count only moves the members that have to move.
+"""
+import hashlib
+import logging
+import math
+import re
+from collections import Counter
+from config import ADDRESS_SET_MAX_MEMBERS, ADDRESS_SET_FILL_FACTOR, ADDRESS_SET_SHRINK_FACTOR
+
+
+def shard_set_name(address_set_name, index):
+    return f"{address_set_name}-{index}"
+
+
+def is_deny_set(set_name, address_set_name):
+    """True for the parent deny set and its shard sets"""
+    return set_name == address_set_name or re.fullmatch(re.escape(address_set_name) + r"-\d+", set_name or "") is not None
+
+
+def shard_count(member_count, current=None):
+    """Number of shards needed to keep every shard below the member limit
+
+    With the current count the shards grow as soon as they are full but only
+    shrink once the members fit in fewer shards at ADDRESS_SET_SHRINK_FACTOR
+    of the fill capacity, so a count near a boundary does not flap.
+    """
+    if member_count <= 0:
+        return 0
+    capacity = max(1, int(ADDRESS_SET_MAX_MEMBERS * ADDRESS_SET_FILL_FACTOR))
+    needed = math.ceil(member_count / capacity)
+    if not current or needed > current:
+        return needed
+    return max(needed, min(current, math.ceil(member_count / (capacity * ADDRESS_SET_SHRINK_FACTOR))))
+
+
+def layout_count(address_set_name, shard_sets):
+    """Shard count of an existing layout, judged by its highest shard index"""
+    indexes = [
+        int(name.rsplit("-", 1)[1]) for name in shard_sets
+        if name != address_set_name and is_deny_set(name, address_set_name)
+    ]
+    return max(indexes) + 1 if indexes else None
+
+
+def shard_index(name, count):
+    """Jump consistent hash of an address name into count shards"""
+    key = int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "big")
+    bucket, candidate = -1, 0
+    while candidate < count:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def members_from_history(address_set_name, names, count):
+    """Rebuild the deny set layout that a previous run pushed
+
+    count is the shard count recorded for that run, None if the members were
+    pushed straight into the parent set. Returns (members by set, shard sets).
+    """
+    if count is None:
+        return {address_set_name: set(names)}, set()
+    members = {}
+    for name in names:
+        members.setdefault(shard_set_name(address_set_name, shard_index(name, count)), set()).add(name)
+    return members, set(members)
+
+
+def plan_shards(change_set, address_set_name, current_members, current_shards, desired_names):
+    """Queue the membership changes that move the deny set to its sharded layout
+
+    current_members maps the parent and shard set names to the managed members
+    they hold now, current_shards are the shard sets nested in the parent.
+    Returns the new shard count.
+    """
+    count = shard_count(len(desired_names), layout_count(address_set_name, current_shards | set(current_members)))
+    target = {name: shard_set_name(address_set_name, shard_index(name, count)) for name in desired_names}
+    sizes = Counter(target.values())
+    # The hash is not perfectly even; add shards until none is over the limit
+    while sizes and max(sizes.values()) > ADDRESS_SET_MAX_MEMBERS and count < len(desired_names):
+        count += 1
+        target = {name: shard_set_name(address_set_name, shard_index(name, count)) for name in desired_names}
+        sizes = Counter(target.values())
+    # An address set cannot be empty, so shards without members are left out
+    wanted_shards = set(target.values())
+
+    moved = 0
+    for set_name, members in current_members.items():
+        for name in members:
+            if target.get(name) != set_name:
+                change_set.remove_member(set_name, name)
+                moved += name in target
+    for name, set_name in target.items():
+        if name not in current_members.get(set_name, ()):
+            change_set.add_member(set_name, name)
+
+    stale_shards = (current_shards | set(current_members)) - wanted_shards - {address_set_name}
+    for child in stale_shards:
+        if child in current_shards:
+            change_set.remove_set_reference(address_set_name, child)
+        change_set.delete_set(child)
+    for child in wanted_shards - current_shards:
+        change_set.add_set_reference(address_set_name, child)
+
+    logging.info(f"Deny set {address_set_name}: {len(target)} members in {count} shards, {moved} members moved")
+    return count
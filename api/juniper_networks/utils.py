@@ -1,24 +1,84 @@
 import logging
-import requests
+import threading
 from api.criminalip.manage_files import QueryData
-from config import VSRX_IP, VSRX_PORT, VSRX_HEADERS
+from api.http_client import request
+from api.metrics import RPC_LATENCY
+from api.retry import CircuitBreaker, RetryPolicy
+from api.juniper_networks.devices import current_device
+from config import SRX_RETRY_MAX_ATTEMPTS, SRX_RETRY_BUDGET, RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS
+from config import CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_SECONDS
+
+_retry_policies = {}
+_retry_policies_lock = threading.Lock()
+
+
+def srx_retry_for(device=None):
+    """Return the retry policy of device, or of the device selected for the calling thread
+
+    Every device has its own retry budget and circuit breaker, so an
+    unreachable device cannot use up the retries of the healthy ones.
+    """
+    device = device or current_device()
+    with _retry_policies_lock:
+        policy = _retry_policies.get(device.name)
+        if policy is None:
+            policy = _retry_policies[device.name] = RetryPolicy(
+                f"SRX RPC {device.name}",
+                max_attempts=SRX_RETRY_MAX_ATTEMPTS,
+                base_delay=RETRY_BASE_DELAY_SECONDS,
+                max_delay=RETRY_MAX_DELAY_SECONDS,
+                budget=SRX_RETRY_BUDGET,
+                breaker=CircuitBreaker(CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RESET_SECONDS),
+            )
+        return policy
+
+
+def srx_retry_policies():
+    """The retry policies of every device contacted so far"""
+    with _retry_policies_lock:
+        return [policy for _, policy in sorted(_retry_policies.items())]
+
 
 def load_queries(query_file_name):
     """Read the c2 detect query json file"""
     return QueryData.from_file(query_file_name)
 
-def make_rpc_request(rpc_xml):
-    """Make an RPC request to the vSRX REST API"""
-    url = f"http://{VSRX_IP}:{VSRX_PORT}/rpc"
-    logging.info(f"Making RPC request to {url}")
-    
+def make_rpc_request(rpc_xml, stream=False, device=None):
+    """Make an RPC request to the vSRX REST API
+
+    With stream=True the reply body is not read up front, so large replies can be
+    parsed incrementally from response.iter_content(). The request goes to
+    device, or to the device selected for the calling thread.
+    """
+    device = device or current_device()
+    url = device.url
+
+    def send():
+        with RPC_LATENCY.time(device=device.name):
+            return request(f"srx-{device.name}", "POST", url, headers=device.headers, data=rpc_xml, verify=False, stream=stream)
+
     try:
-        response = requests.post(url, headers=VSRX_HEADERS, data=rpc_xml, verify=False)
-        logging.info(f"Response status: {response.status_code}")
+        response = srx_retry_for(device).call(
+            send,
+            key=url,
+            retry_if=lambda response: response.status_code >= 500,
+        )
+        logging.debug(f"RPC to {url} answered {response.status_code}")
         return response
     except Exception as e:
         logging.error(f"API request failed: {str(e)}")
         return None
 
 
-   
\ No newline at end of file
+def rpc_succeeded(response, status_codes=(200, 201, 204)):
+    """Return True if an RPC reply has a success status and reports no errors
+
+    The device can answer a rejected change with a success status and an
+    <xnm:error> or <rpc-error> element in the body, so the body is checked too.
+    """
+    if response is None or response.status_code not in status_codes:
+        return False
+    text = response.text or ""
+    if "<xnm:error" in text:
+        return False
+    return "<rpc-error" not in text or "<error-severity>error</error-severity>" not in text
@@ -0,0 +1,113 @@
+"""
+Logging Pipeline
+
+Log records are put on an in-memory queue by the calling thread and written by
+a single listener thread, so crawler and RPC threads never wait on file I/O.
+The file is rotated by size and every line is one JSON object; values passed
+with extra= are written as fields of their own. DEBUG records, which carry the
+per-page detail, can be sampled so a debug run does not produce gigabytes.
+"""
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class PlainQueueHandler(QueueHandler):
+    """QueueHandler that leaves the message and the traceback apart for the formatter"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DebugSampler(logging.Filter):
+    """Let through every record above DEBUG and a sample_rate share of DEBUG records"""
+
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.sample_rate
+
+
+def setup_logging(path, level="INFO", max_bytes=50 * 2 ** 20, backup_count=10, json_format=True, debug_sample_rate=0.0):
+    """Route the root logger through a queue to a size-rotated file at path
+
+    A debug_sample_rate above 0 enables DEBUG records and keeps that share of
+    them. Calling it again replaces the previous setup.
+    """
+    global _listener
+    stop_logging()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    if json_format:
+        file_handler.setFormatter(JSONFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+
+    records = queue.SimpleQueue()
+    queue_handler = PlainQueueHandler(records)
+    if debug_sample_rate > 0:
+        level = logging.DEBUG
+        queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = QueueListener(records, file_handler)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Write out the queued records and close the log file"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+atexit.register(stop_logging)
@@ -0,0 +1,204 @@
+"""
+Run Metrics
+
+In-process counters, gauges and histograms for the crawl, merge and SRX push,
+rendered in the Prometheus text exposition format. After each run the metrics
+are written to a node-exporter textfile; long-running processes can also serve
+them over HTTP.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def _samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, (), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self):
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state["buckets"]):
+                yield f"{self.name}_bucket", key, (("le", _format_value(bound)),), count
+            yield f"{self.name}_sum", key, (), state["sum"]
+            yield f"{self.name}_count", key, (), state["count"]
+
+
+STAGE_DURATION = Gauge("cip_autoblock_stage_duration_seconds", "Duration of the last run of each pipeline stage")
+RUN_DURATION = Gauge("cip_autoblock_run_duration_seconds", "Duration of the last complete run")
+LAST_RUN = Gauge("cip_autoblock_last_run_timestamp_seconds", "Unix time the last run finished")
+API_REQUESTS = Counter("cip_autoblock_api_requests_total", "Criminal IP search requests by HTTP status")
+API_LATENCY = Histogram("cip_autoblock_api_request_duration_seconds", "Latency of Criminal IP search requests")
+RPC_LATENCY = Histogram("cip_autoblock_rpc_duration_seconds", "Latency of SRX RPC requests")
+COMMIT_DURATION = Histogram("cip_autoblock_commit_duration_seconds", "Duration of SRX configuration commits")
+RETRY_EVENTS = Gauge("cip_autoblock_retry_events", "Calls, retries, failures and circuit trips of each retry policy")
+QUERY_MISSED_RESULTS = Gauge("cip_autoblock_query_missed_results", "Results of a query still beyond the offset cap after partitioning")
+BLOCKLIST_IPS = Gauge("cip_autoblock_ips", "IPs by state after the last merge")
+ALLOWLISTED_IPS = Gauge("cip_autoblock_allowlisted_ips", "Crawled IPs of the current day kept off the blocklist by each allowlist source")
+DEVICE_FAILED_CHANGES = Gauge("cip_autoblock_device_failed_changes", "Changes not applied on each device in the last run")
+
+
+@contextmanager
+def timed_stage(stage, **labels):
+    """Record the duration of the with block as the duration of stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.set(duration, stage=stage, **labels)
+        logging.info(f"Stage {stage} took {duration:.2f}s")
+
+
+def record_retry_stats(policy):
+    """Export the counters of a RetryPolicy"""
+    stats = policy.stats()
+    for event in ("calls", "retries", "failures", "circuit_trips"):
+        RETRY_EVENTS.set(stats[event], policy=policy.name, event=event)
+
+
+def render_metrics():
+    """Render every metric in the Prometheus text exposition format"""
+    with _lock:
+        metrics = list(_metrics)
+        lines = []
+        for metric in metrics:
+            if metric.values:
+                lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """Write the metrics for the node-exporter textfile collector atomically"""
+    directory = os.path.dirname(path) or "."
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".prom")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(render_metrics())
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError as e:
+        logging.error(f"Could not write metrics to {path}: {str(e)}")
+        return False
+    logging.info(f"Wrote metrics to {path}")
+    return True
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    server_version = "CIPMetrics/1.0"
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics {self.address_string()} - {format % args}")
+
+
+def start_metrics_server(host, port):
+    """Serve /metrics from a background thread and return the server"""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
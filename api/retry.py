@@ -0,0 +1,152 @@
+"""
+Retry Engine
+
+Bounded retries with exponential backoff and full jitter, a per-run retry budget
+and a per-key circuit breaker. Used by the Criminal IP crawler and the SRX RPC
+client so that a flapping endpoint costs a bounded amount of time per run.
+"""
+import logging
+import random
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is refused because its circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Open a circuit for a key after failure_threshold consecutive failures"""
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = {}
+        self.open_until = {}
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        with self.lock:
+            until = self.open_until.get(key)
+            if until is None:
+                return True
+            if time.monotonic() >= until:
+                # Half-open: let one attempt through, a failure re-opens the circuit
+                del self.open_until[key]
+                self.failures[key] = self.failure_threshold - 1
+                return True
+            return False
+
+    def is_open(self, key):
+        with self.lock:
+            until = self.open_until.get(key)
+            return until is not None and time.monotonic() < until
+
+    def record_success(self, key):
+        with self.lock:
+            self.failures.pop(key, None)
+
+    def record_failure(self, key):
+        with self.lock:
+            count = self.failures.get(key, 0) + 1
+            self.failures[key] = count
+            if count >= self.failure_threshold and key not in self.open_until:
+                self.open_until[key] = time.monotonic() + self.reset_seconds
+                self.trips += 1
+                logging.error(f"Circuit opened for {key} after {count} consecutive failures")
+
+
+class RetryPolicy:
+    """Run a callable with bounded, jittered exponential backoff"""
+
+    def __init__(self, name, max_attempts, base_delay, max_delay, budget=None, breaker=None):
+        self.name = name
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = 0
+            self.retries = 0
+            self.failures = 0
+            self.retry_seconds = 0.0
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def _take_retry(self):
+        with self.lock:
+            if self.budget is not None and self.retries >= self.budget:
+                return False
+            self.retries += 1
+            return True
+
+    def call(self, func, key=None, retry_on=(Exception,), retry_if=None):
+        """Call func until it succeeds or the attempts, budget or circuit run out
+
+        retry_on lists the exceptions that trigger a retry. retry_if may inspect a
+        returned value and ask for a retry; after the last attempt that value is
+        returned as is. Exceptions are re-raised once no retry is left.
+        """
+        key = key if key is not None else self.name
+        with self.lock:
+            self.calls += 1
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker and not self.breaker.allow(key):
+                raise CircuitOpenError(f"Circuit open for {key}")
+
+            started = time.monotonic()
+            try:
+                result = func()
+            except retry_on as err:
+                failure, error = None, err
+            else:
+                if retry_if is None or not retry_if(result):
+                    if self.breaker:
+                        self.breaker.record_success(key)
+                    return result
+                failure, error = result, None
+
+            if self.breaker:
+                self.breaker.record_failure(key)
+            logging.error(
+                f"{self.name} attempt {attempt}/{self.max_attempts} for {key} failed: "
+                f"{type(error).__name__ + ': ' + str(error) if error else failure}"
+            )
+            with self.lock:
+                self.retry_seconds += time.monotonic() - started
+            if attempt == self.max_attempts or not self._take_retry():
+                with self.lock:
+                    self.failures += 1
+                if error is not None:
+                    raise error
+                return failure
+
+            delay = self._backoff(attempt)
+            time.sleep(delay)
+            with self.lock:
+                self.retry_seconds += delay
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "retry_seconds": round(self.retry_seconds, 3),
+                "circuit_trips": self.breaker.trips if self.breaker else 0,
+            }
+
+    def log_stats(self):
+        counters = self.stats()
+        logging.info(
+            f"Retry stats for {self.name}: {counters['calls']} calls, {counters['retries']} retries, "
+            f"{counters['failures']} failures, {counters['retry_seconds']}s spent retrying, "
+            f"{counters['circuit_trips']} circuit trips"
+        )
@@ -0,0 +1,59 @@
+"""
+Interval Scheduler
+
+Runs named jobs at fixed intervals on the calling thread until stopped. Jobs
+never overlap; a job that overruns its interval runs again as soon as it is
+due instead of queueing missed runs. stop() may be called from a signal
+handler: the running job is allowed to finish and no further job starts.
+"""
+import logging
+import threading
+import time
+
+
+class Job:
+    def __init__(self, name, interval, func, next_run):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.next_run = next_run
+        self.runs = 0
+        self.failures = 0
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+        self.stopped = threading.Event()
+
+    def add_job(self, name, interval, func, delay=0):
+        """Run func every interval seconds, the first time after delay seconds"""
+        self.jobs.append(Job(name, interval, func, time.monotonic() + delay))
+
+    def stop(self):
+        self.stopped.set()
+
+    def run_job(self, job):
+        """Run one job, logging instead of raising its errors"""
+        started = time.monotonic()
+        logging.info(f"Running scheduled job {job.name}")
+        try:
+            job.func()
+        except Exception as e:
+            job.failures += 1
+            logging.exception(f"Scheduled job {job.name} failed: {str(e)}")
+        job.runs += 1
+        finished = time.monotonic()
+        job.next_run = max(job.next_run + job.interval, finished)
+        logging.info(f"Job {job.name} finished in {finished - started:.1f}s, next run in {job.next_run - finished:.0f}s")
+
+    def run(self):
+        """Run due jobs until stop() is called"""
+        logging.info(f"Scheduler started with jobs: {', '.join(job.name for job in self.jobs)}")
+        while not self.stopped.is_set() and self.jobs:
+            job = min(self.jobs, key=lambda job: job.next_run)
+            wait = job.next_run - time.monotonic()
+            if wait > 0 and self.stopped.wait(wait):
+                break
+            self.run_job(job)
+        logging.info("Scheduler stopped")
@@ -0,0 +1,124 @@
+"""
+Mock Criminal IP API
+
+Local stand-in for GET /v1/banner/search. Every query holds a configurable
+number of results, served ten per page by offset like the real API. IPs are
+derived from the query and the result index, so the same query always returns
+the same addresses and different queries barely overlap. Results are served
+newest first, result_interval seconds apart, counting back from when the mock
+started, and after:/before: date filters narrow the results to that window. A share of the
+requests can be answered with 429 or 500 to exercise the rate limiter and the
+retry engine.
+"""
+import hashlib
+import ipaddress
+import json
+import math
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 10
+DATE_FILTER = re.compile(r"(after|before):\s*(\d{4}-\d{2}-\d{2}(?: \d{2}:\d{2}:\d{2})?)")
+
+
+class MockCriminalIP:
+    """Result generator and counters shared by all request handler threads"""
+
+    def __init__(self, results_per_query=1000, rate_limit_ratio=0.0, error_ratio=0.0, seed=0, result_interval=1.0):
+        self.results_per_query = results_per_query
+        self.result_interval = result_interval
+        self.rate_limit_ratio = rate_limit_ratio
+        self.error_ratio = error_ratio
+        self.random = random.Random(seed)
+        self.started = datetime.now().replace(microsecond=0)
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "pages": 0, "rate_limited": 0, "errors": 0}
+
+    def ip_address(self, query, index):
+        digest = hashlib.blake2b(f"{query}\0{index}".encode(), digest_size=4).digest()
+        # Keep the addresses in 1.0.0.0 - 223.255.255.255
+        value = 0x01000000 + int.from_bytes(digest, "big") % (0xE0000000 - 0x01000000)
+        return str(ipaddress.IPv4Address(value))
+
+    def search(self, query, offset):
+        """Return (status, payload) for one search request"""
+        with self.lock:
+            self.stats["requests"] += 1
+            roll = self.random.random()
+            if roll < self.rate_limit_ratio:
+                self.stats["rate_limited"] += 1
+                return 429, {"status": 429, "message": "Too Many Requests"}
+            if roll < self.rate_limit_ratio + self.error_ratio:
+                self.stats["errors"] += 1
+                return 500, {"status": 500, "message": "Internal Server Error"}
+            self.stats["pages"] += 1
+
+        first, last = self.window(query)
+        base_query = DATE_FILTER.sub("", query).strip()
+        start = first + offset
+        end = min(start + PAGE_SIZE, last + 1)
+        result = [
+            {
+                "ip_address": self.ip_address(base_query, index),
+                "scan_dtime": (self.started - timedelta(seconds=index * self.result_interval)).strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for index in range(start, end)
+        ]
+        count = max(0, last - first + 1)
+        return 200, {"status": 200, "data": {"count": count, "result": result}}
+
+    def window(self, query):
+        """First and last result index inside the after:/before: dates of query"""
+        first, last = 0, self.results_per_query - 1
+        for name, value in DATE_FILTER.findall(query):
+            seconds = (self.started - datetime.fromisoformat(value)).total_seconds()
+            if name == "after":
+                last = min(last, math.floor(seconds / self.result_interval))
+            else:
+                first = max(first, math.floor(seconds / self.result_interval) + 1 if seconds >= 0 else 0)
+        return first, last
+
+
+class MockCriminalIPRequestHandler(BaseHTTPRequestHandler):
+    server_version = "MockCriminalIP/1.0"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/v1/banner/search":
+            self.send_error(404)
+            return
+        params = parse_qs(url.query)
+        query = params.get("query", [""])[0]
+        try:
+            offset = int(params.get("offset", ["0"])[0])
+        except ValueError:
+            self.send_error(400, "Invalid offset")
+            return
+
+        status, payload = self.server.cip.search(query, offset)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_mock_cip(cip, host="127.0.0.1", port=0):
+    """Create a threaded HTTP server for cip; port 0 picks a free port"""
+    server = ThreadingHTTPServer((host, port), MockCriminalIPRequestHandler)
+    server.daemon_threads = True
+    server.cip = cip
+    return server
@@ -0,0 +1,191 @@
+"""
+Mock SRX REST API
+
+Local stand-in for the SRX /rpc endpoint. It keeps a candidate and a running
+configuration of address books, address sets and security policies, applies
+edit-config payloads to the candidate and validates it on commit the way the
+device does: address book and address set size limits, empty sets and members
+that reference missing objects are rejected with an <xnm:error> reply. Commits
+take a configurable time. get-configuration reads the candidate unless the
+committed database is asked for, like the device.
+"""
+import copy
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+
+class MockConfiguration:
+    def __init__(self):
+        # address book name -> {"addresses": {name: prefix}, "sets": {name: {"addresses": set, "sets": set}}}
+        self.address_books = {}
+        # (from_zone, to_zone) -> set of policy names
+        self.policies = {}
+
+    def book(self, name):
+        return self.address_books.setdefault(name, {"addresses": {}, "sets": {}})
+
+
+class MockSRX:
+    """Configuration state and counters shared by all request handler threads"""
+
+    def __init__(self, commit_latency=0.2, max_address_book_entries=262144, max_set_members=1024):
+        self.commit_latency = commit_latency
+        self.max_address_book_entries = max_address_book_entries
+        self.max_set_members = max_set_members
+        self.lock = threading.Lock()
+        self.running = MockConfiguration()
+        self.candidate = MockConfiguration()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"rpcs": 0, "edits": 0, "reads": 0, "commits": 0, "commit_checks": 0, "rollbacks": 0, "errors": 0}
+
+    def reset(self):
+        """Forget the configuration and the counters"""
+        with self.lock:
+            self.running = MockConfiguration()
+            self.candidate = MockConfiguration()
+            self.reset_stats()
+
+    def handle_rpc(self, body):
+        """Process one RPC and return the reply body"""
+        root = ET.fromstring(body)
+        tag = root.tag
+        with self.lock:
+            self.stats["rpcs"] += 1
+            if tag == "edit-config":
+                self.stats["edits"] += 1
+                self._apply_edit(root)
+                return "<rpc-reply><ok/></rpc-reply>"
+            if tag == "get-configuration":
+                self.stats["reads"] += 1
+                committed = root.get("database") == "committed"
+                return self._render(self.running if committed else self.candidate)
+            if tag == "load-configuration" and root.get("rollback") == "0":
+                self.stats["rollbacks"] += 1
+                self.candidate = copy.deepcopy(self.running)
+                return "<rpc-reply><ok/></rpc-reply>"
+            if tag == "commit-configuration":
+                check = root.find("check") is not None
+                self.stats["commit_checks" if check else "commits"] += 1
+                errors = self._validate(self.candidate)
+                if errors:
+                    self.stats["errors"] += 1
+                    messages = "".join(f"<xnm:error><message>{escape(error)}</message></xnm:error>" for error in errors[:10])
+                    return f'<rpc-reply xmlns:xnm="http://xml.juniper.net/xnm/1.1/xnm">{messages}</rpc-reply>'
+                if not check:
+                    time.sleep(self.commit_latency)
+                    self.running = copy.deepcopy(self.candidate)
+                return "<rpc-reply><ok/></rpc-reply>"
+        return None
+
+    def _apply_edit(self, root):
+        for book_element in root.iter("address-book"):
+            book = self.candidate.book(book_element.findtext("name"))
+            for element in book_element:
+                name = element.findtext("name")
+                delete = element.get("operation") == "delete"
+                if element.tag == "address":
+                    if delete:
+                        book["addresses"].pop(name, None)
+                    else:
+                        book["addresses"][name] = element.findtext("ip-prefix")
+                elif element.tag == "address-set":
+                    if delete:
+                        book["sets"].pop(name, None)
+                        continue
+                    address_set = book["sets"].setdefault(name, {"addresses": set(), "sets": set()})
+                    for member in element:
+                        if member.tag not in ("address", "address-set"):
+                            continue
+                        members = address_set["addresses" if member.tag == "address" else "sets"]
+                        if member.get("operation") == "delete":
+                            members.discard(member.findtext("name"))
+                        else:
+                            members.add(member.findtext("name"))
+
+        for zone_pair in root.iter("policies"):
+            for pair in zone_pair.findall("policy"):
+                zones = (pair.findtext("from-zone-name"), pair.findtext("to-zone-name"))
+                for policy in pair.findall("policy"):
+                    names = self.candidate.policies.setdefault(zones, set())
+                    if policy.get("operation") == "delete":
+                        names.discard(policy.findtext("name"))
+                    else:
+                        names.add(policy.findtext("name"))
+
+    def _validate(self, configuration):
+        errors = []
+        for book_name, book in configuration.address_books.items():
+            entries = len(book["addresses"]) + len(book["sets"])
+            if entries > self.max_address_book_entries:
+                errors.append(f"address-book {book_name}: {entries} entries exceed the limit of {self.max_address_book_entries}")
+            for set_name, address_set in book["sets"].items():
+                size = len(address_set["addresses"]) + len(address_set["sets"])
+                if size == 0:
+                    errors.append(f"address-set {set_name}: must have at least one member")
+                if size > self.max_set_members:
+                    errors.append(f"address-set {set_name}: {size} members exceed the limit of {self.max_set_members}")
+                for member in address_set["addresses"] - book["addresses"].keys():
+                    errors.append(f"address-set {set_name}: address {member} is not defined")
+                for member in address_set["sets"] - book["sets"].keys():
+                    errors.append(f"address-set {set_name}: address-set {member} is not defined")
+        return errors
+
+    def _render(self, configuration):
+        parts = ["<rpc-reply><configuration><security>"]
+        for book_name, book in configuration.address_books.items():
+            parts.append(f"<address-book><name>{escape(book_name)}</name>")
+            for name, prefix in book["addresses"].items():
+                parts.append(f"<address><name>{escape(name)}</name><ip-prefix>{prefix}</ip-prefix></address>")
+            for set_name, address_set in book["sets"].items():
+                parts.append(f"<address-set><name>{escape(set_name)}</name>")
+                parts.extend(f"<address><name>{escape(name)}</name></address>" for name in sorted(address_set["addresses"]))
+                parts.extend(f"<address-set><name>{escape(name)}</name></address-set>" for name in sorted(address_set["sets"]))
+                parts.append("</address-set>")
+            parts.append("</address-book>")
+        parts.append("<policies>")
+        for (from_zone, to_zone), names in configuration.policies.items():
+            parts.append(f"<policy><from-zone-name>{from_zone}</from-zone-name><to-zone-name>{to_zone}</to-zone-name>")
+            parts.extend(f"<policy><name>{escape(name)}</name></policy>" for name in sorted(names))
+            parts.append("</policy>")
+        parts.append("</policies></security></configuration></rpc-reply>")
+        return "".join(parts)
+
+
+class MockSRXRequestHandler(BaseHTTPRequestHandler):
+    server_version = "MockSRX/1.0"
+
+    def do_POST(self):
+        if self.path != "/rpc":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            reply = self.server.srx.handle_rpc(body)
+        except ET.ParseError as e:
+            self.send_error(400, f"Malformed RPC: {e}")
+            return
+        if reply is None:
+            self.send_error(400, "Unsupported RPC")
+            return
+        data = reply.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_mock_srx(srx, host="127.0.0.1", port=0):
+    """Create a threaded HTTP server for srx; port 0 picks a free port"""
+    server = ThreadingHTTPServer((host, port), MockSRXRequestHandler)
+    server.daemon_threads = True
+    server.srx = srx
+    return server
@@ -0,0 +1,190 @@
+"""
+End-to-end Benchmark
+
+Runs the Criminal IP crawl, the state store merge and the SRX push against the
+local mock servers for several blocklist sizes and reports wall time per stage,
+API calls, RPCs, commits and peak traced memory. Every size runs in a fresh
+interpreter with its own work directory, so module level state, the state store
+and the CSV files never leak from one run into the next.
+
+    python -m bench.run_bench --sizes 1000 10000 100000
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+
+from bench.mock_cip import MockCriminalIP, create_mock_cip
+from bench.mock_srx import MockSRX, create_mock_srx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def configure(workdir, cip_url, srx_port, queries, since):
+    """Point config at the mock servers and the work directory before the app is imported"""
+    import config
+
+    config.BASE_URL = cip_url
+    config.DEVICES = [{"name": "bench", "host": "127.0.0.1", "port": srx_port, "user": "bench", "password": "bench"}]
+    config.LOG_FILE_NAME = os.path.join(workdir, "bench.log")
+    config.QUERY_FILE_NAME = os.path.join(workdir, "queries.json")
+    config.CSV_FILE_PATTERN = os.path.join(workdir, "detect_IP_{date}.csv")
+    config.PREVIOUS_CSV_FILE_PATH = os.path.join(workdir, "previous_ip_addresses.csv")
+    config.TODAY_CSV_FILE_PATH = os.path.join(workdir, "today_ip_addresses.csv")
+    config.OUTPUT_FILE_PATTERN = os.path.join(workdir, "output_{date}.csv")
+    config.STATE_DB_PATH = os.path.join(workdir, "ip_state.db")
+    config.CRAWL_CACHE_DIR = os.path.join(workdir, "page_cache")
+    config.CIP_RATE_LIMIT_PER_SECOND = 1e9
+    config.CIP_RATE_LIMIT_BURST = 1000
+    config.RETRY_BASE_DELAY_SECONDS = 0.01
+    config.RETRY_MAX_DELAY_SECONDS = 0.1
+
+    with open(config.QUERY_FILE_NAME, "w") as query_file:
+        json.dump({"count": queries, "data": {f"bench-{i}": [f"tag: bench_{i} after: {since}"] for i in range(queries)}}, query_file)
+
+
+def run_child(args):
+    """Run the pipeline once in this interpreter and print the measurements as JSON"""
+    configure(args.workdir, args.cip_url, args.srx_port, args.queries, args.since)
+
+    import config
+    import main
+    from api.juniper_networks.devices import fan_out
+    from api.log_pipeline import setup_logging
+
+    setup_logging(config.LOG_FILE_NAME, config.LOG_LEVEL, config.LOG_MAX_BYTES, config.LOG_BACKUP_COUNT, config.LOG_JSON)
+
+    tracemalloc.start()
+    stages = {}
+    started = time.perf_counter()
+
+    stage_started = time.perf_counter()
+    queries = main.load_queries(config.QUERY_FILE_NAME)
+    main.crawl_queries(queries.data)
+    stages["crawl"] = time.perf_counter() - stage_started
+
+    stage_started = time.perf_counter()
+    new_ip_addresses, delete_ip_addresses, _ = main.merge_and_update_ip_addresses()
+    stages["merge"] = time.perf_counter() - stage_started
+
+    stage_started = time.perf_counter()
+    groups = main.category_groups(main.DENY_ADDRESS_SET_NAME, main.DENY_POLICY_NAME)
+    desired = main.desired_prefixes(None, groups)
+    results = fan_out(
+        lambda device: main.sync_device(device, new_ip_addresses, delete_ip_addresses, desired, False, groups)
+    )
+    stages["push"] = time.perf_counter() - stage_started
+
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    main.close_sessions()
+
+    print(json.dumps({
+        "wall": wall,
+        "stages": stages,
+        "peak_memory": peak,
+        "new_ips": len(new_ip_addresses),
+        "prefixes": len(desired),
+        "failed_changes": sum(result if isinstance(result, int) else 1 for result in results.values()),
+    }))
+
+
+def run_size(size, args, cip, srx, cip_port, srx_port):
+    """Run one benchmark size in a subprocess and combine its output with the mock counters"""
+    queries = max(1, math.ceil(size / args.results_per_query))
+    cip.results_per_query = math.ceil(size / queries)
+    # Start the after: filter early enough to include the oldest mock result
+    span = timedelta(seconds=cip.results_per_query * args.result_interval) + timedelta(days=1)
+    since = (cip.started - span).date().isoformat()
+    cip.reset_stats()
+    srx.reset()
+
+    with tempfile.TemporaryDirectory(prefix="cip-bench-") as workdir:
+        command = [
+            sys.executable, "-m", "bench.run_bench", "--child",
+            "--workdir", workdir, "--queries", str(queries), "--since", since,
+            "--cip-url", f"http://127.0.0.1:{cip_port}/", "--srx-port", str(srx_port),
+        ]
+        completed = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Benchmark run for {size} IPs failed:\n{completed.stderr}")
+
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result.update(size=size, queries=queries, api=dict(cip.stats), srx=dict(srx.stats))
+    return result
+
+
+def print_report(results):
+    header = (
+        f"{'IPs':>8} {'wall s':>8} {'crawl s':>8} {'merge s':>8} {'push s':>8} "
+        f"{'API calls':>9} {'429s':>5} {'RPCs':>6} {'commits':>7} {'checks':>6} {'peak MB':>8} {'failed':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        stages = result["stages"]
+        print(
+            f"{result['size']:>8} {result['wall']:>8.2f} {stages['crawl']:>8.2f} {stages['merge']:>8.2f} "
+            f"{stages['push']:>8.2f} {result['api']['requests']:>9} {result['api']['rate_limited']:>5} "
+            f"{result['srx']['rpcs']:>6} {result['srx']['commits']:>7} {result['srx']['commit_checks']:>6} "
+            f"{result['peak_memory'] / 2 ** 20:>8.1f} {result['failed_changes']:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the blocklist pipeline against local mock servers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="blocklist sizes to run")
+    parser.add_argument("--results-per-query", type=int, default=5000, help="results per mock query")
+    parser.add_argument("--result-interval", type=float, default=1.0, help="seconds between consecutive mock results")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.01, help="share of API requests answered with 429")
+    parser.add_argument("--error-ratio", type=float, default=0.005, help="share of API requests answered with 500")
+    parser.add_argument("--commit-latency", type=float, default=0.2, help="seconds a mock commit takes")
+    parser.add_argument("--max-address-book-entries", type=int, default=262144, help="mock address book size limit")
+    parser.add_argument("--max-set-members", type=int, default=1024, help="mock address set member limit")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--queries", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--since", help=argparse.SUPPRESS)
+    parser.add_argument("--cip-url", help=argparse.SUPPRESS)
+    parser.add_argument("--srx-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    cip = MockCriminalIP(
+        rate_limit_ratio=args.rate_limit_ratio, error_ratio=args.error_ratio, result_interval=args.result_interval
+    )
+    srx = MockSRX(args.commit_latency, args.max_address_book_entries, args.max_set_members)
+    cip_server = create_mock_cip(cip)
+    srx_server = create_mock_srx(srx)
+    for server in (cip_server, srx_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = []
+    try:
+        for size in args.sizes:
+            results.append(run_size(size, args, cip, srx, cip_server.server_address[1], srx_server.server_address[1]))
+            print(f"Finished {size} IPs in {results[-1]['wall']:.1f}s", file=sys.stderr)
+    finally:
+        cip_server.shutdown()
+        srx_server.shutdown()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,58 @@
 import base64
 from datetime import datetime, timedelta
 import os
+from api.ip_set import IPSet
 
 BASIC_PATH = os.path.dirname(os.path.abspath(__file__))
 
-# Time information
-now = datetime.now()
-date = now.strftime("%Y-%m-%d")
-yesterday = now - timedelta(days=1)
-yesterday_date = yesterday.strftime("%Y-%m-%d")
-SEVEN_DAYS_AGO = now - timedelta(days=7)
+# Time information (functions, so a process that stays up never works with a stale date)
+def current_date():
+    return datetime.now().strftime("%Y-%m-%d")
 
-# Logging information
-UPDATEDAY = str(now.strftime("%Y_%m_%d"))
-LOG_FILE_NAME = f"{BASIC_PATH}/log/{UPDATEDAY}_log_file.log"
+
+def yesterday_date():
+    return (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+# Blocklist Expiry (days after an IP was last seen, per query name in cip_c2_detect_query.json)
+DEFAULT_CATEGORY = "criminalip"
+DEFAULT_TTL_DAYS = 7
+CATEGORY_TTL_DAYS = {
+    # "Cobalt Strike": 14,
+    # "SSH Worm": 3,
+}
+
+# Logging information (JSON lines written from a background thread, rotated by size)
+LOG_FILE_NAME = f"{BASIC_PATH}/log/cip_autoblock.log"
+LOG_LEVEL = "INFO"
+LOG_JSON = True
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 10
+# Share of per-page DEBUG records kept; above 0 enables DEBUG logging
+LOG_DEBUG_SAMPLE_RATE = 0.0
+
+# Metrics (Prometheus textfile written after every run, empty to disable; port 0 disables the HTTP endpoint)
+METRICS_TEXTFILE_PATH = f"{BASIC_PATH}/log/cip_autoblock.prom"
+METRICS_HTTP_HOST = "127.0.0.1"
+METRICS_HTTP_PORT = 0
 
 # Important File Paths For Querying IPs and Record Keeping
 QUERY_FILE_NAME = f"{BASIC_PATH}/cip_c2_detect_query.json"
-CSV_FILE_PATH = f"{BASIC_PATH}/api/input/detect_IP_{date}.csv"
+CSV_FILE_PATTERN = f"{BASIC_PATH}/api/input/detect_IP_{{date}}.csv"
 PREVIOUS_CSV_FILE_PATH = f"{BASIC_PATH}/api/input/previous_ip_addresses.csv"
 TODAY_CSV_FILE_PATH =  f"{BASIC_PATH}/api/input/today_ip_addresses.csv"
-OUTPUT_FILE_PATH = f"{BASIC_PATH}/api/output/detect_IP_{date}.csv"
+OUTPUT_FILE_PATTERN = f"{BASIC_PATH}/api/output/detect_IP_{{date}}.csv"
+STATE_DB_PATH = f"{BASIC_PATH}/api/input/ip_state.db"
+
+
+def csv_file_path():
+    """Today's crawl output"""
+    return CSV_FILE_PATTERN.format(date=current_date())
+
+
+def output_file_path():
+    """Today's record of new malicious IPs"""
+    return OUTPUT_FILE_PATTERN.format(date=current_date())
 
 # SRX API
 VSRX_IP = ""
@@ -35,11 +67,104 @@ VSRX_HEADERS = {
     "Accept": "application/xml"
 }
 
+# SRX Devices (one entry per SRX cluster, the first one is the default device)
+DEVICES = [
+    {"name": "vsrx", "host": VSRX_IP, "port": VSRX_PORT, "user": API_USER, "password": API_PASSWORD},
+]
+DEVICE_PUSH_WORKERS = 4
+
+# SRX Batching
+EDIT_CONFIG_CHUNK_SIZE = 500
+
+# Commit Window (commit after this many changes or once the oldest pending change is this old)
+COMMIT_WINDOW_ITEMS = 5000
+COMMIT_WINDOW_SECONDS = 60
+
+# Deny Set Sharding (members per address set; check the limit of your SRX model)
+ADDRESS_SET_MAX_MEMBERS = 1024
+ADDRESS_SET_FILL_FACTOR = 0.8
+ADDRESS_SET_SHRINK_FACTOR = 0.75
+
+# Sync the device from a get-configuration snapshot instead of the local push history
+RECONCILE_MODE = False
+
+# Daemon Mode (python main.py --daemon; job intervals in seconds)
+DAEMON_CRAWL_INTERVAL = 3600
+DAEMON_EXPIRY_INTERVAL = 3600
+DAEMON_RECONCILE_INTERVAL = 86400
+
+# Category Groups (query names from cip_c2_detect_query.json -> own address set and policy; "deny" blocks,
+# "log" permits and logs sessions; categories in no group stay in test-deny-set)
+CATEGORY_GROUPS = {
+    # "c2": {"categories": ["Cobalt Strike", "covenant", "sliver"], "action": "deny"},
+    # "scanner": {"categories": ["SSH Worm"], "action": "log"},
+}
+
+# Allowlist (ranges never blocked; source name -> CIDR file or list of files, one CIDR per line or a cloud provider JSON range file)
+ALLOWLIST_FILES = {
+    # "own": f"{BASIC_PATH}/allowlist/own.txt",
+    # "aws": f"{BASIC_PATH}/allowlist/ip-ranges.json",
+}
+
+# Prefix Aggregation (a density below 1.0 lets a prefix cover some unlisted addresses)
+AGGREGATE_PREFIXES = True
+AGGREGATE_MIN_DENSITY = 1.0
+AGGREGATE_MIN_PREFIX_LEN = 24
+
+# Retries And Circuit Breakers
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 60
+CIP_RETRY_MAX_ATTEMPTS = 5
+CIP_RETRY_BUDGET = 500
+SRX_RETRY_MAX_ATTEMPTS = 3
+SRX_RETRY_BUDGET = 100
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 10
+CIRCUIT_BREAKER_RESET_SECONDS = 300
+
+# HTTP Connection Pooling
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 16
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 120
+
+# Dynamic Address Feed (FEED_URL is how the SRX reaches this host, e.g. http://10.0.0.5:8080)
+FEED_MODE = False
+FEED_DIR = f"{BASIC_PATH}/api/output/feed"
+FEED_URL = ""
+FEED_SERVER_HOST = "0.0.0.0"
+FEED_SERVER_PORT = 8080
+FEED_KEEP_VERSIONS = 24
+FEED_UPDATE_INTERVAL = 300
+FEED_HOLD_INTERVAL = 86400
+FEED_ADDRESS_NAME = "cip-dynamic-blocklist"
+FEED_POLICY_NAME = "deny-to-cip-feed"
+
 # CIP API
 CRIMINALIP_API_KEY = ""
 BASE_URL = "https://api.criminalip.io/"
 ENDPOINT = "v1/banner/search"
 HEADERS = {"x-api-key": CRIMINALIP_API_KEY, "Cache-Control": "no-cache"}
 
+# CIP Crawling (tune the rate limit to your API plan)
+CIP_RATE_LIMIT_PER_SECOND = 2.0
+CIP_RATE_LIMIT_BURST = 5
+CIP_RATE_LIMIT_BACKOFF_SECONDS = 30
+CIP_CRAWL_WORKERS = 4
+CIP_PARTITION_WORKERS = 4
+CIP_MIN_PARTITION_SECONDS = 3600
+CSV_FLUSH_ROWS = 1000
+CSV_FLUSH_SECONDS = 5
+
+# Crawl Page Cache (lets a crashed crawl resume without fetching its pages again)
+CRAWL_CACHE_DIR = f"{BASIC_PATH}/api/input/page_cache"
+CRAWL_CACHE_MAX_BYTES = 512 * 1024 * 1024
+CRAWL_CACHE_MAX_AGE_SECONDS = 86400
+
+# Query Cursors (remember the newest result time per query and only fetch newer results)
+QUERY_CURSORS = True
+CIP_RESULT_TIME_FIELD = "scan_dtime"
+
 # Global Set To Keep Track Of IP Addresses
-ip_data = set()
+ip_data = IPSet()
+# IPs already recorded under each category, so an IP found by several queries keeps all its categories
+category_ip_data = {}
@@ -1,39 +1,347 @@
+import argparse
 import logging
-from api.criminalip.cip_request_get_ip import process_ioc
-from api.criminalip.manage_files import merge_and_update_ip_addresses, output_result
-from api.juniper_networks.utils import load_queries
-from config import QUERY_FILE_NAME
-from api.juniper_networks.api import check_if_policy_exists, create_address_object, create_address_set, create_security_policy, delete_address_object, delete_address_object_from_address_set
-
-def main():
-    queries = load_queries(QUERY_FILE_NAME)
-    for c2_name, query_list in queries.data.items():
-        process_ioc(c2_name, query_list)
-    
-    new_ip_addresses, delete_ip_addresses = merge_and_update_ip_addresses()
-
-    if delete_ip_addresses:
-        logging.info(f"Deleting address objects for {len(delete_ip_addresses)} malicious IPs")
-        ip_list = list(delete_ip_addresses) if isinstance(delete_ip_addresses, set) else delete_ip_addresses
-        for ip in ip_list:
-            delete_address_object(ip)
-        for ip in ip_list:
-            delete_address_object_from_address_set(ip)
-
-    if new_ip_addresses:
-        logging.info(f"Creating address objects for {len(new_ip_addresses)} new malicious IPs")
-        ip_list = list(new_ip_addresses) if isinstance(new_ip_addresses, set) else new_ip_addresses
-        for ip in ip_list:
-            create_address_object(ip)
-        for ip in ip_list:
-            create_address_set(ip)
-        
-    if not check_if_policy_exists():
-        create_security_policy()
+import signal
+import time
+from api.criminalip.cip_request_get_ip import cip_retry, crawl_queries
+from api.criminalip.manage_files import DEFAULT_DEVICE, active_ip_addresses, category_groups, desired_prefixes, group_members, has_push_history, merge_and_update_ip_addresses, output_result, plan_prefix_changes, save_pushed_prefixes, update_group_members
+from api.juniper_networks.utils import load_queries, srx_retry_policies
+from api.http_client import close_sessions, log_connection_stats
+from api.feed_server import FEED_FILE_NAME, publish_feed, serve_feed
+from api.scheduler import Scheduler
+from config import QUERY_FILE_NAME, RECONCILE_MODE, current_date, ip_data, category_ip_data
+from config import DAEMON_CRAWL_INTERVAL, DAEMON_EXPIRY_INTERVAL, DAEMON_RECONCILE_INTERVAL
+from config import FEED_MODE, FEED_DIR, FEED_URL, FEED_SERVER_HOST, FEED_SERVER_PORT, FEED_KEEP_VERSIONS
+from config import FEED_UPDATE_INTERVAL, FEED_HOLD_INTERVAL, FEED_ADDRESS_NAME, FEED_POLICY_NAME
+from api.juniper_networks.api import AddressChangeSet, DENY_ADDRESS_SET_NAME, DENY_POLICY_NAME, check_if_policy_exists, create_dynamic_address_feed, create_permit_security_policy, create_security_policy, delete_security_policy, fetch_address_book, plan_group_sets, plan_reconcile
+from api.category_groups import action_mask, address_sets
+from api.juniper_networks.commit import commit_manager_for, log_commit_stats
+from api.juniper_networks.devices import fan_out
+from api.metrics import DEVICE_FAILED_CHANGES, LAST_RUN, RUN_DURATION, record_retry_stats, start_metrics_server, timed_stage, write_textfile
+from api.log_pipeline import setup_logging
+from config import METRICS_TEXTFILE_PATH, METRICS_HTTP_HOST, METRICS_HTTP_PORT
+from config import LOG_FILE_NAME, LOG_LEVEL, LOG_JSON, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_DEBUG_SAMPLE_RATE
+
+def emptied_groups(groups, current, desired):
+    """Groups that have prefixes in current and none left in desired"""
+    held = 0
+    for mask in current.values():
+        held |= mask
+    wanted = 0
+    for mask in desired.values():
+        wanted |= mask
+    return [group for group in groups if (held & ~wanted) >> group.bit & 1]
+
+
+def push_changes(device, new_ip_addresses, delete_ip_addresses, desired, groups):
+    """Push the difference between the local push history of device and the blocklist
+
+    Returns the number of changes that were not applied.
+    """
+    prefixes_to_add, prefixes_to_delete, pushed, shard_counts = plan_prefix_changes(
+        new_ip_addresses, delete_ip_addresses, device.name, desired, groups[0].address_set
+    )
+
+    change_set = AddressChangeSet()
+
+    if prefixes_to_delete:
+        logging.info(f"Deleting {len(prefixes_to_delete)} address objects of expired malicious IPs")
+        for prefix in prefixes_to_delete:
+            change_set.delete_address(prefix, address_set_name=None)
+
+    if prefixes_to_add:
+        logging.info(f"Creating {len(prefixes_to_add)} address objects for new malicious IPs")
+        for prefix in prefixes_to_add:
+            change_set.add_address(prefix, address_set_name=None)
+
+    new_shard_counts = plan_group_sets(change_set, address_sets(groups), pushed, desired, shard_counts)
+    # A policy must go before the address set it refers to
+    for group in emptied_groups(groups, pushed, desired):
+        delete_security_policy(group.policy)
+
+    failed = []
+    if len(change_set):
+        results = change_set.push()
+        failed = [item for _, item, success in results if not success]
+        if failed:
+            logging.error(f"{len(failed)} address changes were not applied on {device.name}")
+        else:
+            shard_counts = new_shard_counts
+        pushed = AddressChangeSet.applied_groups(results, pushed, desired)
+    save_pushed_prefixes(pushed, shard_counts, device.name)
+    return len(failed)
+
+
+def reconcile_changes(device, desired, groups):
+    """Sync device to the blocklist from one snapshot of its address book
+
+    Returns the number of changes that were not applied, or None if the
+    snapshot could not be fetched.
+    """
+    snapshot = fetch_address_book()
+    if snapshot is None:
+        return None
+
+    change_set, shard_counts = plan_reconcile(snapshot, desired, address_sets(groups))
+    pushed = snapshot.managed_groups(address_sets(groups))
+    for group in emptied_groups(groups, pushed, desired):
+        delete_security_policy(group.policy)
+    failed = []
+    if len(change_set):
+        results = change_set.push()
+        failed = [item for _, item, success in results if not success]
+        if failed:
+            logging.error(f"{len(failed)} address changes were not applied on {device.name}")
+            # The layout is unknown now, the next reconcile will read it again
+            shard_counts = None
+        pushed = AddressChangeSet.applied_groups(results, pushed, desired)
     else:
-        logging.info("Policy already exists, skipping creation")
+        logging.info(f"Address book of {device.name} already matches the blocklist")
+    save_pushed_prefixes(pushed, shard_counts, device.name)
+    return len(failed)
+
+
+def ensure_policies(groups, desired):
+    """Create the policy of every group that has members and no policy yet
+
+    A group without members has no address set for a policy to refer to.
+    """
+    held = 0
+    for mask in desired.values():
+        held |= mask
+    for group in groups:
+        if not held >> group.bit & 1:
+            continue
+        if check_if_policy_exists(group.policy):
+            logging.info(f"Policy {group.policy} already exists, skipping creation")
+        elif group.action == "log":
+            create_permit_security_policy(group.policy, group.address_set, "trust", "untrust")
+        else:
+            create_security_policy(group.policy, group.address_set)
+
+
+def sync_device(device, new_ip_addresses, delete_ip_addresses, desired, reconcile, groups):
+    """Bring one device in line with the blocklist and make sure the group policies exist
+
+    Devices without a push history are reconciled, since their address book
+    is unknown. Returns the number of changes that were not applied.
+    """
+    failed = None
+    with timed_stage("push", device=device.name):
+        if reconcile or (device.name != DEFAULT_DEVICE and not has_push_history(device.name)):
+            failed = reconcile_changes(device, desired, groups)
+            if failed is None:
+                logging.error(f"Could not read the address book of {device.name}, falling back to the local push history")
+        if failed is None:
+            failed = push_changes(device, new_ip_addresses, delete_ip_addresses, desired, groups)
+
+    with timed_stage("policy_check", device=device.name):
+        ensure_policies(groups, desired)
+        if not commit_manager_for(device).flush():
+            failed += 1
+    return failed
+
+
+def wire_feed(device):
+    """Wire the feed policy on device once
+
+    Returns the number of changes that were not applied.
+    """
+    if check_if_policy_exists(FEED_POLICY_NAME):
+        logging.info(f"Feed policy already exists on {device.name}, skipping creation")
+        return 0
+    if not FEED_URL:
+        logging.error("FEED_URL is not set, cannot wire the dynamic address feed on the device")
+        return 1
+    if not create_dynamic_address_feed(
+        FEED_URL, f"/{FEED_FILE_NAME}", address_name=FEED_ADDRESS_NAME,
+        update_interval=FEED_UPDATE_INTERVAL, hold_interval=FEED_HOLD_INTERVAL,
+    ):
+        return 1
+    if not create_security_policy(FEED_POLICY_NAME, FEED_ADDRESS_NAME):
+        return 1
+    return 0 if commit_manager_for(device).flush() else 1
+
+
+def log_device_results(results):
+    """Log one line per device with the outcome of its sync"""
+    for name, result in sorted(results.items()):
+        DEVICE_FAILED_CHANGES.set(1 if isinstance(result, Exception) else result, device=name)
+        if isinstance(result, Exception):
+            logging.error(f"Device {name}: failed ({result})")
+        elif result:
+            logging.error(f"Device {name}: {result} changes not applied")
+        else:
+            logging.info(f"Device {name}: in sync")
+
+
+def run_pipeline(reconcile=RECONCILE_MODE, feed=FEED_MODE, crawl=True, state=None):
+    """Crawl, merge and push once, returning the new and expired IPs
+
+    With crawl=False only today's crawl output is merged again, which applies
+    expiries. state keeps the active blocklist in memory between daemon cycles.
+    """
+    started = time.perf_counter()
+    if crawl:
+        with timed_stage("crawl"):
+            queries = load_queries(QUERY_FILE_NAME)
+            crawl_queries(queries.data)
+
+    with timed_stage("merge"):
+        new_ip_addresses, delete_ip_addresses, recategorized = merge_and_update_ip_addresses()
+    with timed_stage("aggregate"):
+        active = state.update(new_ip_addresses, delete_ip_addresses) if state else None
+        groups = category_groups(DENY_ADDRESS_SET_NAME, DENY_POLICY_NAME)
+        members = state.update_groups(groups, new_ip_addresses.union(recategorized), delete_ip_addresses) if state else None
+        desired = desired_prefixes(active, groups, members)
+
+    if feed:
+        # The feed sits behind one deny policy, so log-only prefixes stay off it
+        deny = action_mask(groups, "deny")
+        with timed_stage("publish_feed"):
+            publish_feed([prefix for prefix, mask in desired.items() if mask & deny], FEED_DIR, FEED_KEEP_VERSIONS)
+        results = fan_out(wire_feed)
+    else:
+        results = fan_out(
+            lambda device: sync_device(device, new_ip_addresses, delete_ip_addresses, desired, reconcile, groups)
+        )
+    log_device_results(results)
 
     output_result(new_ip_addresses)
+    report_run(started)
+    return new_ip_addresses, delete_ip_addresses
+
+
+def report_run(started):
+    """Log the connection, retry and commit counters and export the run metrics"""
+    log_connection_stats()
+    cip_retry.log_stats()
+    for policy in srx_retry_policies():
+        policy.log_stats()
+    log_commit_stats()
+
+    record_retry_stats(cip_retry)
+    for policy in srx_retry_policies():
+        record_retry_stats(policy)
+    RUN_DURATION.set(time.perf_counter() - started)
+    LAST_RUN.set(int(time.time()))
+    if METRICS_TEXTFILE_PATH:
+        write_textfile(METRICS_TEXTFILE_PATH)
+
+
+class WarmState:
+    """State the daemon keeps in memory between cycles
+
+    The active blocklist and the IPs of each category group are read from the
+    state store once and then updated from the merge results, so a cycle only
+    reads the category masks of the IPs its merge added or recategorized.
+    """
+
+    def __init__(self):
+        self.active = None
+        self.groups = None
+        self.members = None
+        self.crawl_date = None
+
+    def update(self, new_ip_addresses, delete_ip_addresses):
+        """Apply a merge result to the in-memory blocklist and return it"""
+        if self.active is None:
+            self.active = active_ip_addresses()
+        else:
+            self.active = self.active.union(new_ip_addresses).difference(delete_ip_addresses)
+        return self.active
+
+    def update_groups(self, groups, changed, removed):
+        """Apply a merge result to the in-memory group members and return them
+
+        The members are read again when the groups or their categories change.
+        """
+        if len(groups) < 2:
+            self.groups = self.members = None
+        elif self.members is None or self.groups != groups:
+            self.members = group_members(self.active, groups)
+            self.groups = groups
+        else:
+            self.members = update_group_members(self.members, groups, changed, removed)
+        return self.members
+
+    def start_crawl(self):
+        """Start a new crawl dedupe set when the day, and with it the crawl CSV, changes"""
+        today = current_date()
+        if self.crawl_date != today:
+            ip_data.clear()
+            category_ip_data.clear()
+            self.crawl_date = today
+
+
+def run_daemon(feed=FEED_MODE):
+    """Run the crawl, expiry and reconcile jobs on their intervals until SIGTERM or SIGINT"""
+    state = WarmState()
+    scheduler = Scheduler()
+
+    def cycle(**kwargs):
+        cip_retry.reset_stats()
+        for policy in srx_retry_policies():
+            policy.reset_stats()
+        run_pipeline(feed=feed, state=state, **kwargs)
+
+    def crawl_job():
+        state.start_crawl()
+        cycle(reconcile=False, crawl=True)
+
+    scheduler.add_job("crawl", DAEMON_CRAWL_INTERVAL, crawl_job)
+    scheduler.add_job("expiry", DAEMON_EXPIRY_INTERVAL, lambda: cycle(reconcile=False, crawl=False), DAEMON_EXPIRY_INTERVAL)
+    if not feed:
+        scheduler.add_job(
+            "reconcile", DAEMON_RECONCILE_INTERVAL, lambda: cycle(reconcile=True, crawl=False), DAEMON_RECONCILE_INTERVAL
+        )
+
+    def stop(signum, frame):
+        logging.info(f"Received signal {signum}, stopping after the current job")
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        scheduler.run()
+    finally:
+        close_sessions()
+        logging.info("Daemon stopped")
+
+
+def main(reconcile=RECONCILE_MODE, feed=FEED_MODE):
+    run_pipeline(reconcile, feed)
+    close_sessions()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Block Criminal IP malicious IPs on Juniper SRX")
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="sync the device from a snapshot of its address book instead of the local push history",
+    )
+    parser.add_argument(
+        "--feed",
+        action="store_true",
+        help="publish the blocklist as a dynamic address feed instead of editing the address book",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and crawl, expire and reconcile on the DAEMON_* intervals until SIGTERM",
+    )
+    parser.add_argument(
+        "--serve-feed",
+        action="store_true",
+        help="only serve the published feed over HTTP until interrupted",
+    )
+    args = parser.parse_args()
+    setup_logging(LOG_FILE_NAME, LOG_LEVEL, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_JSON, LOG_DEBUG_SAMPLE_RATE)
+    if METRICS_HTTP_PORT:
+        start_metrics_server(METRICS_HTTP_HOST, METRICS_HTTP_PORT)
+    if args.serve_feed:
+        serve_feed(FEED_DIR, FEED_SERVER_HOST, FEED_SERVER_PORT)
+    elif args.daemon:
+        run_daemon(feed=args.feed or FEED_MODE)
+    else:
+        main(reconcile=args.reconcile or RECONCILE_MODE, feed=args.feed or FEED_MODE)
\ No newline at end of file
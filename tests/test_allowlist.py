@@ -0,0 +1,76 @@
+import ipaddress
+import json
+import random
+
+from api.allowlist import Allowlist, PrefixTrie, load_allowlist
+from api.ip_set import IPSet
+
+
+def random_prefixes(rng, count):
+    prefixes = []
+    for _ in range(count):
+        length = rng.choice([8, 12, 16, 20, 24, 28, 30, 32])
+        prefixes.append(ipaddress.ip_network((rng.getrandbits(32), length), strict=False))
+    return prefixes
+
+
+def test_trie_lookup_matches_brute_force():
+    rng = random.Random(7)
+    prefixes = random_prefixes(rng, 300)
+    trie = PrefixTrie(32)
+    for index, network in enumerate(prefixes):
+        trie.insert(int(network.network_address), network.prefixlen, index)
+
+    addresses = [rng.getrandbits(32) for _ in range(2000)]
+    addresses += [int(network.network_address) for network in prefixes]
+    for value in addresses:
+        address = ipaddress.IPv4Address(value)
+        containing = [(network.prefixlen, -index) for index, network in enumerate(prefixes) if address in network]
+        # Most specific prefix wins; a prefix listed twice keeps its first source
+        expected = -max(containing)[1] if containing else None
+        assert trie.lookup(value) == expected
+
+
+def test_trie_overlaps_matches_brute_force():
+    rng = random.Random(11)
+    prefixes = random_prefixes(rng, 200)
+    trie = PrefixTrie(32)
+    for network in prefixes:
+        trie.insert(int(network.network_address), network.prefixlen, "source")
+
+    for candidate in random_prefixes(rng, 2000) + prefixes:
+        expected = any(candidate.overlaps(network) for network in prefixes)
+        assert trie.overlaps(int(candidate.network_address), candidate.prefixlen) == expected
+
+
+def test_filter_and_split_overlapping():
+    allowlist = Allowlist()
+    allowlist.add("10.0.0.0/24", "corp")
+    allowlist.add("2001:db8::/32", "cloud")
+    hits = {}
+    kept = allowlist.filter(IPSet(["10.0.0.5", "10.0.1.5", "2001:db8::1", "2001:db9::1"]), hits)
+
+    assert list(kept) == ["10.0.1.5", "2001:db9::1"]
+    assert {source: len(values) for source, values in hits.items()} == {"corp": 1, "cloud": 1}
+    assert allowlist.match("10.0.0.200") == "corp"
+    assert allowlist.match("10.0.1.1") is None
+
+    blocked = IPSet(["10.0.1.1", "10.0.1.2"])
+    assert allowlist.split_overlapping({"10.0.0.0/23", "192.0.2.0/24"}, blocked) == {
+        "10.0.1.1/32", "10.0.1.2/32", "192.0.2.0/24",
+    }
+
+
+def test_load_allowlist_reads_text_and_json_files(tmp_path):
+    text_file = tmp_path / "corp.txt"
+    text_file.write_text("# office\n198.51.100.0/24\n\nnot a range\n203.0.113.7 # vpn\n")
+    json_file = tmp_path / "ip-ranges.json"
+    json_file.write_text(json.dumps({"prefixes": [{"ip_prefix": "192.0.2.0/24"}], "ipv6_prefixes": [{"ipv6_prefix": "2001:db8::/32"}]}))
+
+    allowlist = load_allowlist({"corp": str(text_file), "aws": [str(json_file)]})
+
+    assert len(allowlist) == 4
+    assert allowlist.sources == {"corp": 2, "aws": 2}
+    assert allowlist.match("203.0.113.7") == "corp"
+    assert allowlist.match("2001:db8::5") == "aws"
+    assert not allowlist.is_stale({"corp": str(text_file), "aws": [str(json_file)]})
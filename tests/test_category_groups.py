@@ -0,0 +1,47 @@
+import pytest
+
+from api.category_groups import address_sets, build_groups, group_mask
+
+CATEGORY_BITS = {"Cobalt Strike": 0, "Sliver": 1, "SSH Scanner": 2}
+GROUP_BITS = {"c2": 1, "scanner": 2}
+
+
+def make_groups(group_config):
+    return build_groups(group_config, CATEGORY_BITS, GROUP_BITS, "test-deny-set", "deny-to-test-set")
+
+
+def test_build_groups_puts_ungrouped_categories_in_the_default_group():
+    groups = make_groups({"c2": {"categories": ["Cobalt Strike", "Sliver"]}})
+    default, c2 = groups
+    assert (default.bit, default.address_set, default.action) == (0, "test-deny-set", "deny")
+    assert (c2.address_set, c2.policy, c2.action) == ("cip-c2-set", "cip-c2-deny", "deny")
+    assert c2.categories == 0b011
+    assert default.categories & 0b100
+    assert not default.categories & 0b011
+    assert address_sets(groups) == {0: "test-deny-set", 1: "cip-c2-set"}
+
+
+def test_group_mask():
+    groups = make_groups({"c2": {"categories": ["Cobalt Strike", "Sliver"]}})
+    assert group_mask(0b001, groups) == 0b10
+    assert group_mask(0b100, groups) == 0b01
+    assert group_mask(0b101, groups) == 0b11
+    # IPs stored before categories were recorded stay in the default set
+    assert group_mask(0, groups) == 0b01
+
+
+def test_deny_wins_over_log():
+    groups = make_groups({
+        "scanner": {"categories": ["SSH Scanner"], "action": "log"},
+        "c2": {"categories": ["Cobalt Strike"], "action": "deny"},
+    })
+    assert group_mask(0b100, groups) == 0b100
+    # Seen by a deny and a log category: only in the deny set
+    assert group_mask(0b101, groups) == 0b010
+    # A category in no group puts the IP in the default deny set
+    assert group_mask(0b110, groups) == 0b001
+
+
+def test_unknown_action_is_rejected():
+    with pytest.raises(ValueError, match="drop"):
+        make_groups({"c2": {"categories": ["Sliver"], "action": "drop"}})
@@ -0,0 +1,78 @@
+import ipaddress
+import random
+
+import pytest
+
+from api.cidr import aggregate_prefixes, host_prefixes
+from api.ip_set import IPSet
+from api.juniper_networks.api import ADDRESS_NAME_PREFIX, address_object_name, as_prefix
+
+
+def random_ips(rng, count):
+    # Draw from a few /22s so that whole /24s and their halves fill up
+    bases = [int(ipaddress.IPv4Address(base)) for base in ("10.0.0.0", "192.168.4.0", "203.0.112.0")]
+    return IPSet(str(ipaddress.IPv4Address(rng.choice(bases) + rng.randrange(1024))) for _ in range(count))
+
+
+def covered(prefixes):
+    addresses = []
+    for prefix in prefixes:
+        addresses.extend(str(address) for address in ipaddress.ip_network(prefix))
+    return addresses
+
+
+def assert_disjoint(prefixes):
+    networks = sorted(ipaddress.ip_network(prefix) for prefix in prefixes)
+    for first, second in zip(networks, networks[1:]):
+        assert not first.overlaps(second), (first, second)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_exact_aggregation_covers_the_blocklist_only(seed):
+    ip_set = random_ips(random.Random(seed), 2000)
+    prefixes = aggregate_prefixes(ip_set)
+    addresses = covered(prefixes)
+    assert len(addresses) == len(set(addresses))
+    assert set(addresses) == set(ip_set)
+    assert_disjoint(prefixes)
+    assert min(int(prefix.split("/")[1]) for prefix in prefixes) >= 24
+
+
+def test_exact_aggregation_matches_collapse_addresses_up_to_min_prefix_len():
+    ip_set = random_ips(random.Random(11), 3000)
+    expected = []
+    for network in ipaddress.collapse_addresses(ipaddress.ip_network(prefix) for prefix in host_prefixes(ip_set)):
+        expected.extend(network.subnets(new_prefix=24) if network.prefixlen < 24 else [network])
+    assert sorted(aggregate_prefixes(ip_set), key=ipaddress.ip_network) == sorted(map(str, expected), key=ipaddress.ip_network)
+
+
+def test_min_density_covers_every_address_with_dense_prefixes():
+    ip_set = random_ips(random.Random(3), 1500)
+    prefixes = aggregate_prefixes(ip_set, min_density=0.75)
+    assert_disjoint(prefixes)
+    assert set(ip_set) <= set(covered(prefixes))
+    for prefix in prefixes:
+        network = ipaddress.ip_network(prefix)
+        listed = sum(str(address) in ip_set for address in network)
+        assert listed >= network.num_addresses * 0.75
+    assert len(prefixes) <= len(aggregate_prefixes(ip_set))
+
+
+def test_ipv6_uses_the_same_number_of_host_bits():
+    ip_set = IPSet(f"2001:db8::{value:x}" for value in range(256))
+    ip_set.add("2001:db8::1:1")
+    assert aggregate_prefixes(ip_set, min_prefix_len=24) == ["2001:db8::/120", "2001:db8::1:1/128"]
+
+
+def test_address_object_names():
+    assert address_object_name("10.0.0.1") == address_object_name("10.0.0.1/32")
+    assert address_object_name("10.0.0.0/24") == f"{ADDRESS_NAME_PREFIX}10-0-0-0-24"
+    assert address_object_name("2001:db8::1") == f"{ADDRESS_NAME_PREFIX}2001-db8--1"
+    assert address_object_name("2001:db8::/120") == f"{ADDRESS_NAME_PREFIX}2001-db8---120"
+    assert ":" not in address_object_name("::ffff:10.0.0.1")
+
+
+def test_as_prefix():
+    assert as_prefix("10.0.0.1") == "10.0.0.1/32"
+    assert as_prefix("2001:db8::1") == "2001:db8::1/128"
+    assert as_prefix("10.0.0.0/24") == "10.0.0.0/24"
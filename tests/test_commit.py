@@ -0,0 +1,115 @@
+from collections import namedtuple
+
+import pytest
+
+from api.juniper_networks import commit
+from api.juniper_networks.commit import COMMIT_CHECK_RPC, COMMIT_RPC, ROLLBACK_RPC, CommitManager
+
+Reply = namedtuple("Reply", ["status_code", "text"])
+Device = namedtuple("Device", ["name"])
+
+OK = Reply(200, "<rpc-reply/>")
+ERROR = Reply(200, "<rpc-reply><rpc-error><error-severity>error</error-severity></rpc-error></rpc-reply>")
+
+
+class FakeDevice:
+    """Candidate and running configuration as lists of operations
+
+    ("member", set, name) adds a member, ("ref", set) nests a set in the parent
+    and ("bad", key) stands for a change the commit check rejects. A reference
+    to a set without members is rejected too, like an empty address set.
+    """
+
+    def __init__(self):
+        self.running = []
+        self.candidate = []
+        self.commits = []
+
+    def valid(self, operations):
+        filled = {operation[1] for operation in operations if operation[0] == "member"}
+        return all(
+            operation[0] != "bad" and (operation[0] != "ref" or operation[1] in filled)
+            for operation in operations
+        )
+
+    def rpc(self, payload):
+        if payload == ROLLBACK_RPC:
+            self.candidate = list(self.running)
+        elif payload == COMMIT_CHECK_RPC:
+            return OK if self.valid(self.candidate) else ERROR
+        elif payload == COMMIT_RPC:
+            if not self.valid(self.candidate):
+                return ERROR
+            self.running = list(self.candidate)
+            self.commits.append(list(self.candidate))
+        else:
+            self.candidate.extend(payload)
+        return OK
+
+
+@pytest.fixture
+def device(monkeypatch):
+    device = FakeDevice()
+    monkeypatch.setattr(commit, "make_rpc_request", device.rpc)
+    monkeypatch.setattr(commit, "current_device", lambda: Device("srx-test"))
+    return device
+
+
+def build_payloads(operations):
+    return [tuple(operations)] if operations else []
+
+
+def member_units(keys, set_name="s0"):
+    return [(key, [("member", set_name, key)]) for key in keys]
+
+
+def test_apply_commits_good_windows_once(device):
+    manager = CommitManager(max_items=4, max_seconds=60)
+    assert manager.apply(member_units(range(10)), build_payloads) == set()
+    assert len(device.commits) == 3
+    assert (manager.checks, manager.rollbacks) == (3, 0)
+    assert sorted(name for _, _, name in device.running) == list(range(10))
+
+
+@pytest.mark.parametrize("bad", [[0], [5], [3, 12], [0, 1, 2, 15]])
+def test_apply_bisects_to_the_rejected_units(device, bad):
+    units = [(key, [("bad", key)] if key in bad else [("member", "s0", key)]) for key in range(16)]
+    manager = CommitManager(max_items=100, max_seconds=60)
+    assert manager.apply(units, build_payloads) == set(bad)
+    assert sorted(name for _, _, name in device.running) == [key for key in range(16) if key not in bad]
+    assert len(device.commits) == 1
+    # Two trials per level of the bisection for each rejected unit, plus the first and last check
+    assert manager.checks <= 2 + 2 * len(bad) * 4
+
+
+def test_apply_reports_everything_when_the_base_is_rejected(device):
+    manager = CommitManager(max_items=100, max_seconds=60)
+    assert manager.apply(member_units(range(4)), build_payloads, base=[("bad", "base")]) == {0, 1, 2, 3, None}
+    assert device.running == []
+
+
+def test_base_operations_go_with_the_first_window_that_needs_them(device):
+    def ready(operation, window):
+        return any(unit_operation[1] == operation[1] for _, operations in window for unit_operation in operations)
+
+    units = member_units(range(3), "s0") + member_units(range(3, 6), "s1")
+    base = [("ref", "s1"), ("ref", "s0")]
+    manager = CommitManager(max_items=3, max_seconds=60)
+    assert manager.apply(units, build_payloads, base=base, ready=ready) == set()
+    # Each reference is committed with the members that keep its set from being empty
+    assert [("ref", "s0") in state for state in device.commits] == [True, True]
+    assert [("ref", "s1") in state for state in device.commits] == [False, True]
+    assert manager.rollbacks == 0
+
+
+def test_request_commit_waits_for_the_window(device):
+    manager = CommitManager(max_items=3, max_seconds=60)
+    assert manager.request_commit() and manager.request_commit()
+    assert device.commits == []
+    assert manager.request_commit()
+    assert len(device.commits) == 1
+    manager.request_commit()
+    assert manager.flush()
+    assert len(device.commits) == 2
+    assert manager.flush()
+    assert len(device.commits) == 2
@@ -0,0 +1,99 @@
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from api.juniper_networks.parser import ConfigRecord, iter_config_records, iter_xml_chunks
+
+CONFIGURATION = b"""<configuration xmlns="http://xml.juniper.net/xnm/1.1/xnm">
+  <security>
+    <address-book>
+      <name>global</name>
+      <address><name>test-ip-10-0-0-1</name><ip-prefix>10.0.0.1/32</ip-prefix></address>
+      <address><name>test-ip-10-0-1-0-24</name><ip-prefix>10.0.1.0/24</ip-prefix></address>
+      <address-set>
+        <name>test-deny-set-0</name>
+        <address><name>test-ip-10-0-0-1</name></address>
+        <address><name>test-ip-10-0-1-0-24</name></address>
+      </address-set>
+      <address-set>
+        <name>test-deny-set</name>
+        <address-set><name>test-deny-set-0</name></address-set>
+      </address-set>
+    </address-book>
+    <address-book>
+      <name>trust-book</name>
+      <address><name>test-ip-2001-db8--1</name><ip-prefix>2001:db8::1/128</ip-prefix></address>
+    </address-book>
+    <policies>
+      <policy>
+        <from-zone-name>untrust</from-zone-name>
+        <to-zone-name>trust</to-zone-name>
+        <policy><name>deny-to-test-set</name><match><source-address>test-deny-set</source-address></match></policy>
+        <policy><name>allow-web</name></policy>
+      </policy>
+    </policies>
+  </security>
+</configuration>
+"""
+
+RECORDS = [
+    ConfigRecord("address", "global", "test-ip-10-0-0-1", "10.0.0.1/32"),
+    ConfigRecord("address", "global", "test-ip-10-0-1-0-24", "10.0.1.0/24"),
+    ConfigRecord("set-member", "global", "test-deny-set-0", "test-ip-10-0-0-1"),
+    ConfigRecord("set-member", "global", "test-deny-set-0", "test-ip-10-0-1-0-24"),
+    ConfigRecord("set-reference", "global", "test-deny-set", "test-deny-set-0"),
+    ConfigRecord("address", "trust-book", "test-ip-2001-db8--1", "2001:db8::1/128"),
+    ConfigRecord("policy", ("untrust", "trust"), "deny-to-test-set", None),
+    ConfigRecord("policy", ("untrust", "trust"), "allow-web", None),
+]
+
+
+def multipart(payload, boundary=b"--a1b2c3"):
+    return (
+        boundary + b"\r\nContent-Type: application/xml; charset=utf-8\r\n\r\n"
+        + payload + b"\r\n" + boundary + b"--\r\n"
+    )
+
+
+def chunked(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64, 1 << 20])
+def test_multipart_reply_in_any_chunking(size):
+    reply = multipart(CONFIGURATION)
+    assert b"".join(iter_xml_chunks(chunked(reply, size))).strip() == CONFIGURATION.strip()
+    assert list(iter_config_records(chunked(reply, size))) == RECORDS
+
+
+@pytest.mark.parametrize("size", [1, 64])
+def test_plain_reply(size):
+    assert list(iter_config_records(chunked(CONFIGURATION, size))) == RECORDS
+
+
+def test_empty_reply():
+    assert list(iter_xml_chunks([])) == []
+    assert list(iter_xml_chunks([b"--a1b2c3\r\n", b"\r\n"])) == []
+
+
+def large_reply(count):
+    yield b"--a1b2c3\r\n\r\n<configuration><security><address-book><name>global</name>"
+    for value in range(count):
+        address = f"10.{value >> 16 & 255}.{value >> 8 & 255}.{value & 255}"
+        yield f"<address><name>test-ip-{address.replace('.', '-')}</name><ip-prefix>{address}/32</ip-prefix></address>".encode()
+    yield b"</address-book></security></configuration>\r\n--a1b2c3--\r\n"
+
+
+def test_finished_records_are_dropped_from_the_tree():
+    tracemalloc.start()
+    try:
+        count = sum(1 for _ in iter_config_records(large_reply(20000)))
+        _, streamed_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        ET.fromstring(b"".join(iter_xml_chunks(large_reply(20000))))
+        _, tree_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert count == 20000
+    assert streamed_peak < tree_peak / 4
@@ -0,0 +1,99 @@
+from collections import Counter
+
+import pytest
+
+from api.juniper_networks import sharding
+from api.juniper_networks.api import AddressChangeSet
+from api.juniper_networks.sharding import is_deny_set, layout_count, members_from_history, plan_shards, shard_count, shard_index
+
+DENY_SET = "test-deny-set"
+NAMES = [f"test-ip-10-{value >> 16 & 255}-{value >> 8 & 255}-{value & 255}" for value in range(5000)]
+
+
+@pytest.fixture
+def small_sets(monkeypatch):
+    monkeypatch.setattr(sharding, "ADDRESS_SET_MAX_MEMBERS", 100)
+    monkeypatch.setattr(sharding, "ADDRESS_SET_FILL_FACTOR", 0.8)
+    monkeypatch.setattr(sharding, "ADDRESS_SET_SHRINK_FACTOR", 0.75)
+
+
+def test_shard_index_is_stable_and_in_range():
+    for count in (1, 2, 7, 64):
+        indexes = [shard_index(name, count) for name in NAMES]
+        assert indexes == [shard_index(name, count) for name in NAMES]
+        assert set(indexes) == set(range(count))
+
+
+def test_growing_the_shard_count_only_moves_members_to_the_new_shard():
+    for count in range(1, 20):
+        moved = 0
+        for name in NAMES:
+            before, after = shard_index(name, count), shard_index(name, count + 1)
+            if before != after:
+                assert after == count
+                moved += 1
+        # About 1 / (count + 1) of the members move
+        assert abs(moved / len(NAMES) - 1 / (count + 1)) < 0.03
+
+
+def test_shard_index_spreads_members_evenly():
+    sizes = Counter(shard_index(name, 10) for name in NAMES)
+    assert max(sizes.values()) < 1.15 * len(NAMES) / 10
+    assert min(sizes.values()) > 0.85 * len(NAMES) / 10
+
+
+def test_shard_count_grows_when_full_and_shrinks_with_hysteresis(small_sets):
+    assert shard_count(0) == 0
+    assert shard_count(80) == 1
+    assert shard_count(81) == 2
+    assert shard_count(81, current=1) == 2
+    # 4 shards stay until the members fit in 3 shards at 75% of capacity
+    assert shard_count(230, current=4) == 4
+    assert shard_count(180, current=4) == 3
+    assert shard_count(100, current=4) == 2
+    assert shard_count(200, current=2) == 3
+
+
+def apply(change_set, members, shards):
+    """Apply the queued set changes to a model of the device"""
+    for set_name, name in change_set.items[change_set.REMOVE_MEMBER]:
+        members[set_name].remove(name)
+    for parent, child in change_set.items[change_set.REMOVE_SET_REFERENCE]:
+        shards.remove(child)
+    for (set_name,) in change_set.items[change_set.DELETE_SET]:
+        assert not members.pop(set_name, None)
+    for set_name, name in change_set.items[change_set.ADD_MEMBER]:
+        members.setdefault(set_name, set()).add(name)
+    for parent, child in change_set.items[change_set.ADD_SET_REFERENCE]:
+        assert parent == DENY_SET
+        shards.add(child)
+
+
+def test_plan_shards_keeps_every_shard_below_the_limit(small_sets):
+    members, shards = {DENY_SET: set(NAMES[:50])}, set()
+    for size in (50, 400, 1000, 300, 1000, 40):
+        change_set = AddressChangeSet()
+        count = plan_shards(change_set, DENY_SET, members, shards, set(NAMES[:size]))
+        apply(change_set, members, shards)
+        members = {set_name: names for set_name, names in members.items() if names}
+        assert set().union(*members.values()) == set(NAMES[:size])
+        assert all(len(names) <= 100 for names in members.values())
+        assert shards == set(members) - {DENY_SET}
+        assert layout_count(DENY_SET, shards) == count
+        assert members_from_history(DENY_SET, set(NAMES[:size]), count) == (members, shards)
+
+
+def test_plan_shards_adds_shards_until_none_overflows(monkeypatch, small_sets):
+    # A fill factor of 1.0 leaves no slack for the uneven hash
+    monkeypatch.setattr(sharding, "ADDRESS_SET_FILL_FACTOR", 1.0)
+    count = plan_shards(AddressChangeSet(), DENY_SET, {}, set(), set(NAMES[:1000]))
+    assert count > 10
+    assert max(Counter(shard_index(name, count) for name in NAMES[:1000]).values()) <= 100
+
+
+def test_is_deny_set():
+    assert is_deny_set(DENY_SET, DENY_SET)
+    assert is_deny_set(f"{DENY_SET}-12", DENY_SET)
+    assert not is_deny_set(f"{DENY_SET}-x", DENY_SET)
+    assert not is_deny_set("cip-c2-set", DENY_SET)
+    assert not is_deny_set(None, DENY_SET)
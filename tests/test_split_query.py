@@ -0,0 +1,73 @@
+import logging
+from datetime import datetime, timedelta
+
+import pytest
+
+from api.criminalip import cip_request_get_ip
+from api.criminalip.cip_request_get_ip import AFTER_FILTER, BEFORE_FILTER, MAX_REACHABLE_RESULTS, plan_partitions, split_query
+
+DAY_START = datetime(2026, 10, 17)
+
+
+def test_split_whole_days():
+    assert split_query("tag: x after: 2026-10-01 before: 2026-10-05", 86400) == [
+        "tag: x after: 2026-10-01 before: 2026-10-03",
+        "tag: x after: 2026-10-03 before: 2026-10-05",
+    ]
+
+
+def test_split_one_day_into_hours():
+    assert split_query("tag: x after: 2026-10-17 before: 2026-10-18", 3600) == [
+        "tag: x after: 2026-10-17 before: 2026-10-17 12:00:00",
+        "tag: x after: 2026-10-17 12:00:00 before: 2026-10-18",
+    ]
+    assert split_query("tag: x after: 2026-10-17 12:00:00 before: 2026-10-17 14:30:00", 3600) == [
+        "tag: x after: 2026-10-17 12:00:00 before: 2026-10-17 13:00:00",
+        "tag: x after: 2026-10-17 13:00:00 before: 2026-10-17 14:30:00",
+    ]
+
+
+@pytest.mark.parametrize("query, min_window", [
+    ("tag: x", 3600),
+    ("tag: x after: 2026-10-17 before: 2026-10-18", 86400),
+    ("tag: x after: 2026-10-17 12:00:00 before: 2026-10-17 13:59:59", 3600),
+])
+def test_unsplittable_windows(query, min_window):
+    assert split_query(query, min_window) is None
+
+
+def fake_search(monkeypatch, times, honor_time=True):
+    """Answer first-page requests with the number of times inside the window of the query"""
+    def fetch_query_page(url, payload):
+        start = datetime.fromisoformat(AFTER_FILTER.search(payload["query"]).group(1))
+        before = BEFORE_FILTER.search(payload["query"])
+        end = datetime.fromisoformat(before.group(1)) if before else DAY_START + timedelta(days=1)
+        if not honor_time:
+            start = datetime.combine(start.date(), datetime.min.time())
+        count = sum(start <= moment < end for moment in times)
+        return {"data": {"count": count, "result": []}}
+    monkeypatch.setattr(cip_request_get_ip, "fetch_query_page", fetch_query_page)
+    return fetch_query_page
+
+
+def test_plan_partitions_splits_one_day_below_the_cap(monkeypatch):
+    times = [DAY_START + timedelta(seconds=second) for second in range(0, 86400, 2)]
+    fetch = fake_search(monkeypatch, times)
+    query = "tag: x after: 2026-10-17 before: 2026-10-18"
+    partitions, complete = plan_partitions(query, fetch(None, {"query": query}))
+    counts = [page["data"]["count"] for _, page in partitions]
+    assert complete
+    assert len(partitions) > 1
+    assert all(count <= MAX_REACHABLE_RESULTS for count in counts)
+    assert sum(counts) == len(times)
+
+
+def test_plan_partitions_keeps_a_window_the_api_does_not_narrow(monkeypatch, caplog):
+    times = [DAY_START + timedelta(seconds=second) for second in range(0, 86400, 2)]
+    fetch = fake_search(monkeypatch, times, honor_time=False)
+    query = "tag: x after: 2026-10-17 before: 2026-10-18"
+    with caplog.at_level(logging.WARNING):
+        partitions, complete = plan_partitions(query, fetch(None, {"query": query}))
+    assert complete
+    assert [partition for partition, _ in partitions] == [query]
+    assert "did not narrow" in caplog.text
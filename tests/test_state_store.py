@@ -0,0 +1,73 @@
+from datetime import date
+
+import pytest
+
+from api.criminalip.state_store import MAX_TAG_BITS, IPStateStore
+from api.ip_set import IPSet
+
+TODAY = date(2026, 10, 17)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = IPStateStore(str(tmp_path / "ip_state.db"))
+    yield store
+    store.close()
+
+
+def ttl_days(category):
+    return 7
+
+
+def test_merge_records_every_category_of_an_ip(store):
+    result = store.merge({"Sliver": IPSet(["1.1.1.1", "2.2.2.2"]), "SSH Scanner": IPSet(["2.2.2.2"])}, TODAY, ttl_days)
+    bits = store.tag_bits("category", [])
+    assert sorted(result.new) == ["1.1.1.1", "2.2.2.2"]
+    assert dict(store.category_masks()) == {
+        "1.1.1.1": 1 << bits["Sliver"],
+        "2.2.2.2": 1 << bits["Sliver"] | 1 << bits["SSH Scanner"],
+    }
+
+
+
+def test_merge_reports_ips_that_gain_a_category(store):
+    store.merge({"Sliver": IPSet(["1.1.1.1", "2.2.2.2"])}, TODAY, ttl_days)
+    result = store.merge({"Sliver": IPSet(["1.1.1.1", "2.2.2.2"]), "SSH Scanner": IPSet(["2.2.2.2", "3.3.3.3"])}, TODAY, ttl_days)
+    assert sorted(result.new) == ["3.3.3.3"]
+    assert sorted(result.recategorized) == ["2.2.2.2"]
+    bits = store.tag_bits("category", [])
+    assert dict(store.category_masks(["2.2.2.2", "9.9.9.9"])) == {
+        "2.2.2.2": 1 << bits["Sliver"] | 1 << bits["SSH Scanner"],
+    }
+
+def test_tag_bits_are_stable(store):
+    first = store.tag_bits("category", ["b", "a"])
+    assert store.tag_bits("category", ["a", "c"]) == dict(first, c=2)
+    assert store.tag_bits("group", ["c2"], first_bit=1) == {"c2": 1}
+
+
+def test_tag_bits_reuse_the_bits_of_removed_names(store):
+    names = [f"query {i}" for i in range(MAX_TAG_BITS)]
+    store.merge({name: IPSet([f"10.0.{i}.1"]) for i, name in enumerate(names)}, TODAY, ttl_days, set(names))
+    retired_bit = store.tag_bits("category", [])["query 0"]
+
+    configured = set(names[1:]) | {"renamed"}
+    store.merge({"renamed": IPSet(["10.9.9.9"])}, TODAY, ttl_days, configured)
+
+    bits = store.tag_bits("category", [])
+    assert "query 0" not in bits
+    assert bits["renamed"] == retired_bit
+    masks = dict(store.category_masks())
+    # The retired bit is cleared, so old IPs do not turn up in the new category
+    assert masks["10.0.0.1"] == 0
+    assert masks["10.9.9.9"] == 1 << retired_bit
+    assert max(bits.values()) < MAX_TAG_BITS
+
+
+def test_tag_bits_fail_when_no_bit_can_be_reused(store):
+    names = [f"query {i}" for i in range(MAX_TAG_BITS)]
+    store.tag_bits("category", names)
+    with pytest.raises(ValueError, match="at most 63"):
+        store.tag_bits("category", ["one more"], keep=set(names))
+    with pytest.raises(ValueError):
+        store.tag_bits("category", ["one more"])